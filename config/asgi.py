@@ -14,3 +14,11 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# 最初のリクエストを待たずにRAGのモジュールとクライアントを読み込む（manage.pyのコマンドでは行わない）
+from django.conf import settings  # noqa: E402
+
+if settings.RAG_WARMUP_ON_STARTUP:
+    from rag.services import warm_up
+
+    warm_up()
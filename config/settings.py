@@ -161,17 +161,135 @@ ACCOUNT_USERNAME_REQUIRED = False
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
-# LangSmith settings
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
-os.environ["LANGCHAIN_API_KEY"] = config("LANGCHAIN_API_KEY", default="")
-os.environ["LANGCHAIN_PROJECT"] = "agent-book"
+# LangSmith settings（リモートへのトレース送信は明示的に有効にした場合だけ行う）
+LANGSMITH_TRACING = config("LANGSMITH_TRACING", default=False, cast=bool)
+# 送信するトレースの割合（0〜1、リクエスト単位でサンプリング）
+LANGSMITH_TRACING_SAMPLING_RATE = config("LANGSMITH_TRACING_SAMPLING_RATE", default=0.1, cast=float)
+LANGCHAIN_API_KEY = config("LANGCHAIN_API_KEY", default="")
+# APIキーが無い場合は、有効にしても送信を試みない
+_langsmith_enabled = LANGSMITH_TRACING and bool(LANGCHAIN_API_KEY)
+os.environ["LANGSMITH_TRACING"] = "true" if _langsmith_enabled else "false"
+os.environ["LANGCHAIN_TRACING_V2"] = "true" if _langsmith_enabled else "false"
+if _langsmith_enabled:
+    os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
+    os.environ["LANGCHAIN_API_KEY"] = LANGCHAIN_API_KEY
+    os.environ["LANGCHAIN_PROJECT"] = config("LANGCHAIN_PROJECT", default="agent-book")
+    os.environ["LANGSMITH_TRACING_SAMPLING_RATE"] = str(LANGSMITH_TRACING_SAMPLING_RATE)
+
+# Metrics settings（段階ごとの所要時間をPrometheus形式で /rag/metrics/ に公開）
+RAG_METRICS_ENABLED = config("RAG_METRICS_ENABLED", default=True, cast=bool)
+# 設定すると「Authorization: Bearer <トークン>」でスクレイプできる（未設定ならスタッフのログインが必要）
+RAG_METRICS_TOKEN = config("RAG_METRICS_TOKEN", default="")
 
 # Gemini API settings
 GEMINI_API_KEY = config("GEMINI_API", default="")
 
+# Model gateway settings（プロセス内のLLM・エンベディングの呼び出しをモデルごとにまとめて制御する）
+# モデルごとの同時リクエスト数の上限
+MODEL_GATEWAY_CHAT_CONCURRENCY = config("MODEL_GATEWAY_CHAT_CONCURRENCY", default=8, cast=int)
+MODEL_GATEWAY_EMBEDDING_CONCURRENCY = config("MODEL_GATEWAY_EMBEDDING_CONCURRENCY", default=8, cast=int)
+# 同時リクエスト数の枠が空くのを待つ秒数（超えたら503で「混み合っています」と返す）
+MODEL_GATEWAY_ACQUIRE_TIMEOUT = config("MODEL_GATEWAY_ACQUIRE_TIMEOUT", default=30, cast=float)
+# 429・5xx・タイムアウトを再試行する回数と、ジッタ付き指数バックオフの基準・上限の秒数
+MODEL_GATEWAY_MAX_RETRIES = config("MODEL_GATEWAY_MAX_RETRIES", default=3, cast=int)
+MODEL_GATEWAY_BACKOFF_BASE = config("MODEL_GATEWAY_BACKOFF_BASE", default=0.5, cast=float)
+MODEL_GATEWAY_BACKOFF_MAX = config("MODEL_GATEWAY_BACKOFF_MAX", default=8, cast=float)
+# この回数続けて失敗したら、MODEL_GATEWAY_RESET_TIMEOUT秒の間はAPIを呼ばずにすぐ失敗させる
+MODEL_GATEWAY_FAILURE_THRESHOLD = config("MODEL_GATEWAY_FAILURE_THRESHOLD", default=5, cast=int)
+MODEL_GATEWAY_RESET_TIMEOUT = config("MODEL_GATEWAY_RESET_TIMEOUT", default=30, cast=float)
+# 設定するとGeminiの代わりにfake_model_serverコマンドの擬似モデルサーバーを呼ぶ（例: http://127.0.0.1:8765）
+FAKE_MODEL_SERVER_URL = config("FAKE_MODEL_SERVER_URL", default="")
+
 # Chroma settings
 CHROMA_PERSIST_DIRECTORY = BASE_DIR / 'chroma_db'
 
+# RAG settings
+# ベクトルストアのバックエンド（chroma: ChromaDB、numpy: メモリマップしたNumPy行列による厳密検索）
+RAG_VECTORSTORE_BACKEND = config("RAG_VECTORSTORE_BACKEND", default="chroma")
+# numpyバックエンドの保存先
+NUMPY_INDEX_DIRECTORY = config("NUMPY_INDEX_DIRECTORY", default=str(BASE_DIR / 'numpy_index'))
+# numpyバックエンドで1段目の検索に使うベクトルの次元数（先頭から切り詰める、0で全次元）
+RAG_VECTOR_DIMENSIONS = config("RAG_VECTOR_DIMENSIONS", default=0, cast=int)
+# numpyバックエンドで1段目の検索に使うベクトルの量子化（none / int8 / binary）
+RAG_VECTOR_QUANTIZATION = config("RAG_VECTOR_QUANTIZATION", default="none")
+# 切り詰め・量子化した場合に、全精度のベクトルで並べ替え直す候補数
+RAG_RERANK_CANDIDATES = config("RAG_RERANK_CANDIDATES", default=50, cast=int)
+# chromaバックエンドの保存形式（per_user: ユーザーごとのディレクトリ、shared: 全ユーザーで共有するコレクション）
+RAG_VECTORSTORE_MODE = config("RAG_VECTORSTORE_MODE", default="per_user")
+# sharedモードでユーザーを振り分けるコレクション数
+RAG_VECTORSTORE_SHARDS = config("RAG_VECTORSTORE_SHARDS", default=1, cast=int)
+# プロセス内で開いたままにするユーザー別ベクトルストアの上限数
+RAG_VECTORSTORE_POOL_SIZE = config("RAG_VECTORSTORE_POOL_SIZE", default=32, cast=int)
+# WSGI/ASGIアプリケーションの起動時にRAGのモジュールとクライアントを読み込んでおくか
+RAG_WARMUP_ON_STARTUP = config("RAG_WARMUP_ON_STARTUP", default=False, cast=bool)
+# 非同期ビューからChromaなどのブロッキング処理を実行するスレッド数
+RAG_BLOCKING_THREADS = config("RAG_BLOCKING_THREADS", default=16, cast=int)
+
+# Markdownの読み込み方法（streaming: 1行ずつ読みながらチャンク化、unstructured: UnstructuredMarkdownLoader）
+RAG_MARKDOWN_LOADER = config("RAG_MARKDOWN_LOADER", default="streaming")
+
+# Retrieval settings
+# LLMに渡すチャンク数
+RAG_RETRIEVAL_K = config("RAG_RETRIEVAL_K", default=5, cast=int)
+# ベクトル検索の類似度（コサイン）がこの値未満のチャンクはLLMに渡さない（0で無効）
+# 1件も残らない場合はLLMを呼ばずに「関連する情報が見つかりませんでした」と返す
+RAG_MIN_SIMILARITY = config("RAG_MIN_SIMILARITY", default=0.5, cast=float)
+# 最上位の類似度からこの値より下がったチャンクもLLMに渡さない（0で無効）
+RAG_SCORE_GAP = config("RAG_SCORE_GAP", default=0.15, cast=float)
+# LLMに渡すコンテキストのトークン数の上限（概算）
+RAG_CONTEXT_MAX_TOKENS = config("RAG_CONTEXT_MAX_TOKENS", default=3000, cast=int)
+# プロンプトに含める会話履歴（要約＋直近のやり取り）のトークン数の上限（概算）
+RAG_CHAT_HISTORY_MAX_TOKENS = config("RAG_CHAT_HISTORY_MAX_TOKENS", default=1000, cast=int)
+# そのうち古いやり取りを畳み込んだ要約に使うトークン数の上限
+RAG_CHAT_SUMMARY_MAX_TOKENS = config("RAG_CHAT_SUMMARY_MAX_TOKENS", default=300, cast=int)
+# 語彙検索（文字n-gram・BM25）インデックスの保存先（空にするとベクトル検索のみ）
+LEXICAL_INDEX_DIRECTORY = config("LEXICAL_INDEX_DIRECTORY", default=str(BASE_DIR / 'lexical_index'))
+# ベクトル検索・語彙検索それぞれからRRFでの統合前に取得する候補数
+RAG_HYBRID_CANDIDATES = config("RAG_HYBRID_CANDIDATES", default=20, cast=int)
+RAG_RRF_K = config("RAG_RRF_K", default=60, cast=int)
+# 型番などの識別子がそのまま見つかった場合にエンベディングを呼ばず語彙検索の結果だけで回答する
+RAG_LEXICAL_FAST_PATH = config("RAG_LEXICAL_FAST_PATH", default=True, cast=bool)
+# クエリごとに検索方法（語彙検索のみ・直接エンベディング・HyDE）を選ぶ（Falseで常にHyDE）
+RAG_QUERY_ROUTER = config("RAG_QUERY_ROUTER", default=True, cast=bool)
+# この文字数（空白を除く）以上の質問はHyDEを使わず直接エンベディングする
+RAG_ROUTER_DIRECT_MIN_CHARS = config("RAG_ROUTER_DIRECT_MIN_CHARS", default=40, cast=int)
+# 直接エンベディングでの検索の最高類似度（コサイン）がこの値以上ならHyDEを使わない
+RAG_ROUTER_DIRECT_MIN_SCORE = config("RAG_ROUTER_DIRECT_MIN_SCORE", default=0.7, cast=float)
+
+# Embedding scheduler settings
+EMBEDDING_BATCH_SIZE = config("EMBEDDING_BATCH_SIZE", default=100, cast=int)
+EMBEDDING_MAX_CONCURRENCY = config("EMBEDDING_MAX_CONCURRENCY", default=4, cast=int)
+EMBEDDING_REQUESTS_PER_MINUTE = config("EMBEDDING_REQUESTS_PER_MINUTE", default=1500, cast=int)
+EMBEDDING_TOKENS_PER_MINUTE = config("EMBEDDING_TOKENS_PER_MINUTE", default=1_000_000, cast=int)
+
+# Embedding cache settings（パスを空にするとキャッシュを無効化）
+EMBEDDING_CACHE_PATH = config("EMBEDDING_CACHE_PATH", default=str(BASE_DIR / 'embedding_cache.sqlite3'))
+EMBEDDING_CACHE_MAX_ENTRIES = config("EMBEDDING_CACHE_MAX_ENTRIES", default=200_000, cast=int)
+
+# HyDE cache settings（HYDE_CACHE_BACKENDにCACHESのエイリアスを指定するとプロセス間で共有）
+HYDE_CACHE_BACKEND = config("HYDE_CACHE_BACKEND", default="")
+HYDE_CACHE_TTL = config("HYDE_CACHE_TTL", default=60 * 60 * 24, cast=int)
+HYDE_CACHE_MAX_ENTRIES = config("HYDE_CACHE_MAX_ENTRIES", default=10_000, cast=int)
+
+# Answer cache settings（類似度のしきい値を0より大きくすると言い換えにも一致させる）
+ANSWER_CACHE_ENABLED = config("ANSWER_CACHE_ENABLED", default=True, cast=bool)
+ANSWER_CACHE_TTL = config("ANSWER_CACHE_TTL", default=60 * 60, cast=int)
+ANSWER_CACHE_MAX_USERS = config("ANSWER_CACHE_MAX_USERS", default=1000, cast=int)
+ANSWER_CACHE_MAX_ENTRIES_PER_USER = config("ANSWER_CACHE_MAX_ENTRIES_PER_USER", default=200, cast=int)
+ANSWER_CACHE_SIMILARITY_THRESHOLD = config("ANSWER_CACHE_SIMILARITY_THRESHOLD", default=0.0, cast=float)
+
+# Ingestion worker settings (manage.py run_ingest_workers)
+INGEST_WORKERS = config("INGEST_WORKERS", default=4, cast=int)
+INGEST_POLL_INTERVAL = config("INGEST_POLL_INTERVAL", default=2.0, cast=float)
+INGEST_MAX_ATTEMPTS = config("INGEST_MAX_ATTEMPTS", default=3, cast=int)
+# 失敗したドキュメントを再試行するまでの秒数（試行のたびに2倍にする）
+INGEST_RETRY_BACKOFF = config("INGEST_RETRY_BACKOFF", default=30.0, cast=float)
+# ワーカーが一度に取得してまとめてエンベディングするドキュメント数
+INGEST_CLAIM_BATCH = config("INGEST_CLAIM_BATCH", default=8, cast=int)
+# 処理中のまま放置されたドキュメントを再キューするまでの秒数
+INGEST_STALE_TIMEOUT = config("INGEST_STALE_TIMEOUT", default=600, cast=int)
+# ワーカーのメトリクスを公開するポート（0で公開しない）
+INGEST_METRICS_PORT = config("INGEST_METRICS_PORT", default=0, cast=int)
+
 # Email settings for development
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -1,12 +1,20 @@
 from django.contrib import admin
+from .ingestion import enqueue_documents
 from .models import Document
 
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
     """ドキュメントの管理画面"""
-    list_display = ('title', 'user', 'uploaded_at', 'is_processed')
-    list_filter = ('is_processed', 'uploaded_at')
+    list_display = ('title', 'user', 'uploaded_at', 'status', 'attempts')
+    list_filter = ('status', 'uploaded_at')
     search_fields = ('title', 'user__email')
-    readonly_fields = ('uploaded_at', 'updated_at')
+    readonly_fields = ('uploaded_at', 'updated_at', 'locked_at')
     ordering = ('-uploaded_at',)
+    actions = ('requeue_documents',)
+
+    @admin.action(description='選択したドキュメントを再処理する')
+    def requeue_documents(self, request, queryset):
+        """ドキュメントをベクトル化待ちに戻す"""
+        count = enqueue_documents(queryset)
+        self.message_user(request, f'{count}件のドキュメントを再処理キューに追加しました。')
@@ -0,0 +1,31 @@
+import hashlib
+
+from django.core.files import File
+
+
+def hash_file(file) -> str:
+    """アップロードされたファイルの内容のSHA-256"""
+    hasher = hashlib.sha256()
+    for chunk in file.chunks():
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class HashingFile(File):
+    """保存のために読み出しながら、内容のSHA-256を計算するファイル
+
+    一時ファイルを移動して保存する最適化（temporary_file_path）は使わず、
+    必ずchunks()で読み出して保存させることで、ファイルを二度読まずにハッシュを得る。
+    """
+
+    def __init__(self, file):
+        super().__init__(file, name=file.name)
+        self._hasher = hashlib.sha256()
+
+    def chunks(self, chunk_size=None):
+        for chunk in self.file.chunks(chunk_size):
+            self._hasher.update(chunk)
+            yield chunk
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
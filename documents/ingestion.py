@@ -0,0 +1,338 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import PurePosixPath
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import F, Q
+from django.utils import timezone
+
+from rag.services import DocumentParser, get_document_processor
+
+from .models import Document
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_documents(documents: Iterable[Document]) -> int:
+    """ドキュメントをベクトル化待ちにする"""
+    ids = [document.pk for document in documents]
+    return Document.objects.filter(pk__in=ids).update(
+        status=Document.Status.QUEUED, error_message='', attempts=0, locked_at=None, retry_at=None
+    )
+
+
+def requeue_stale_documents() -> int:
+    """ワーカーが落ちて処理中のまま残ったドキュメントを待機中に戻す"""
+    deadline = timezone.now() - timedelta(seconds=settings.INGEST_STALE_TIMEOUT)
+    stale = Document.objects.filter(status=Document.Status.PROCESSING, locked_at__lt=deadline)
+    stale.filter(attempts__gte=settings.INGEST_MAX_ATTEMPTS).update(
+        status=Document.Status.FAILED, error_message='処理がタイムアウトしました。', locked_at=None
+    )
+    return stale.update(status=Document.Status.QUEUED, locked_at=None)
+
+
+def claim_documents(limit: int) -> List[Document]:
+    """待機中のドキュメントを最大limit件取得して処理中にする（再試行の日時前のものは除く）"""
+    candidates = Document.objects.filter(
+        Q(retry_at__isnull=True) | Q(retry_at__lte=timezone.now()), status=Document.Status.QUEUED
+    ).order_by('uploaded_at')
+    claimed = []
+    for pk in candidates.values_list('pk', flat=True)[:limit * 2]:
+        # 条件付きUPDATEで、他のワーカーと同じドキュメントを取り合わないようにする
+        updated = Document.objects.filter(pk=pk, status=Document.Status.QUEUED).update(
+            status=Document.Status.PROCESSING, locked_at=timezone.now(), attempts=F('attempts') + 1
+        )
+        if updated:
+            claimed.append(pk)
+            if len(claimed) >= limit:
+                break
+    return list(Document.objects.filter(pk__in=claimed).order_by('uploaded_at'))
+
+
+def _reuse_duplicates(processor, documents: List[Document]) -> Tuple[Dict[str, object], List[Document]]:
+    """同じユーザーに同じ内容の処理済みドキュメントがあれば、そのチャンクとエンベディングを複製
+
+    (複製したドキュメントIDごとのチャンク数, 通常どおり読み込んで処理するドキュメント)を返す。
+    """
+    hashed = [document for document in documents if document.content_hash]
+    if not hashed:
+        return {}, documents
+
+    sources = {}
+    candidates = Document.objects.filter(
+        user_id__in={document.user_id for document in hashed},
+        content_hash__in={document.content_hash for document in hashed},
+        status=Document.Status.DONE,
+    ).exclude(pk__in=[document.pk for document in documents]).order_by('uploaded_at')
+    for source in candidates:
+        sources.setdefault((source.user_id, source.content_hash), source)
+
+    results: Dict[str, object] = {}
+    remaining = []
+    for document in documents:
+        source = sources.get((document.user_id, document.content_hash))
+        if source is None:
+            remaining.append(document)
+            continue
+        try:
+            results[str(document.id)] = processor.copy_document_chunks(
+                str(document.user_id), str(source.id), str(document.id), source=document.file.path
+            )
+        except Exception:
+            logger.warning('同じ内容のドキュメントから複製できないため読み込み直します: %s', document.id, exc_info=True)
+            remaining.append(document)
+    return results, remaining
+
+
+def process_documents(documents: List[Document]) -> List[bool]:
+    """ドキュメントをまとめてベクトル化し、それぞれの結果のステータスを保存"""
+    processor = get_document_processor()
+    results, remaining = _reuse_duplicates(processor, documents)
+    results.update(processor.ingest_documents(
+        [(document.file.path, str(document.user_id), str(document.id)) for document in remaining]
+    ))
+
+    outcomes = []
+    for document in documents:
+        result = results[str(document.id)]
+        if isinstance(result, Exception):
+            outcomes.append(_mark_failed(document, result))
+        else:
+            outcomes.append(_mark_done(document, processor))
+    return outcomes
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """attempts回目の試行に失敗した後、再試行するまでの時間"""
+    return timedelta(seconds=settings.INGEST_RETRY_BACKOFF * 2 ** max(attempts - 1, 0))
+
+
+def _mark_failed(document: Document, error: Exception) -> bool:
+    logger.error('ドキュメントの処理に失敗しました: %s', document.id, exc_info=error)
+    retry = document.attempts < settings.INGEST_MAX_ATTEMPTS
+    # 一時的な障害ですぐに試行回数を使い切らないよう、待ってから再試行する
+    Document.objects.filter(pk=document.pk, status=Document.Status.PROCESSING).update(
+        status=Document.Status.QUEUED if retry else Document.Status.FAILED,
+        error_message=str(error),
+        locked_at=None,
+        retry_at=timezone.now() + retry_delay(document.attempts) if retry else None,
+    )
+    return False
+
+
+def fail_documents(documents: List[Document], error: Exception):
+    """処理の途中で例外が発生したバッチのうち、処理中のまま残ったドキュメントを失敗として扱う
+
+    試行回数が残っていれば、待ってから再試行されるよう待機中に戻す。
+    """
+    for document in documents:
+        _mark_failed(document, error)
+
+
+def _mark_done(document: Document, processor) -> bool:
+    updated = Document.objects.filter(pk=document.pk, status=Document.Status.PROCESSING).update(
+        status=Document.Status.DONE, error_message='', locked_at=None
+    )
+    if not updated and not Document.objects.filter(pk=document.pk).exists():
+        # 処理中に削除されたドキュメントのチャンクを残さない
+        processor.delete_document_from_vectorstore(str(document.user_id), str(document.id))
+    return True
+
+
+@dataclass
+class ImportProgress:
+    """ディレクトリ・アーカイブからの一括登録の進捗"""
+    processed: int = 0
+    chunks: int = 0
+    failed: int = 0
+    skipped: int = 0
+    # 同じ内容のドキュメントからチャンクとエンベディングを複製した件数
+    reused: int = 0
+
+
+def _is_markdown(name: str) -> bool:
+    parts = PurePosixPath(name).parts
+    return name.endswith('.md') and not any(part.startswith('.') or part == '__MACOSX' for part in parts)
+
+
+def iter_source_files(path: str) -> Iterator[Tuple[str, bytes]]:
+    """ディレクトリ・zip・tarの中の.mdファイルを(相対パス, 内容)として1件ずつ取り出す"""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full_path = os.path.join(root, name)
+                relative = PurePosixPath(*os.path.relpath(full_path, path).split(os.sep)).as_posix()
+                if _is_markdown(relative):
+                    with open(full_path, 'rb') as f:
+                        yield relative, f.read()
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _is_markdown(info.filename):
+                    yield PurePosixPath(info.filename).as_posix(), archive.read(info)
+    elif tarfile.is_tarfile(path):
+        # ストリームとして先頭から順に読み、アーカイブ全体を展開しない
+        with tarfile.open(path, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and _is_markdown(member.name):
+                    yield PurePosixPath(member.name).as_posix(), archive.extractfile(member).read()
+    else:
+        raise ValueError(f'ディレクトリ・zip・tarのいずれでもありません: {path}')
+
+
+def _init_parser_process():
+    # spawnで起動した子プロセスでDjangoの設定を読み込む
+    import django
+
+    django.setup()
+
+
+def _parse_document(item: Tuple[str, str, str]):
+    """子プロセスでファイルを読み込んでチャンク化（失敗時は例外を返す）"""
+    file_path, user_id, document_id = item
+    try:
+        return DocumentParser().load_chunks(file_path, user_id, document_id)
+    except Exception as e:
+        # 例外の型によってはプロセス間で受け渡せないため、メッセージだけを返す
+        return RuntimeError(f'{type(e).__name__}: {e}')
+
+
+def _claim_queued(pks: List) -> List[Document]:
+    """指定した待機中のドキュメントを1回のUPDATEで処理中にする"""
+    claimed_at = timezone.now()
+    Document.objects.filter(pk__in=pks, status=Document.Status.QUEUED).update(
+        status=Document.Status.PROCESSING, locked_at=claimed_at, attempts=F('attempts') + 1
+    )
+    return list(Document.objects.filter(pk__in=pks, status=Document.Status.PROCESSING, locked_at=claimed_at))
+
+
+def _import_batches(user, path: str, batch_size: int, progress: ImportProgress) -> Iterator[List[Document]]:
+    """処理するドキュメントをbatch_size件ずつ処理中の状態にして返す"""
+    # 前回中断した、またはアップロード後に未処理のドキュメントを先に処理する
+    queued = list(Document.objects.filter(user=user, status=Document.Status.QUEUED).values_list('pk', flat=True))
+    for start in range(0, len(queued), batch_size):
+        claimed = _claim_queued(queued[start:start + batch_size])
+        if claimed:
+            yield claimed
+
+    # 登録済みのタイトルは1回のクエリでまとめて取得する
+    titles = set(Document.objects.filter(user=user).values_list('title', flat=True))
+    max_length = Document._meta.get_field('title').max_length
+    pending: List[Document] = []
+    try:
+        for name, data in iter_source_files(path):
+            if name in titles or len(name) > max_length:
+                progress.skipped += 1
+                continue
+            titles.add(name)
+            document = Document(
+                user=user,
+                title=name,
+                content_hash=hashlib.sha256(data).hexdigest(),
+                status=Document.Status.PROCESSING,
+                attempts=1,
+                locked_at=timezone.now(),
+            )
+            document.file.save(PurePosixPath(name).name, ContentFile(data), save=False)
+            pending.append(document)
+            if len(pending) >= batch_size:
+                created, pending = Document.objects.bulk_create(pending), []
+                yield created
+        if pending:
+            created, pending = Document.objects.bulk_create(pending), []
+            yield created
+    except BaseException:
+        # 行を作る前に中断した場合は、保存済みのファイルを残さない
+        for document in pending:
+            document.file.delete(save=False)
+        raise
+
+
+def _finish_batch(processor, documents: List[Document], parsed: List, progress: ImportProgress):
+    """解析済みのバッチをまとめてエンベディング・保存し、ステータスを更新"""
+    results, remaining = _reuse_duplicates(processor, documents)
+    progress.reused += len(results)
+    remaining_pks = {document.pk for document in remaining}
+    items = []
+    for document, chunks in zip(documents, parsed):
+        if document.pk not in remaining_pks:
+            continue
+        if isinstance(chunks, Exception):
+            results[str(document.id)] = chunks
+        else:
+            items.append((str(document.user_id), str(document.id), chunks))
+    results.update(processor.sync_document_chunks(items))
+
+    done = []
+    for document in documents:
+        result = results[str(document.id)]
+        if isinstance(result, Exception):
+            _mark_failed(document, result)
+            progress.failed += 1
+        else:
+            done.append(document.pk)
+            progress.chunks += result
+    Document.objects.filter(pk__in=done, status=Document.Status.PROCESSING).update(
+        status=Document.Status.DONE, error_message='', locked_at=None
+    )
+    progress.processed += len(documents)
+
+
+def import_documents(
+    user, path: str, batch_size: int = 200, processes: Optional[int] = None
+) -> Iterator[ImportProgress]:
+    """ディレクトリ・アーカイブ内の.mdファイルを一括で登録・ベクトル化し、バッチごとに進捗を返す
+
+    タイトルはアーカイブ内の相対パスで、登録済みのタイトルはスキップする。ファイルの解析は
+    プロセスプールで並列に行い、エンベディングと保存はバッチ単位でまとめて行う。
+    中断しても同じ引数で再実行すれば、未処理のドキュメントから再開する。
+    """
+    progress = ImportProgress()
+    processor = get_document_processor()
+    requeue_stale_documents()
+    batches = _import_batches(user, path, batch_size, progress)
+    # 処理中にしたがまだ完了していないドキュメント
+    in_flight: List[Document] = []
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            # 親プロセスのChromaなどのスレッドを引き継がないようforkは使わない
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_parser_process,
+        ) as pool:
+            def submit(batch: List[Document]):
+                in_flight.extend(batch)
+                return [
+                    pool.submit(_parse_document, (document.file.path, str(user.id), str(document.id)))
+                    for document in batch
+                ]
+
+            current = next(batches, None)
+            futures = submit(current) if current else []
+            while current:
+                # このバッチをエンベディングしている間に、次のバッチを子プロセスで解析しておく
+                upcoming = next(batches, None)
+                upcoming_futures = submit(upcoming) if upcoming else []
+                _finish_batch(processor, current, [future.result() for future in futures], progress)
+                finished = {document.pk for document in current}
+                in_flight[:] = [document for document in in_flight if document.pk not in finished]
+                yield progress
+                current, futures = upcoming, upcoming_futures
+    finally:
+        batches.close()
+        if in_flight:
+            # 中断した場合は処理中のまま残さず、再実行やワーカーで処理できるよう待機中に戻す
+            Document.objects.filter(
+                pk__in=[document.pk for document in in_flight], status=Document.Status.PROCESSING
+            ).update(status=Document.Status.QUEUED, locked_at=None)
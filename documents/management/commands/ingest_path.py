@@ -0,0 +1,66 @@
+import os
+import tarfile
+import time
+import uuid
+import zipfile
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from documents.ingestion import import_documents
+
+
+class Command(BaseCommand):
+    help = 'ディレクトリまたはzip・tarアーカイブ内のマークダウンファイルを一括で登録・ベクトル化します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='登録先のユーザー（メールアドレスまたはID）')
+        parser.add_argument('path', help='マークダウンファイルのディレクトリ、またはzip・tarアーカイブ')
+        parser.add_argument('--batch', type=int, default=200, help='まとめて登録・エンベディングするドキュメント数')
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count(), help='ファイルを解析・チャンク化するプロセス数'
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'パスが見つかりません: {path}')
+        if not (os.path.isdir(path) or zipfile.is_zipfile(path) or tarfile.is_tarfile(path)):
+            raise CommandError(f'ディレクトリ・zip・tarのいずれでもありません: {path}')
+        if options['batch'] < 1 or options['processes'] < 1:
+            raise CommandError('--batchと--processesには1以上を指定してください。')
+        user = self.get_user(options['user'])
+
+        started = time.perf_counter()
+        progress = None
+        try:
+            for progress in import_documents(user, path, options['batch'], options['processes']):
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'{progress.processed}件を処理しました（{progress.chunks}チャンク、再利用{progress.reused}件、'
+                    f'失敗{progress.failed}件、スキップ{progress.skipped}件、{progress.processed / elapsed:.1f}件/秒）'
+                )
+        except KeyboardInterrupt:
+            raise CommandError('中断しました。同じコマンドを再実行すると続きから処理します。')
+
+        if progress is None:
+            self.stdout.write('新しく登録するファイルはありませんでした。')
+            return
+        message = f'{progress.processed - progress.failed}件のドキュメントを登録しました。'
+        if progress.failed:
+            self.stdout.write(self.style.WARNING(
+                message + f'{progress.failed}件は失敗しました。エラー内容はドキュメント一覧で確認できます。'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
+
+    def get_user(self, value: str):
+        User = get_user_model()
+        try:
+            return User.objects.get(**{User.USERNAME_FIELD: value})
+        except User.DoesNotExist:
+            pass
+        try:
+            return User.objects.get(pk=uuid.UUID(value))
+        except (ValueError, User.DoesNotExist):
+            raise CommandError(f'ユーザーが見つかりません: {value}')
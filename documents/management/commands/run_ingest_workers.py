@@ -0,0 +1,108 @@
+import logging
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from documents.ingestion import claim_documents, fail_documents, process_documents, requeue_stale_documents
+from rag.metrics import start_http_server
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'アップロードされたドキュメントをバックグラウンドでベクトル化するワーカーを起動します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=settings.INGEST_WORKERS, help='並列に処理するワーカー数'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=settings.INGEST_POLL_INTERVAL,
+            help='待機中のドキュメントが無い場合のポーリング間隔（秒）'
+        )
+        parser.add_argument(
+            '--batch', type=int, default=settings.INGEST_CLAIM_BATCH,
+            help='1つのワーカーがまとめてエンベディングするドキュメント数'
+        )
+        parser.add_argument(
+            '--once', action='store_true', help='待機中のドキュメントを処理し終えたら終了する'
+        )
+        parser.add_argument(
+            '--metrics-port', type=int, default=settings.INGEST_METRICS_PORT,
+            help='取り込みの段階ごとの所要時間をPrometheus形式で公開するポート（0で公開しない）'
+        )
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+            signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+        requeued = requeue_stale_documents()
+        if requeued:
+            self.stdout.write(f'{requeued}件の中断されたドキュメントを再キューしました。')
+
+        if options['metrics_port']:
+            start_http_server(options['metrics_port'])
+            self.stdout.write(f'メトリクスを http://127.0.0.1:{options["metrics_port"]}/metrics で公開しています。')
+
+        threads = [
+            threading.Thread(
+                target=self.run_worker,
+                args=(stop_event, options['poll_interval'], options['batch'], options['once']),
+                name=f'ingest-worker-{index}',
+                daemon=True,
+            )
+            for index in range(options['workers'])
+        ]
+        for thread in threads:
+            thread.start()
+
+        self.stdout.write(f'{len(threads)}個のワーカーを起動しました。')
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+
+        self.stdout.write(self.style.SUCCESS('ワーカーを停止しました。'))
+
+    def run_worker(self, stop_event, poll_interval, batch, once):
+        """キューからドキュメントを取り出して処理し続ける"""
+        try:
+            while not stop_event.is_set():
+                documents = []
+                try:
+                    close_old_connections()
+                    documents = claim_documents(batch)
+                    if not documents:
+                        if once:
+                            return
+                        requeue_stale_documents()
+                        stop_event.wait(poll_interval)
+                        continue
+
+                    for document, succeeded in zip(documents, process_documents(documents)):
+                        if succeeded:
+                            self.stdout.write(f'処理完了: {document.title}')
+                        else:
+                            self.stderr.write(f'処理失敗: {document.title}')
+                except Exception as e:
+                    # DBの一時的な障害などでワーカーを止めず、少し待ってから続ける
+                    logger.exception('ドキュメントの処理中にエラーが発生しました')
+                    self._release(documents, e)
+                    stop_event.wait(poll_interval)
+        finally:
+            close_old_connections()
+
+    def _release(self, documents, error):
+        """取得したまま処理できなかったドキュメントを、処理中のまま残さないよう戻す"""
+        if not documents:
+            return
+        try:
+            close_old_connections()
+            fail_documents(documents, error)
+        except Exception:
+            # 戻せなかったドキュメントはINGEST_STALE_TIMEOUTの経過後に再キューされる
+            logger.exception('処理できなかったドキュメントを待機中に戻せませんでした')
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:16
+
+from django.db import migrations, models
+
+
+def forwards_status(apps, schema_editor):
+    """既存のis_processedをstatusへ移行"""
+    Document = apps.get_model('documents', 'Document')
+    Document.objects.filter(is_processed=True).update(status='done')
+    Document.objects.filter(is_processed=False).update(status='queued')
+
+
+def backwards_status(apps, schema_editor):
+    """statusをis_processedへ戻す"""
+    Document = apps.get_model('documents', 'Document')
+    Document.objects.filter(status='done').update(is_processed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='処理試行回数'),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='error_message',
+            field=models.TextField(blank=True, verbose_name='エラー内容'),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='locked_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='処理開始日時'),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='status',
+            field=models.CharField(choices=[('queued', '待機中'), ('processing', '処理中'), ('done', '処理済み'), ('failed', '失敗')], db_index=True, default='queued', max_length=20, verbose_name='処理状況'),
+        ),
+        migrations.RunPython(forwards_status, backwards_status),
+        migrations.RemoveField(
+            model_name='document',
+            name='is_processed',
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:18
+
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def forwards_content_hash(apps, schema_editor):
+    """既存のドキュメントのファイルから内容のハッシュを計算"""
+    Document = apps.get_model('documents', 'Document')
+    batch = []
+    for document in Document.objects.filter(content_hash='').iterator(chunk_size=500):
+        try:
+            with document.file.open('rb') as f:
+                hasher = hashlib.sha256()
+                for chunk in f.chunks():
+                    hasher.update(chunk)
+        except (OSError, ValueError):
+            # ファイルが見つからないドキュメントは空のまま（重複の判定に使わない）
+            continue
+        document.content_hash = hasher.hexdigest()
+        batch.append(document)
+        if len(batch) >= 500:
+            Document.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    if batch:
+        Document.objects.bulk_update(batch, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0002_document_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64, verbose_name='内容のハッシュ'),
+        ),
+        migrations.RunPython(forwards_content_hash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['user', 'title'], name='documents_user_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['user', 'content_hash'], name='documents_user_hash_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['user', '-uploaded_at'], name='documents_user_uploaded_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0003_document_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='retry_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='再試行する日時'),
+        ),
+    ]
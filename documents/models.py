@@ -11,22 +11,48 @@ def document_upload_path(instance, filename):
 
 class Document(models.Model):
     """ドキュメントモデル"""
+
+    class Status(models.TextChoices):
+        QUEUED = 'queued', '待機中'
+        PROCESSING = 'processing', '処理中'
+        DONE = 'done', '処理済み'
+        FAILED = 'failed', '失敗'
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='documents')
     title = models.CharField(max_length=255, verbose_name='タイトル')
     file = models.FileField(upload_to=document_upload_path, verbose_name='ファイル')
     uploaded_at = models.DateTimeField(auto_now_add=True, verbose_name='アップロード日時')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
-    is_processed = models.BooleanField(default=False, verbose_name='処理済み')
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.QUEUED, db_index=True, verbose_name='処理状況'
+    )
+    error_message = models.TextField(blank=True, verbose_name='エラー内容')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='処理試行回数')
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name='処理開始日時')
+    # 一時的な失敗の後、この日時まではワーカーが再取得しない
+    retry_at = models.DateTimeField(null=True, blank=True, verbose_name='再試行する日時')
+    # ファイル内容のSHA-256（同じ内容のドキュメントのチャンクとエンベディングを再利用する）
+    content_hash = models.CharField(max_length=64, blank=True, verbose_name='内容のハッシュ')
 
     class Meta:
         verbose_name = 'ドキュメント'
         verbose_name_plural = 'ドキュメント'
         ordering = ['-uploaded_at']
+        indexes = [
+            models.Index(fields=['user', 'title'], name='documents_user_title_idx'),
+            models.Index(fields=['user', 'content_hash'], name='documents_user_hash_idx'),
+            models.Index(fields=['user', '-uploaded_at'], name='documents_user_uploaded_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    @property
+    def is_processed(self):
+        """ベクトル化が完了しているか"""
+        return self.status == self.Status.DONE
+
     def delete(self, *args, **kwargs):
         """ドキュメント削除時にファイルも削除"""
         if self.file:
@@ -1,3 +1,126 @@
-from django.test import TestCase
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .ingestion import _mark_failed, claim_documents, enqueue_documents
+from .management.commands.run_ingest_workers import Command as RunIngestWorkersCommand
+from .models import Document
+
+
+@override_settings(INGEST_MAX_ATTEMPTS=3, INGEST_RETRY_BACKOFF=30.0)
+class IngestionRetryTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="alice", email="alice@example.com", password=None)
+        self.document = Document.objects.create(user=self.user, title="a.md", file="documents/a.md")
+
+    def claim_and_fail(self) -> Document:
+        [claimed] = claim_documents(limit=1)
+        with self.assertLogs("documents.ingestion", "ERROR"):
+            _mark_failed(claimed, RuntimeError("一時的な障害"))
+        return Document.objects.get(pk=self.document.pk)
+
+    def test_failed_document_is_not_reclaimed_until_backoff_passes(self):
+        before = timezone.now()
+        document = self.claim_and_fail()
+
+        self.assertEqual(document.status, Document.Status.QUEUED)
+        self.assertGreaterEqual(document.retry_at, before + timedelta(seconds=30))
+        self.assertEqual(claim_documents(limit=1), [])
+
+        Document.objects.filter(pk=document.pk).update(retry_at=timezone.now() - timedelta(seconds=1))
+        document = self.claim_and_fail()
+        # 試行のたびに待ち時間を2倍にする
+        self.assertGreaterEqual(document.retry_at, timezone.now() + timedelta(seconds=59))
+
+    def test_last_attempt_fails_without_retry_time(self):
+        for _ in range(3):
+            Document.objects.filter(pk=self.document.pk).update(retry_at=None)
+            document = self.claim_and_fail()
+
+        self.assertEqual(document.status, Document.Status.FAILED)
+        self.assertIsNone(document.retry_at)
+
+    def test_enqueue_clears_retry_time(self):
+        self.claim_and_fail()
+        enqueue_documents([self.document])
+
+        self.assertEqual([document.pk for document in claim_documents(limit=1)], [self.document.pk])
+
+
+@override_settings(INGEST_MAX_ATTEMPTS=3, INGEST_RETRY_BACKOFF=0.0)
+class IngestWorkerTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="alice", email="alice@example.com", password=None)
+        for index in range(3):
+            Document.objects.create(user=user, title=f"{index}.md", file=f"documents/{index}.md")
+
+    def test_worker_keeps_draining_the_queue_after_an_unexpected_error(self):
+        def process(documents):
+            if process.calls == 0:
+                process.calls += 1
+                raise RuntimeError("DBの一時的な障害")
+            Document.objects.filter(pk__in=[document.pk for document in documents]).update(
+                status=Document.Status.DONE, locked_at=None
+            )
+            return [True] * len(documents)
+
+        process.calls = 0
+        command = RunIngestWorkersCommand(stdout=StringIO(), stderr=StringIO())
+        with mock.patch(
+            "documents.management.commands.run_ingest_workers.process_documents", side_effect=process
+        ), self.assertLogs("documents", "ERROR"):
+            command.run_worker(threading.Event(), poll_interval=0, batch=1, once=True)
+
+        self.assertEqual(Document.objects.exclude(status=Document.Status.DONE).count(), 0)
+
+
+class DocumentUploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = get_user_model().objects.create_user(username="alice", email="alice@example.com", password=None)
+        self.client.force_login(self.user)
+
+    def upload(self, replace: bool = False):
+        data = {"file": SimpleUploadedFile("a.md", "# 手順\n\n本文です。\n".encode())}
+        if replace:
+            data["mode"] = "replace"
+        return self.client.post(reverse("documents:upload"), data)
+
+    def test_same_content_is_skipped_only_when_processed(self):
+        self.upload()
+        document = Document.objects.get(user=self.user)
+        Document.objects.filter(pk=document.pk).update(status=Document.Status.DONE)
+
+        self.upload(replace=True)
+        document.refresh_from_db()
+        self.assertEqual(document.status, Document.Status.DONE)
+
+    def test_failed_document_is_requeued_by_uploading_the_same_file(self):
+        self.upload()
+        document = Document.objects.get(user=self.user)
+        Document.objects.filter(pk=document.pk).update(
+            status=Document.Status.FAILED, attempts=3, error_message="失敗"
+        )
+
+        self.upload()
+        document.refresh_from_db()
+        self.assertEqual(document.status, Document.Status.FAILED)
+
+        self.upload(replace=True)
+        document.refresh_from_db()
+        self.assertEqual((document.status, document.attempts), (Document.Status.QUEUED, 0))
+        self.assertEqual(Document.objects.filter(user=self.user).count(), 1)
@@ -7,4 +7,5 @@ urlpatterns = [
     path('', views.DocumentListView.as_view(), name='list'),
     path('upload/', views.DocumentUploadView.as_view(), name='upload'),
     path('<uuid:pk>/delete/', views.DocumentDeleteView.as_view(), name='delete'),
+    path('delete/', views.DocumentBulkDeleteView.as_view(), name='bulk_delete'),
 ]
@@ -1,11 +1,18 @@
-from django.views.generic import ListView, CreateView, DeleteView
+import logging
+
+from django.views.generic import ListView, CreateView, DeleteView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import ValidationError
+from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.contrib import messages
 
 from .models import Document
 from .forms import DocumentUploadForm
-from rag.services import DocumentProcessor
+from .hashing import HashingFile, hash_file
+from rag.services import get_document_processor
+
+logger = logging.getLogger(__name__)
 
 
 class DocumentListView(LoginRequiredMixin, ListView):
@@ -35,9 +42,21 @@ class DocumentUploadView(LoginRequiredMixin, CreateView):
             messages.error(request, 'ファイルが選択されていません。')
             return self.get(request, *args, **kwargs)
 
+        # 「更新」モードでは同名のドキュメントを新しい内容で差し替える
+        replace = request.POST.get('mode') == 'replace'
+
         success_count = 0
+        updated_count = 0
         error_count = 0
         skipped_count = 0
+        # 新しく保存したドキュメントの内容のハッシュ
+        created_hashes = {}
+
+        # 同じファイル名の既存ドキュメントは1回のクエリでまとめて取得
+        existing_documents = {
+            document.title: document
+            for document in Document.objects.filter(user=request.user, title__in=[file.name for file in files])
+        }
 
         for file in files:
             # ファイルのバリデーション
@@ -47,49 +66,79 @@ class DocumentUploadView(LoginRequiredMixin, CreateView):
                 continue
 
             # 同じファイル名のドキュメントが既に存在するかチェック
-            if Document.objects.filter(user=request.user, title=file.name).exists():
-                messages.warning(request, f'{file.name}: 同じファイル名のドキュメントが既に存在します。処理をスキップしました。')
+            existing = existing_documents.get(file.name)
+            same_content = (
+                existing is not None and existing.content_hash and existing.content_hash == hash_file(file)
+            )
+            # 処理が完了していないドキュメントは、同じ内容でも更新モードでは再処理する
+            if same_content and existing.status == Document.Status.DONE:
+                messages.info(request, f'{file.name}: 同じ内容のドキュメントが既に存在します。処理をスキップしました。')
                 skipped_count += 1
                 continue
 
-            try:
-                # ドキュメントオブジェクトを作成
-                document = Document.objects.create(
-                    user=request.user,
-                    title=file.name,
-                    file=file
-                )
-
-                # ドキュメントを処理してベクトルストアに保存
-                processor = DocumentProcessor()
-
-                # ドキュメントを読み込み
-                documents = processor.load_document(document.file.path)
+            if existing is not None and replace:
+                try:
+                    self.replace_document(existing, file)
+                    updated_count += 1
+                except Exception as e:
+                    error_count += 1
+                    logger.exception('ドキュメントの更新に失敗しました: %s', file.name)
+                    messages.error(request, f'{file.name}: 更新中にエラーが発生しました - {str(e)}')
+                continue
 
-                # チャンク化
-                chunks = processor.chunk_documents(
-                    documents,
-                    str(request.user.id),
-                    str(document.id)
+            if same_content:
+                messages.warning(
+                    request,
+                    f'{file.name}: 同じ内容のドキュメントがありますが、ベクトル化が完了していないためスキップしました。'
+                    '処理し直す場合は「同じファイル名のドキュメントがある場合は内容を更新する」にチェックを入れてください。'
                 )
+                skipped_count += 1
+                continue
 
-                # ベクトルストアに保存
-                processor.store_documents(chunks, str(request.user.id))
+            if existing is not None:
+                messages.warning(
+                    request,
+                    f'{file.name}: 同じファイル名で内容の異なるドキュメントが既に存在するため、スキップしました。'
+                    '内容を更新する場合は「同じファイル名のドキュメントがある場合は内容を更新する」にチェックを入れてください。'
+                )
+                skipped_count += 1
+                continue
 
-                # 処理完了フラグを設定
-                document.is_processed = True
+            try:
+                # ドキュメントオブジェクトを作成（ベクトル化はワーカーが行う）
+                document = Document(user=request.user, title=file.name, status=Document.Status.QUEUED)
+                # 保存のために読み出しながら内容のハッシュを計算する
+                hashing = HashingFile(file)
+                document.file.save(file.name, hashing, save=False)
+                document.content_hash = hashing.hexdigest()
                 document.save()
+                existing_documents[file.name] = document
+                created_hashes[document.pk] = document.content_hash
 
                 success_count += 1
 
             except Exception as e:
                 error_count += 1
-                print(e)
-                messages.error(request, f'{file.name}: 処理中にエラーが発生しました - {str(e)}')
+                logger.exception('ドキュメントの保存に失敗しました: %s', file.name)
+                messages.error(request, f'{file.name}: 保存中にエラーが発生しました - {str(e)}')
 
         # 結果メッセージ
         if success_count > 0:
-            messages.success(request, f'{success_count}個のドキュメントが正常にアップロードされ、処理が完了しました。')
+            messages.success(request, f'{success_count}個のドキュメントをアップロードしました。ベクトル化が完了するとチャットで利用できます。')
+
+        if created_hashes:
+            # 同じ内容の処理済みドキュメントがあるものは、ワーカーがチャンクとエンベディングを複製する
+            known = set(
+                Document.objects.filter(
+                    user=request.user, content_hash__in=set(created_hashes.values()), status=Document.Status.DONE
+                ).exclude(pk__in=list(created_hashes)).values_list('content_hash', flat=True)
+            )
+            reused_count = sum(1 for content_hash in created_hashes.values() if content_hash in known)
+            if reused_count > 0:
+                messages.info(request, f'{reused_count}個のファイルは既存のドキュメントと同じ内容のため、ベクトル化の結果を再利用します。')
+
+        if updated_count > 0:
+            messages.success(request, f'{updated_count}個のドキュメントを更新しました。変更された部分だけが再ベクトル化されます。')
 
         if skipped_count > 0:
             messages.info(request, f'{skipped_count}個のファイルは既に存在するためスキップされました。')
@@ -99,6 +148,24 @@ class DocumentUploadView(LoginRequiredMixin, CreateView):
 
         return self.get(request, *args, **kwargs)
 
+    def replace_document(self, document, file):
+        """既存ドキュメントのファイルを差し替えてベクトル化待ちに戻す
+
+        ワーカーが保存済みのチャンクと比較し、変更されたチャンクだけをエンベディングする。
+        """
+        old_file = document.file.name
+        hashing = HashingFile(file)
+        document.file.save(file.name, hashing, save=False)
+        document.content_hash = hashing.hexdigest()
+        document.status = Document.Status.QUEUED
+        document.error_message = ''
+        document.attempts = 0
+        document.locked_at = None
+        document.retry_at = None
+        document.save()
+        if old_file and old_file != document.file.name:
+            document.file.storage.delete(old_file)
+
 
 class DocumentDeleteView(LoginRequiredMixin, DeleteView):
     """ドキュメント削除ビュー"""
@@ -116,7 +183,7 @@ class DocumentDeleteView(LoginRequiredMixin, DeleteView):
 
         # ベクトルストアからも削除
         try:
-            processor = DocumentProcessor()
+            processor = get_document_processor()
             processor.delete_document_from_vectorstore(
                 str(self.request.user.id),
                 str(self.object.id)
@@ -126,3 +193,37 @@ class DocumentDeleteView(LoginRequiredMixin, DeleteView):
 
         messages.success(request, 'ドキュメントが削除されました。')
         return super().delete(request, *args, **kwargs)
+
+
+class DocumentBulkDeleteView(LoginRequiredMixin, View):
+    """選択したドキュメントの一括削除ビュー"""
+    success_url = reverse_lazy('documents:list')
+
+    def post(self, request, *args, **kwargs):
+        """選択されたドキュメントをベクトルストアとまとめて削除"""
+        try:
+            documents = list(
+                Document.objects.filter(user=request.user, pk__in=request.POST.getlist('document_ids'))
+            )
+        except ValidationError:
+            documents = []
+
+        if not documents:
+            messages.error(request, 'ドキュメントが選択されていません。')
+            return redirect(self.success_url)
+
+        # ベクトルストアからは1回の呼び出しでまとめて削除
+        try:
+            processor = get_document_processor()
+            processor.delete_documents_from_vectorstore(
+                str(request.user.id),
+                [str(document.id) for document in documents]
+            )
+        except Exception as e:
+            messages.error(request, f'ベクトルストアからの削除中にエラーが発生しました: {str(e)}')
+
+        for document in documents:
+            document.delete()
+
+        messages.success(request, f'{len(documents)}個のドキュメントが削除されました。')
+        return redirect(self.success_url)
@@ -1,3 +1,20 @@
 from django.contrib import admin
+from .models import ChatMessage, ChatSession
 
-# Register your models here.
+
+class ChatMessageInline(admin.TabularInline):
+    model = ChatMessage
+    fields = ('role', 'content', 'retrieval_query', 'summarized', 'created_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(ChatSession)
+class ChatSessionAdmin(admin.ModelAdmin):
+    """チャットの会話の管理画面"""
+    list_display = ('title', 'user', 'created_at', 'updated_at')
+    search_fields = ('title', 'user__email')
+    readonly_fields = ('created_at', 'updated_at')
+    ordering = ('-updated_at',)
+    inlines = (ChatMessageInline,)
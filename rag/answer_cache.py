@@ -0,0 +1,103 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from .query_cache import normalize_query
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    """コサイン類似度"""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class _CachedAnswer:
+    def __init__(self, answer: str, version: int, embedding: Optional[List[float]]):
+        self.answer = answer
+        self.version = version
+        self.embedding = embedding
+        self.created_at = time.monotonic()
+
+
+class AnswerCache:
+    """ユーザーごとの回答キャッシュ
+
+    正規化した質問文の完全一致に加え、similarity_thresholdが0より大きい場合は
+    クエリエンベディングの類似度でも一致を判定する。
+    コーパスバージョンが異なる回答は返さない。
+    """
+
+    def __init__(
+        self, max_users: int, max_entries_per_user: int, ttl: float, similarity_threshold: float = 0.0
+    ):
+        self.max_users = max_users
+        self.max_entries_per_user = max_entries_per_user
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._users: "OrderedDict[str, OrderedDict[str, _CachedAnswer]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def semantic(self) -> bool:
+        """類似度での一致判定が有効か"""
+        return self.similarity_threshold > 0
+
+    def get(
+        self, user_id: str, query: str, version: int, embedding: Optional[List[float]] = None
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """(回答, 一致の種類)を返す。一致の種類は"exact"・"semantic"、見つからなければ(None, None)"""
+        key = normalize_query(query)
+        with self._lock:
+            entries = self._users.get(user_id)
+            if not entries:
+                return None, None
+            self._expire(entries, version)
+
+            entry = entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+                return entry.answer, "exact"
+
+            if not self.semantic or embedding is None:
+                return None, None
+
+            best_key, best_score = None, self.similarity_threshold
+            for other_key, other in entries.items():
+                if other.embedding is None:
+                    continue
+                score = cosine_similarity(embedding, other.embedding)
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+            if best_key is None:
+                return None, None
+            entries.move_to_end(best_key)
+            return entries[best_key].answer, "semantic"
+
+    def set(
+        self, user_id: str, query: str, answer: str, version: int, embedding: Optional[List[float]] = None
+    ):
+        """回答を保存"""
+        key = normalize_query(query)
+        with self._lock:
+            entries = self._users.setdefault(user_id, OrderedDict())
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+            entries[key] = _CachedAnswer(answer, version, embedding)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries_per_user:
+                entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        """ユーザーのキャッシュを破棄"""
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def _expire(self, entries: "OrderedDict[str, _CachedAnswer]", version: int):
+        deadline = time.monotonic() - self.ttl
+        for key in [key for key, entry in entries.items() if entry.version != version or entry.created_at < deadline]:
+            del entries[key]
@@ -0,0 +1,208 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, ContextManager, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document as LangChainDocument
+
+if TYPE_CHECKING:
+    # chromadbのimportは重いため、プールを作るまで読み込まない
+    from .pool import VectorStorePool
+
+
+class UserVectorStore(ABC):
+    """1ユーザー分のベクトルストアに対する操作
+
+    書き込みはcommitで確定する（確定してからコーパスバージョンを進めること）。
+    """
+
+    @abstractmethod
+    def is_empty(self) -> bool:
+        """ユーザーのチャンクが残っていないか"""
+
+    @abstractmethod
+    def get_chunk_ids(self, document_ids: Sequence[str]) -> Dict[str, set]:
+        """ドキュメントごとの保存済みチャンクIDを取得"""
+
+    @abstractmethod
+    def upsert(self, ids: Sequence[str], chunks: Sequence[LangChainDocument], vectors: Sequence[Sequence[float]]):
+        """エンベディング済みのチャンクを書き込む（同じIDは置き換え）"""
+
+    @abstractmethod
+    def update_metadata(self, ids: Sequence[str], chunks: Sequence[LangChainDocument]):
+        """本文が変わらないチャンクのメタデータだけを更新"""
+
+    @abstractmethod
+    def delete(self, ids: Sequence[str]):
+        """チャンクIDを指定して削除"""
+
+    @abstractmethod
+    def delete_documents(self, document_ids: Sequence[str]) -> bool:
+        """ドキュメントのチャンクをまとめて削除し、削除したかを返す"""
+
+    @abstractmethod
+    def search_with_scores(self, embedding: Sequence[float], k: int) -> List[Tuple[LangChainDocument, float]]:
+        """エンベディングに近い上位k件のチャンクを、コサイン類似度の高い順に類似度とともに検索"""
+
+    def search(self, embedding: Sequence[float], k: int) -> List[LangChainDocument]:
+        """エンベディングに近い上位k件のチャンクを検索"""
+        return [chunk for chunk, _ in self.search_with_scores(embedding, k)]
+
+    @abstractmethod
+    def get_document_chunks(self, document_id: str) -> Tuple[List[LangChainDocument], List[List[float]]]:
+        """ドキュメントの保存済みチャンクとそのエンベディングを、ドキュメント内の順で取得"""
+
+    @abstractmethod
+    def iter_chunks(self, batch_size: int) -> Iterator[Tuple[List[str], List[LangChainDocument]]]:
+        """保存済みのチャンクを(ID, チャンク)のバッチで順に返す"""
+
+    def commit(self):
+        """書き込みを確定"""
+
+    def advance_version(self, version: int):
+        """自プロセスの書き込みでコーパスバージョンが進んだことを記録"""
+
+
+class VectorStoreBackend(ABC):
+    """ユーザーごとのベクトルストアを提供するバックエンド"""
+
+    @abstractmethod
+    def open(
+        self, user_id: str, create: bool = False, version: Optional[int] = None
+    ) -> ContextManager[Optional[UserVectorStore]]:
+        """ユーザーのストアを借用（存在せずcreate=Falseの場合はNone）
+
+        versionを指定すると、保持中のストアが別バージョンの内容であれば読み込み直す。
+        """
+
+    @abstractmethod
+    def exists(self, user_id: str) -> bool:
+        """ユーザーのストアが存在するか"""
+
+    @abstractmethod
+    def discard(self, user_id: str):
+        """ユーザーのストアを削除"""
+
+    def clear(self):
+        """保持中のハンドルをすべて解放"""
+
+
+class ChromaUserStore(UserVectorStore):
+    """VectorStorePoolのエントリに対する操作"""
+
+    def __init__(self, pool: "VectorStorePool", entry, user_id: str):
+        self.pool = pool
+        self.entry = entry
+        self.user_id = user_id
+
+    @property
+    def collection(self):
+        return self.entry.collection
+
+    def is_empty(self) -> bool:
+        return self.pool.is_empty(self.entry, self.user_id)
+
+    def get_chunk_ids(self, document_ids: Sequence[str]) -> Dict[str, set]:
+        stored = self.collection.get(
+            where=self.pool.user_filter(self.user_id, {"document_id": {"$in": list(document_ids)}}),
+            include=["metadatas"],
+        )
+        existing: Dict[str, set] = {}
+        for chunk_id, metadata in zip(stored["ids"], stored["metadatas"]):
+            existing.setdefault(metadata["document_id"], set()).add(chunk_id)
+        return existing
+
+    def upsert(self, ids, chunks, vectors):
+        max_batch_size = self.entry.client.get_max_batch_size()
+        for start in range(0, len(ids), max_batch_size):
+            end = start + max_batch_size
+            self.collection.upsert(
+                ids=list(ids[start:end]),
+                embeddings=list(vectors[start:end]),
+                documents=[chunk.page_content for chunk in chunks[start:end]],
+                metadatas=[chunk.metadata for chunk in chunks[start:end]],
+            )
+
+    def update_metadata(self, ids, chunks):
+        if ids:
+            self.collection.update(ids=list(ids), metadatas=[chunk.metadata for chunk in chunks])
+
+    def delete(self, ids):
+        if ids:
+            self.collection.delete(ids=list(ids))
+
+    def delete_documents(self, document_ids) -> bool:
+        # IDを取得せずメタデータの条件で削除し、件数の変化で削除の有無を判定する
+        before = self.collection.count()
+        self.collection.delete(
+            where=self.pool.user_filter(self.user_id, {"document_id": {"$in": list(document_ids)}})
+        )
+        return self.collection.count() != before
+
+    def search_with_scores(self, embedding, k):
+        results = self.entry.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            list(embedding), k=k, filter=self.pool.user_filter(self.user_id)
+        )
+        # Chromaは距離を返すため、正規化済みのエンベディングを前提にコサイン類似度へ変換する
+        # （l2は二乗距離なので 2 - 2cos、cosine・ipは 1 - cos）
+        space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        scale = 2.0 if space == "l2" else 1.0
+        return [(chunk, 1.0 - distance / scale) for chunk, distance in results]
+
+    def get_document_chunks(self, document_id):
+        stored = self.collection.get(
+            where=self.pool.user_filter(self.user_id, {"document_id": document_id}),
+            include=["documents", "metadatas", "embeddings"],
+        )
+        rows = sorted(
+            zip(stored["ids"], stored["documents"], stored["metadatas"], stored["embeddings"]),
+            key=lambda row: (row[2] or {}).get("chunk_index", 0),
+        )
+        chunks = [
+            LangChainDocument(id=chunk_id, page_content=content, metadata=metadata or {})
+            for chunk_id, content, metadata, _ in rows
+        ]
+        return chunks, [list(embedding) for _, _, _, embedding in rows]
+
+    def iter_chunks(self, batch_size):
+        offset = 0
+        while True:
+            rows = self.collection.get(
+                where=self.pool.user_filter(self.user_id),
+                limit=batch_size,
+                offset=offset,
+                include=["documents", "metadatas"],
+            )
+            if not rows["ids"]:
+                return
+            yield rows["ids"], [
+                LangChainDocument(id=chunk_id, page_content=content, metadata=metadata or {})
+                for chunk_id, content, metadata in zip(rows["ids"], rows["documents"], rows["metadatas"])
+            ]
+            offset += len(rows["ids"])
+
+    def advance_version(self, version: int):
+        # 間に他プロセスの書き込みが無ければ、自プロセスのハンドルは最新なので開き直さない
+        known = self.entry.versions.get(self.user_id)
+        if known is not None and version == known + 1:
+            self.entry.versions[self.user_id] = version
+
+
+class ChromaBackend(VectorStoreBackend):
+    """ChromaDBを使うバックエンド（保存形式はVectorStorePoolの設定に従う）"""
+
+    def __init__(self, pool: "VectorStorePool"):
+        self.pool = pool
+
+    @contextmanager
+    def open(self, user_id: str, create: bool = False, version: Optional[int] = None):
+        with self.pool.acquire(user_id, create=create, version=version) as entry:
+            yield None if entry is None else ChromaUserStore(self.pool, entry, user_id)
+
+    def exists(self, user_id: str) -> bool:
+        return self.pool.exists(user_id)
+
+    def discard(self, user_id: str):
+        self.pool.discard(user_id)
+
+    def clear(self):
+        self.pool.clear()
@@ -0,0 +1,138 @@
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.documents import Document as LangChainDocument
+
+# 隣接チャンクの重なりとみなす最短の文字数（句点1文字だけの一致などを重なりと誤認しない）
+_MIN_OVERLAP = 8
+
+
+def estimate_tokens(text: str) -> int:
+    """プロンプトのトークン数の概算
+
+    APIを呼ばずに数えるため、日本語などASCII以外の文字は1文字1トークン、
+    英数字・記号は4文字1トークンとして数える。
+    """
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def truncate_tokens(text: str, max_tokens: int, count_tokens: Callable[[str], int] = estimate_tokens) -> str:
+    """トークン数の上限に収まるよう末尾を切り詰める"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+def merge_overlap(head: str, tail: str, max_overlap: int) -> Optional[str]:
+    """headの末尾とtailの先頭が重なっていれば、重なりを1回にして連結（重ならなければNone）"""
+    for size in range(min(len(head), len(tail), max_overlap), _MIN_OVERLAP - 1, -1):
+        if head.endswith(tail[:size]):
+            return head + tail[size:]
+    return None
+
+
+@dataclass
+class _Passage:
+    """同じドキュメント内で連続するチャンクをまとめた本文"""
+    last_index: int
+    text: str
+    documents: List[LangChainDocument] = field(default_factory=list)
+
+
+@dataclass
+class BuiltContext:
+    """組み立てたコンテキストと、実際に含めたチャンク"""
+    text: str
+    documents: List[LangChainDocument]
+
+
+class ContextBuilder:
+    """検索結果からLLMに渡すコンテキストを組み立てる
+
+    同じドキュメントで隣り合うチャンクは、分割時の重なりを除いて1つの本文にまとめ、
+    ドキュメント内の位置（chunk_index）順に並べる。ドキュメントは最も上位に検索された順に並べる。
+    チャンクは検索順に採用し、max_tokensを超えるものは入れない。
+    """
+
+    def __init__(
+        self,
+        max_tokens: int,
+        max_overlap: int = 200,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+        separator: str = "\n\n",
+    ):
+        self.max_tokens = max_tokens
+        self.max_overlap = max_overlap
+        self.count_tokens = count_tokens
+        self.separator = separator
+
+    def build(self, documents: List[LangChainDocument]) -> BuiltContext:
+        """予算内に収まるチャンクを選んでコンテキストを作る"""
+        selected: List[LangChainDocument] = []
+        passages: List[_Passage] = []
+        for document in documents:
+            candidate = self._assemble(selected + [document])
+            if self._tokens(candidate) <= self.max_tokens:
+                selected.append(document)
+                passages = candidate
+            elif not selected:
+                # 1件目だけで予算を超える場合は、切り詰めてでも入れる
+                selected.append(document)
+                passages = [self._truncate(candidate[0])]
+                break
+
+        text = self.separator.join(passage.text for passage in passages)
+        return BuiltContext(text=text, documents=[doc for passage in passages for doc in passage.documents])
+
+    def _tokens(self, passages: List[_Passage]) -> int:
+        return self.count_tokens(self.separator.join(passage.text for passage in passages))
+
+    def _assemble(self, documents: List[LangChainDocument]) -> List[_Passage]:
+        # ドキュメントごとに、検索順位が最も高いチャンクの順で並べる
+        groups: Dict[str, List[LangChainDocument]] = {}
+        for document in documents:
+            groups.setdefault(self._document_key(document), []).append(document)
+
+        passages = []
+        for group in groups.values():
+            positioned = sorted(
+                (doc for doc in group if self._chunk_index(doc) is not None), key=self._chunk_index
+            )
+            # 位置が分からないチャンク（chunk_index導入前に登録したもの）は検索順のまま後ろに置く
+            unpositioned = [doc for doc in group if self._chunk_index(doc) is None]
+
+            current: Optional[_Passage] = None
+            for doc in positioned:
+                index = self._chunk_index(doc)
+                if current is not None and index == current.last_index:
+                    # 同じチャンクが重複して検索された場合
+                    continue
+                if current is not None and index == current.last_index + 1:
+                    merged = merge_overlap(current.text, doc.page_content, self.max_overlap)
+                    current.text = merged if merged is not None else current.text + "\n" + doc.page_content
+                    current.last_index = index
+                    current.documents.append(doc)
+                    continue
+                current = _Passage(index, doc.page_content, [doc])
+                passages.append(current)
+            passages.extend(_Passage(-1, doc.page_content, [doc]) for doc in unpositioned)
+        return passages
+
+    def _truncate(self, passage: _Passage) -> _Passage:
+        passage.text = truncate_tokens(passage.text, self.max_tokens, self.count_tokens)
+        return passage
+
+    @staticmethod
+    def _document_key(document: LangChainDocument) -> str:
+        return str(document.metadata.get("document_id") or document.id or id(document))
+
+    @staticmethod
+    def _chunk_index(document: LangChainDocument) -> Optional[int]:
+        index = document.metadata.get("chunk_index")
+        return int(index) if index is not None else None
@@ -0,0 +1,153 @@
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+from .context import estimate_tokens, truncate_tokens
+from .models import ChatMessage, ChatSession
+
+if TYPE_CHECKING:
+    from .services import ChatResult, RAGService
+
+_ROLE_LABELS = {ChatMessage.Role.USER: "ユーザー", ChatMessage.Role.ASSISTANT: "AI"}
+
+
+def format_messages(messages: Sequence[Tuple[str, str]]) -> str:
+    """(発言者, 内容)の列を「ユーザー: …」「AI: …」の行にする"""
+    return "\n".join(f"{_ROLE_LABELS.get(role, role)}: {content}" for role, content in messages)
+
+
+@dataclass
+class ChatHistory:
+    """プロンプトに含める会話履歴（要約と、要約していない直近のメッセージ）"""
+    summary: str = ""
+    # (発言者, 内容)を古い順に並べたもの
+    messages: List[Tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.summary and not self.messages
+
+    def render(self, max_tokens: int, summary_max_tokens: int) -> str:
+        """トークン数の上限内で履歴のテキストを作る
+
+        要約はsummary_max_tokensまで、残りの予算に新しいメッセージから順に入れる。
+        """
+        parts = []
+        summary = truncate_tokens(self.summary, min(summary_max_tokens, max_tokens))
+        if summary:
+            parts.append(f"これまでの会話の要約: {summary}")
+        remaining = max_tokens - estimate_tokens("\n".join(parts))
+
+        recent: List[str] = []
+        for role, content in reversed(self.messages):
+            line = format_messages([(role, content)])
+            # 改行の分も数える
+            cost = estimate_tokens(line) + 1
+            if cost > remaining:
+                if not recent and remaining > 1:
+                    # 最新のメッセージだけで予算を超える場合は切り詰めて入れる
+                    recent.append(truncate_tokens(line, remaining - 1))
+                break
+            recent.append(line)
+            remaining -= cost
+        parts.extend(reversed(recent))
+        return "\n".join(parts)
+
+
+def condense_prompt(query: str, history: ChatHistory) -> str:
+    """追加の質問を、履歴を読まなくても意味が通じる検索用の質問に書き換えるプロンプト"""
+    history_text = history.render(settings.RAG_CHAT_HISTORY_MAX_TOKENS, settings.RAG_CHAT_SUMMARY_MAX_TOKENS)
+    return f"""
+以下の会話の履歴を踏まえて、最後の質問を、履歴を読まなくても意味が通じる検索用の質問に書き換えてください。
+「それ」「2つ目」などの指示語は、履歴の中の具体的な名前に置き換えてください。
+書き換えた質問だけを出力してください。
+
+会話の履歴:
+{history_text}
+
+最後の質問: {query}
+
+検索用の質問:"""
+
+
+def summary_prompt(summary: str, messages: Sequence[Tuple[str, str]]) -> str:
+    """これまでの要約に古いメッセージを畳み込むプロンプト"""
+    return f"""
+これまでの会話の要約に新しいやり取りを加えて、要約を更新してください。
+質問の対象（ドキュメント・機能・エラーコードなど）と回答の要点を残し、{settings.RAG_CHAT_SUMMARY_MAX_TOKENS}字以内にまとめてください。
+更新した要約だけを出力してください。
+
+これまでの要約:
+{summary or "（なし）"}
+
+新しいやり取り:
+{format_messages(messages)}
+
+更新した要約:"""
+
+
+async def aget_session(user, session_id: Optional[str]) -> ChatSession:
+    """ユーザーの会話を取得（見つからなければChatSession.DoesNotExist）
+
+    session_idが無ければ新しい会話を返す。保存は最初のやり取りを保存するときに行う。
+    """
+    if not session_id:
+        return ChatSession(user=user)
+    return await ChatSession.objects.aget(pk=session_id, user=user)
+
+
+async def aload_history(session: ChatSession) -> ChatHistory:
+    """要約と、要約していないメッセージを読み込む"""
+    if session._state.adding:
+        return ChatHistory()
+    messages = [
+        (message.role, message.content)
+        async for message in session.messages.filter(summarized=False).only('role', 'content')
+    ]
+    return ChatHistory(session.summary, messages)
+
+
+async def arecord_turn(session: ChatSession, query: str, result: "ChatResult"):
+    """質問と回答を会話に保存（未保存の会話ならここで作る）"""
+    created = session._state.adding
+    if not session.title:
+        session.title = query[:ChatSession._meta.get_field('title').max_length]
+    if created:
+        await session.asave()
+    await ChatMessage.objects.abulk_create([
+        ChatMessage(
+            session=session, role=ChatMessage.Role.USER, content=query,
+            retrieval_query=result.retrieval_query or '',
+        ),
+        ChatMessage(session=session, role=ChatMessage.Role.ASSISTANT, content=result.response),
+    ])
+    if not created:
+        # 会話の一覧を新しい順に並べるため、更新日時も進める
+        await session.asave(update_fields=['title', 'updated_at'])
+
+
+async def afold_history(session: ChatSession, service: "RAGService") -> int:
+    """要約していないメッセージが予算を超えたら、古いものから要約に畳み込む
+
+    プロンプトの履歴はRAG_CHAT_HISTORY_MAX_TOKENSのうち、要約にRAG_CHAT_SUMMARY_MAX_TOKENS、
+    直近のメッセージに残りを使う。最新の質問と回答は畳み込まない。畳み込んだ件数を返す。
+    """
+    budget = settings.RAG_CHAT_HISTORY_MAX_TOKENS - settings.RAG_CHAT_SUMMARY_MAX_TOKENS
+    messages = [message async for message in session.messages.filter(summarized=False)]
+    tokens = [estimate_tokens(format_messages([(message.role, message.content)])) + 1 for message in messages]
+    total = sum(tokens)
+
+    folded = 0
+    while total > budget and folded < len(messages) - 2:
+        total -= tokens[folded]
+        folded += 1
+    if not folded:
+        return 0
+
+    older = messages[:folded]
+    summary = await service.asummarize_history(session.summary, [(m.role, m.content) for m in older])
+    session.summary = truncate_tokens(summary.strip(), settings.RAG_CHAT_SUMMARY_MAX_TOKENS)
+    await session.asave(update_fields=['summary', 'updated_at'])
+    await ChatMessage.objects.filter(pk__in=[message.pk for message in older]).aupdate(summarized=True)
+    return folded
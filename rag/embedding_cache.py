@@ -0,0 +1,147 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+# SQLiteのプレースホルダ数の上限を超えないように分割する件数
+_QUERY_CHUNK_SIZE = 500
+# 上限を超えたら、件数の確認と削除を毎回行わずに済むよう上限のこの割合まで減らす
+_EVICT_LOW_WATER = 0.9
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュキー用にテキストを正規化（NFKC・空白の圧縮）"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """(モデル名, 正規化テキストのハッシュ)をキーにしたSQLite永続のエンベディングキャッシュ
+
+    max_entriesを超えると最終利用日時の古いものから、上限の9割まで削除する（LRU）。
+    件数はプロセス内で追加した分を数えて見積もり、見積もりが上限を超えたときだけ数え直す。
+    ヒット数・ミス数はプロセス内とファイル内の累計の両方で数える。
+    """
+
+    def __init__(self, path: Path, model_name: str, max_entries: int):
+        self.path = Path(path)
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)", [("hits",), ("misses",)]
+            )
+            # 件数の見積もり（置き換えた分も数えるため実際の件数以上になる）
+            self._entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def make_key(self, text: str) -> str:
+        """キャッシュキーを作成"""
+        payload = f"{self.model_name}\n{normalize_text(text)}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """テキストごとのキャッシュ済みベクトル（未キャッシュはNone）を返す"""
+        keys = [self.make_key(text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        now = time.time()
+
+        with self._lock, self._conn:
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), _QUERY_CHUNK_SIZE):
+                chunk = unique_keys[start:start + _QUERY_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})",
+                        [now, *chunk],
+                    )
+
+            hits = sum(1 for key in keys if key in found)
+            misses = len(keys) - hits
+            self.hits += hits
+            self.misses += misses
+            self._conn.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (hits,))
+            self._conn.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'", (misses,))
+
+        return [found.get(key) for key in keys]
+
+    def put_many(self, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """ベクトルを保存し、上限を超えた分を古い順に削除"""
+        now = time.time()
+        rows = [
+            (self.make_key(text), array("f", vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            self._entries += len(rows)
+            if self._entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # 他のプロセスが追加・削除した分もあるため、実際の件数を数え直してから削除する
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            target = int(self.max_entries * _EVICT_LOW_WATER)
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - target,),
+            )
+            count = target
+        self._entries = count
+
+    def stats(self) -> Dict[str, float]:
+        """ヒット率などの統計を返す"""
+        with self._lock:
+            totals = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = totals["hits"] + totals["misses"]
+        process_lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / process_lookups if process_lookups else 0.0,
+            "total_hits": totals["hits"],
+            "total_misses": totals["misses"],
+            "total_hit_rate": totals["hits"] / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        """キャッシュと統計を消去"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.execute("UPDATE stats SET value = 0")
+            self._entries = 0
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,121 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数を概算（日本語は1〜2文字で1トークン程度）"""
+    return len(text) // 2 + 1
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """レート制限(429)によるエラーかどうか（ModelGatewayがレート制限のため断った場合を含む）"""
+    if getattr(error, "rate_limited", False):
+        return True
+    for attr in ("code", "status_code"):
+        if getattr(error, attr, None) == 429:
+            return True
+    name = type(error).__name__
+    return name in ("ResourceExhausted", "TooManyRequests") or "429" in str(error)
+
+
+class TokenBucket:
+    """1分あたりの上限で補充されるトークンバケット"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """トークンを予約し、使えるようになるまでの待ち時間（秒）を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # 容量を超える要求は容量分として扱い、永久に待たないようにする
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def drain(self):
+        """残りのトークンを捨てる（429を受けた場合に使う）"""
+        with self._lock:
+            self.tokens = min(self.tokens, 0.0)
+            self.updated_at = time.monotonic()
+
+
+class RateLimiter:
+    """リクエスト数とトークン数のクォータを守るレートリミッタ"""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens: int):
+        """リクエスト1件分とトークン分の枠が空くまで待つ"""
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+
+    def penalize(self):
+        """429を受けたので以降のリクエストを遅らせる"""
+        self.requests.drain()
+
+
+class EmbeddingScheduler:
+    """チャンクをバッチにまとめ、並列数とレートを制限してエンベディングするスケジューラ"""
+
+    def __init__(
+        self,
+        embeddings,
+        batch_size: int,
+        max_concurrency: int,
+        limiter: Optional[RateLimiter] = None,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+    ):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="embedding"
+        )
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """テキストをバッチに分けて並列にエンベディングし、入力順のベクトルを返す"""
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        futures = [self._executor.submit(self._embed_batch, batch) for batch in batches]
+
+        vectors = []
+        for future in futures:
+            vectors.extend(future.result())
+        return vectors
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(sum(estimate_tokens(text) for text in batch))
+            try:
+                return self.embeddings.embed_documents(batch)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                if self.limiter is not None:
+                    self.limiter.penalize()
+                # 指数バックオフ＋ジッタ
+                delay = self.backoff_base * (2 ** attempt) * (0.5 + random.random())
+                logger.warning("エンベディングがレート制限されました。%.1f秒後に再試行します", delay)
+                time.sleep(delay)
+                attempt += 1
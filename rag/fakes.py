@@ -0,0 +1,334 @@
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeRateLimitError(Exception):
+    """擬似的なレート制限エラー"""
+    code = 429
+
+
+class FakeEmbeddings(Embeddings):
+    """オフライン計測用の決定的なエンベディング
+
+    文字バイグラムをハッシュして次元に割り当てるため、似た文章は似たベクトルになる。
+    latencyで1リクエストあたりの遅延を、rate_limit_everyでN回に1回の429を再現する。
+    """
+
+    def __init__(self, dimension: int = 768, latency: float = 0.0, rate_limit_every: int = 0):
+        self.dimension = dimension
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.request_count = 0
+        self.text_count = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._on_request(len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self._on_request(1)
+        return self._embed(text)
+
+    def _on_request(self, size: int):
+        with self._lock:
+            self.request_count += 1
+            self.text_count += size
+            count = self.request_count
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit_every and count % self.rate_limit_every == 0:
+            raise FakeRateLimitError("429 Resource has been exhausted (fake)")
+
+    def _embed(self, text: str) -> List[float]:
+        counts = {}
+        for i in range(max(len(text) - 1, 1)):
+            index = zlib.crc32(text[i:i + 2].encode("utf-8")) % self.dimension
+            counts[index] = counts.get(index, 0.0) + 1.0
+        norm = math.sqrt(sum(value * value for value in counts.values())) or 1.0
+        vector = [0.0] * self.dimension
+        for index, value in counts.items():
+            vector[index] = value / norm
+        return vector
+
+
+def fake_response(prompt: str, chars: int = 200) -> str:
+    """プロンプトの末尾（質問）を含む擬似的な回答"""
+    return "擬似的な回答です。" + " ".join(prompt.split())[-chars:]
+
+
+class FakeChatModel(BaseChatModel):
+    """オフライン計測用の決定的なチャットモデル
+
+    プロンプトの末尾（質問）を含む定型文を返す。latencyで応答までの遅延を、
+    token_latencyでストリーミング時の1トークンごとの遅延を再現する。
+    """
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    response_chars: int = 200
+    call_count: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _respond(self, messages: List[BaseMessage]) -> str:
+        self.call_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return fake_response(" ".join(str(message.content) for message in messages), self.response_chars)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._respond(messages)))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        text = self._respond(messages)
+        for start in range(0, len(text), 4):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[start:start + 4]))
+
+
+_CORPUS_TOPICS = ["検索", "生成", "設定", "認証", "課金", "通知", "同期", "監視", "バックアップ", "権限"]
+_OFF_TOPIC = ["明日の天気はどうなりますか？", "おすすめの映画を教えてください", "週末に行ける温泉はありますか？"]
+_CORPUS_WORDS = ["手順", "画面", "項目", "上限", "期限", "再試行", "ログ", "履歴", "容量", "接続", "応答", "更新"]
+
+
+def generate_markdown_document(index: int, sections: int, rng: random.Random) -> str:
+    """擬似的なマニュアルのMarkdownを作る（節ごとにエラーコードE{index}-{節番号}を含む）"""
+    topic = _CORPUS_TOPICS[index % len(_CORPUS_TOPICS)]
+    lines = [f"# {topic}マニュアル{index}", "", f"{topic}機能の使い方を説明します。", ""]
+    for section in range(sections):
+        lines += [f"## {topic}の{rng.choice(_CORPUS_WORDS)}{section}", ""]
+        for _ in range(rng.randint(2, 5)):
+            lines.append("".join(
+                f"{rng.choice(_CORPUS_WORDS)}が{rng.choice(_CORPUS_WORDS)}を超えた場合は{rng.choice(_CORPUS_WORDS)}を確認します。"
+                for _ in range(rng.randint(3, 8))
+            ))
+            lines.append("")
+        lines += [f"- エラーコード E{index}-{section:03d}: {topic}の{rng.choice(_CORPUS_WORDS)}に失敗しました", ""]
+    return "\n".join(lines)
+
+
+def generate_queries(documents: int, sections: int, count: int, rng: random.Random) -> List[str]:
+    """generate_markdown_documentのコーパスに対する質問（エラーコード・長く具体的な質問・無関係な質問を含む）"""
+    queries = []
+    for i in range(count):
+        index = rng.randrange(documents)
+        topic = _CORPUS_TOPICS[index % len(_CORPUS_TOPICS)]
+        if i % 4 == 0:
+            queries.append(f"エラーコード E{index}-{rng.randrange(sections):03d} の原因は？")
+        elif i % 8 == 7:
+            # コーパスと関係のない質問
+            queries.append(f"{rng.choice(_OFF_TOPIC)} ({i})")
+        elif i % 4 == 1:
+            words = [rng.choice(_CORPUS_WORDS) for _ in range(4)]
+            queries.append(
+                f"{topic}マニュアルで{words[0]}が{words[1]}を超えた場合と{words[2]}が{words[3]}を超えた場合に、"
+                f"それぞれ何を確認すればよいか教えてください ({i})"
+            )
+        else:
+            queries.append(f"{topic}の{rng.choice(_CORPUS_WORDS)}が{rng.choice(_CORPUS_WORDS)}を超えたらどうすればいいですか？ ({i})")
+    return queries
+
+
+class FakeServerError(Exception):
+    """擬似モデルサーバーがエラーのステータスを返した"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code} {message}")
+        self.status_code = status_code
+
+
+def _post_json(url: str, payload: dict, timeout: float):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    try:
+        return urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        raise FakeServerError(e.code, e.read().decode("utf-8", "replace")) from e
+    except urllib.error.URLError as e:
+        # 接続できない場合は再試行の対象になるようにConnectionErrorにする
+        raise ConnectionError(str(e.reason)) from e
+
+
+class FakeServerChatModel(BaseChatModel):
+    """fake_model_serverコマンドの擬似モデルサーバーを呼ぶチャットモデル"""
+
+    base_url: str
+    timeout: float = 60.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-server-chat"
+
+    def _prompt(self, messages: List[BaseMessage]) -> str:
+        return " ".join(str(message.content) for message in messages)
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        with _post_json(f"{self.base_url}/chat", {"prompt": self._prompt(messages)}, self.timeout) as response:
+            text = json.load(response)["text"]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        payload = {"prompt": self._prompt(messages), "stream": True}
+        with _post_json(f"{self.base_url}/chat", payload, self.timeout) as response:
+            # 1行に1つの断片のJSONが届く
+            for line in response:
+                if line.strip():
+                    yield ChatGenerationChunk(message=AIMessageChunk(content=json.loads(line)["text"]))
+
+
+class FakeServerEmbeddings(Embeddings):
+    """fake_model_serverコマンドの擬似モデルサーバーを呼ぶエンベディング"""
+
+    def __init__(self, base_url: str, timeout: float = 60.0):
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with _post_json(f"{self.base_url}/embed", {"texts": texts}, self.timeout) as response:
+            return json.load(response)["vectors"]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeModelServer(ThreadingHTTPServer):
+    """ゲートウェイの動作を確かめるための擬似モデルサーバー
+
+    POST /chat {"prompt", "stream"} と POST /embed {"texts"} に擬似的な結果を返す。
+    error_rateの確率で429を、outageの間は503を返す。GET /stats でエンドポイントごとの
+    リクエスト数と同時リクエスト数の最大値を、POST /control で障害の状態や遅延を変更できる。
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, address, latency: float = 0.0, token_latency: float = 0.0, error_rate: float = 0.0,
+        outage: bool = False, dimension: int = 768,
+    ):
+        super().__init__(address, _FakeModelHandler)
+        self.latency = latency
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.outage = outage
+        self.embeddings = FakeEmbeddings(dimension=dimension)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"chat": 0, "embed": 0, "texts": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def control(self, values: dict):
+        for name in ("latency", "token_latency", "error_rate", "outage"):
+            if name in values:
+                setattr(self, name, values[name])
+        if values.get("reset"):
+            self.reset_stats()
+
+
+class _FakeModelHandler(BaseHTTPRequestHandler):
+    server: FakeModelServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self._send(404, {"error": "not found"})
+        with self.server.lock:
+            stats = dict(self.server.stats)
+        self._send(200, stats)
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/control":
+            self.server.control(payload)
+            return self._send(200, {"ok": True})
+        if self.path not in ("/chat", "/embed"):
+            return self._send(404, {"error": "not found"})
+
+        server = self.server
+        with server.lock:
+            server.stats[self.path[1:]] += 1
+            server.stats["texts"] += len(payload.get("texts", []))
+            server.stats["in_flight"] += 1
+            server.stats["max_in_flight"] = max(server.stats["max_in_flight"], server.stats["in_flight"])
+        try:
+            if server.outage:
+                return self._error(503, "Service Unavailable (fake)")
+            if random.random() < server.error_rate:
+                return self._error(429, "Resource has been exhausted (fake)")
+            if server.latency:
+                time.sleep(server.latency)
+            if self.path == "/embed":
+                return self._send(200, {"vectors": [server.embeddings._embed(text) for text in payload["texts"]]})
+            text = fake_response(payload["prompt"])
+            if not payload.get("stream"):
+                return self._send(200, {"text": text})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for start in range(0, len(text), 4):
+                if server.token_latency:
+                    time.sleep(server.token_latency)
+                self.wfile.write(json.dumps({"text": text[start:start + 4]}, ensure_ascii=False).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        finally:
+            with server.lock:
+                server.stats["in_flight"] -= 1
+
+    def _error(self, status: int, message: str):
+        with self.server.lock:
+            self.server.stats["errors"] += 1
+        self._send(status, {"error": message})
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,417 @@
+import asyncio
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterator, Optional, TypeVar
+
+from .embedding_scheduler import is_rate_limit_error
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MODEL_REQUESTS = REGISTRY.counter(
+    "rag_model_requests_total",
+    "モデルのAPI呼び出しの結果ごとの件数（success・retry・rate_limited・error・rejected・coalesced）",
+    ("model", "outcome"),
+)
+MODEL_QUEUE_SECONDS = REGISTRY.histogram(
+    "rag_model_queue_seconds", "モデルの同時リクエスト数の枠が空くまで待った秒数", ("model",)
+)
+
+# 障害とみなして再試行するHTTPステータス
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+_RETRYABLE_NAMES = {"ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout"}
+
+
+class ModelUnavailableError(Exception):
+    """モデルのAPIが使えない（障害中・再試行の上限・混雑）ため呼び出さなかった"""
+
+    def __init__(self, message: str, retry_after: float = 1.0, rate_limited: bool = False):
+        super().__init__(message)
+        # 再試行までの目安の秒数
+        self.retry_after = retry_after
+        # レート制限(429)が原因の場合（is_rate_limit_errorがレート制限として扱う）
+        self.rate_limited = rate_limited
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """レート制限・サーバー側の障害・タイムアウト・接続エラーかどうか（入力の誤りは含まない）"""
+    if is_rate_limit_error(error) or isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    for attr in ("code", "status_code"):
+        if getattr(error, attr, None) in _RETRYABLE_STATUS:
+            return True
+    return type(error).__name__ in _RETRYABLE_NAMES
+
+
+class CircuitBreaker:
+    """連続した失敗で回路を開き、reset_timeoutの間は呼び出さずにすぐ失敗させる
+
+    reset_timeoutが過ぎたら1件だけ試しに通し（半開）、成功すれば閉じ、失敗すれば開き直す。
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self):
+        """回路が開いていればModelUnavailableErrorを送出する"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            remaining = self.opened_at + self.reset_timeout - now
+            # 試しの1件が結果を返さないまま止まっても、reset_timeout後には次の1件を通す
+            trial_running = self._trial_at is not None and now - self._trial_at < self.reset_timeout
+            if remaining > 0 or trial_running:
+                raise ModelUnavailableError(
+                    f"{self.name}は障害のため一時的に利用を停止しています", retry_after=max(remaining, 1.0)
+                )
+            self._trial_at = now
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("%sの呼び出しが回復しました", self.name)
+            self.failures = 0
+            self.opened_at = None
+            self._trial_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_at = None
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning("%sの呼び出しが%d回続けて失敗したため、一時的に停止します", self.name, self.failures)
+                self.opened_at = time.monotonic()
+
+
+class ConcurrencyLimit:
+    """スレッドとasyncioの両方から使える同時実行数の上限
+
+    枠が空くと、待っている呼び出しに到着順で枠を引き渡す。
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        with self._lock:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            event = threading.Event()
+            self._waiters.append(event)
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            if event in self._waiters:
+                self._waiters.remove(event)
+                return False
+        # タイムアウトと同時に枠を引き渡された
+        return True
+
+    async def aacquire(self, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    return False
+            return True
+        except asyncio.CancelledError:
+            with self._lock:
+                handed = waiter not in self._waiters
+                if not handed:
+                    self._waiters.remove(waiter)
+            if handed:
+                # 引き渡された枠を使わずに終わるので次の呼び出しに回す
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_resolve, future)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SingleFlight:
+    """同じキーの呼び出しが実行中なら、新しく呼ばずにその結果を待つ"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> T:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def ado(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = concurrent.futures.Future()
+                # 最初の呼び出し元がキャンセルされても、待っている他の呼び出しのために最後まで実行する
+                task = asyncio.ensure_future(factory())
+                task.add_done_callback(partial(self._settle, key, future))
+        # 待っている側がキャンセルされても、共有の結果はキャンセルしない
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _settle(self, key: Hashable, future: concurrent.futures.Future, task: asyncio.Task):
+        with self._lock:
+            self._calls.pop(key, None)
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def is_running(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._calls
+
+
+class ModelGateway:
+    """1つのモデルへのAPI呼び出しをプロセス内でまとめて制御する
+
+    - 同時リクエスト数をmax_concurrencyまでに制限する（枠が空くのをacquire_timeout秒まで待つ）
+    - 429・5xx・タイムアウトはジッタ付き指数バックオフでmax_retries回まで再試行する
+    - 連続して失敗したら回路を開き、しばらくはAPIを呼ばずにModelUnavailableErrorで失敗させる
+      （429はAPIが応答しているので障害として数えない）
+    - キーを指定した呼び出しは、同じキーの呼び出しが実行中ならその結果を共有する
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        acquire_timeout: float = 30.0,
+    ):
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.limit = ConcurrencyLimit(max_concurrency)
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.flights = SingleFlight()
+
+    def call(self, func: Callable[[], T], key: Optional[Hashable] = None, retry_rate_limits: bool = True) -> T:
+        """funcを制御下で呼び出す
+
+        retry_rate_limits=Falseの場合、429は再試行せずにすぐModelUnavailableError(rate_limited=True)にする
+        （EmbeddingSchedulerのように呼び出し側がレートを調整して再試行する場合に使う）。
+        """
+        if key is None:
+            return self._call(func, retry_rate_limits)
+        if self.flights.is_running(key):
+            MODEL_REQUESTS.inc(model=self.name, outcome="coalesced")
+        return self.flights.do(key, partial(self._call, func, retry_rate_limits))
+
+    async def acall(
+        self, factory: Callable[[], Awaitable[T]], key: Optional[Hashable] = None, retry_rate_limits: bool = True
+    ) -> T:
+        """callの非同期版（factoryは呼ぶたびに新しいコルーチンを返すこと）"""
+        if key is None:
+            return await self._acall(factory, retry_rate_limits)
+        if self.flights.is_running(key):
+            MODEL_REQUESTS.inc(model=self.name, outcome="coalesced")
+        return await self.flights.ado(key, partial(self._acall, factory, retry_rate_limits))
+
+    def stream(self, factory: Callable[[], Iterator[T]]) -> Iterator[T]:
+        """ストリーミングの呼び出し（最初の断片を受け取る前の失敗だけを再試行する）"""
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            started = False
+            with self._slot():
+                try:
+                    for chunk in factory():
+                        started = True
+                        yield chunk
+                except Exception as e:
+                    delay = self._on_error(e, attempt, retry=not started)
+                else:
+                    self._on_success()
+                    return
+            time.sleep(delay)
+            attempt += 1
+
+    async def astream(self, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """streamの非同期版"""
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            started = False
+            async with self._aslot():
+                try:
+                    async for chunk in factory():
+                        started = True
+                        yield chunk
+                except Exception as e:
+                    delay = self._on_error(e, attempt, retry=not started)
+                else:
+                    self._on_success()
+                    return
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _call(self, func: Callable[[], T], retry_rate_limits: bool = True) -> T:
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            with self._slot():
+                try:
+                    result = func()
+                except Exception as e:
+                    delay = self._on_error(e, attempt, retry_rate_limits=retry_rate_limits)
+                else:
+                    self._on_success()
+                    return result
+            # バックオフ中は枠を空けておく
+            time.sleep(delay)
+            attempt += 1
+
+    async def _acall(self, factory: Callable[[], Awaitable[T]], retry_rate_limits: bool = True) -> T:
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            async with self._aslot():
+                try:
+                    result = await factory()
+                except Exception as e:
+                    delay = self._on_error(e, attempt, retry_rate_limits=retry_rate_limits)
+                else:
+                    self._on_success()
+                    return result
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _on_success(self):
+        self.breaker.record_success()
+        MODEL_REQUESTS.inc(model=self.name, outcome="success")
+
+    def _on_error(self, error: Exception, attempt: int, retry: bool = True, retry_rate_limits: bool = True) -> float:
+        """失敗を記録し、再試行までの待ち時間を返す（再試行しない場合は例外を送出する）"""
+        if not is_retryable_error(error):
+            # 入力の誤りなどはAPI自体は応答しているので障害として数えない
+            self.breaker.record_success()
+            MODEL_REQUESTS.inc(model=self.name, outcome="error")
+            raise error
+        if is_rate_limit_error(error):
+            return self._on_rate_limit(error, attempt, retry and retry_rate_limits)
+        self.breaker.record_failure()
+        if not retry or attempt >= self.max_retries or self.breaker.is_open:
+            MODEL_REQUESTS.inc(model=self.name, outcome="error")
+            retry_after = self.breaker.reset_timeout if self.breaker.is_open else self._backoff(attempt)
+            raise ModelUnavailableError(
+                f"{self.name}の呼び出しに失敗しました: {type(error).__name__}", retry_after=retry_after
+            ) from error
+        MODEL_REQUESTS.inc(model=self.name, outcome="retry")
+        delay = self._backoff(attempt) * random.random()
+        logger.warning("%sの呼び出しに失敗しました（%s）。%.2f秒後に再試行します", self.name, type(error).__name__, delay)
+        return delay
+
+    def _on_rate_limit(self, error: Exception, attempt: int, retry: bool) -> float:
+        # クォータの超過は障害ではないため回路は開かない（一括登録で枠を使い切ってもチャットは止めない）
+        MODEL_REQUESTS.inc(model=self.name, outcome="rate_limited")
+        if not retry or attempt >= self.max_retries:
+            raise ModelUnavailableError(
+                f"{self.name}のレート制限を超えました", retry_after=self._backoff(attempt), rate_limited=True
+            ) from error
+        delay = self._backoff(attempt) * random.random()
+        logger.warning("%sのレート制限を超えました。%.2f秒後に再試行します", self.name, delay)
+        return delay
+
+    def _backoff(self, attempt: int) -> float:
+        # 待ち時間は0からこの値までの一様乱数にする（フルジッタ）
+        return min(self.backoff_max, self.backoff_base * (2 ** attempt))
+
+    @contextmanager
+    def _slot(self) -> Iterator[None]:
+        started = time.perf_counter()
+        if not self.limit.acquire(self.acquire_timeout):
+            self._reject_busy()
+        MODEL_QUEUE_SECONDS.observe(time.perf_counter() - started, model=self.name)
+        try:
+            yield
+        finally:
+            self.limit.release()
+
+    @asynccontextmanager
+    async def _aslot(self) -> AsyncIterator[None]:
+        started = time.perf_counter()
+        if not await self.limit.aacquire(self.acquire_timeout):
+            self._reject_busy()
+        MODEL_QUEUE_SECONDS.observe(time.perf_counter() - started, model=self.name)
+        try:
+            yield
+        finally:
+            self.limit.release()
+
+    def _reject_busy(self):
+        MODEL_REQUESTS.inc(model=self.name, outcome="rejected")
+        raise ModelUnavailableError(f"{self.name}へのリクエストが混み合っています", retry_after=self.acquire_timeout)
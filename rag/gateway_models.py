@@ -0,0 +1,134 @@
+from typing import Any, AsyncIterator, Hashable, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from .gateway import ModelGateway
+
+# LangChainのチャットモデルの基底クラスはimportに時間がかかるため、rag.gatewayとは分けて
+# get_llm・get_embeddingsの中で読み込む
+
+
+def _as_chunk(result: ChatResult) -> ChatGenerationChunk:
+    # ストリーミングに対応していないモデルの回答を1つの断片として返す
+    return ChatGenerationChunk(message=AIMessageChunk(content=result.generations[0].message.content))
+
+
+def _messages_key(messages: List[BaseMessage], stop: Optional[List[str]], kwargs: dict) -> Hashable:
+    return (
+        tuple((message.type, str(message.content)) for message in messages),
+        tuple(stop or ()),
+        repr(sorted(kwargs.items())),
+    )
+
+
+class GatewayChatModel(BaseChatModel):
+    """チャットモデルの呼び出しをModelGateway経由にするラッパー
+
+    同じメッセージでの呼び出しが実行中なら、その結果を共有する（ストリーミングは共有しない）。
+    """
+
+    model: BaseChatModel
+    gateway: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return self.model._llm_type
+
+    @property
+    def _identifying_params(self) -> dict:
+        return self.model._identifying_params
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self.gateway.call(
+            lambda: self.model._generate(messages, stop=stop, **kwargs), key=_messages_key(messages, stop, kwargs)
+        )
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await self.gateway.acall(
+            lambda: self.model._agenerate(messages, stop=stop, **kwargs), key=_messages_key(messages, stop, kwargs)
+        )
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if type(self.model)._stream is BaseChatModel._stream:
+            yield _as_chunk(self._generate(messages, stop=stop, **kwargs))
+            return
+        for chunk in self.gateway.stream(lambda: self.model._stream(messages, stop=stop, **kwargs)):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if type(self.model)._astream is BaseChatModel._astream and type(self.model)._stream is BaseChatModel._stream:
+            yield _as_chunk(await self._agenerate(messages, stop=stop, **kwargs))
+            return
+        async for chunk in self.gateway.astream(lambda: self.model._astream(messages, stop=stop, **kwargs)):
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+class GatewayEmbeddings(Embeddings):
+    """エンベディングの呼び出しをModelGateway経由にするラッパー
+
+    同じテキストの列でのリクエストが実行中なら、その結果を共有する。
+    retry_rate_limits=Falseの場合、429はゲートウェイで再試行せずに呼び出し元に返す。
+    """
+
+    def __init__(self, embeddings: Embeddings, gateway: ModelGateway, retry_rate_limits: bool = True):
+        self.embeddings = embeddings
+        self.gateway = gateway
+        self.retry_rate_limits = retry_rate_limits
+
+    def without_rate_limit_retries(self) -> "GatewayEmbeddings":
+        """同じゲートウェイを使い、429を再試行しないラッパー（EmbeddingSchedulerに渡す）"""
+        return GatewayEmbeddings(self.embeddings, self.gateway, retry_rate_limits=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.gateway.call(
+            lambda: self.embeddings.embed_documents(texts), key=("documents", tuple(texts)),
+            retry_rate_limits=self.retry_rate_limits,
+        )
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.gateway.call(
+            lambda: self.embeddings.embed_query(text), key=("query", text), retry_rate_limits=self.retry_rate_limits
+        )
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.gateway.acall(
+            lambda: self.embeddings.aembed_documents(texts), key=("documents", tuple(texts)),
+            retry_rate_limits=self.retry_rate_limits,
+        )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.gateway.acall(
+            lambda: self.embeddings.aembed_query(text), key=("query", text), retry_rate_limits=self.retry_rate_limits
+        )
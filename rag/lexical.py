@@ -0,0 +1,224 @@
+import json
+import re
+import sqlite3
+import unicodedata
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence
+
+from langchain_core.documents import Document as LangChainDocument
+
+# 英数字の連続（ハイフンなどでつながった型番・エラーコードを含む）
+_CODE_PATTERN = re.compile(r"[0-9a-z]+(?:[-_.:/][0-9a-z]+)*")
+# 日本語など英数字以外の文字の連続
+_TEXT_PATTERN = re.compile(r"[^\W\x00-\x7f]+")
+_TOKEN_PATTERN = re.compile(f"(?P<code>{_CODE_PATTERN.pattern})|(?P<text>{_TEXT_PATTERN.pattern})")
+# 型番・エラーコード・定数名のように文字と数字や記号が混ざった語
+_IDENTIFIER_PATTERN = re.compile(
+    r"[0-9A-Za-z]*(?:[A-Za-z][-_.:]?[0-9]|[0-9][-_.:]?[A-Za-z])[-_.:0-9A-Za-z]*"
+    r"|[A-Za-z0-9]+(?:_[A-Za-z0-9]+)+"
+)
+# 1クエリで検索に使うトークン数の上限
+_MAX_QUERY_TOKENS = 64
+# SQLiteのプレースホルダ数の上限を超えないように分割する件数
+_QUERY_CHUNK_SIZE = 500
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def tokenize(text: str) -> List[str]:
+    """語彙検索用にトークン化
+
+    分かち書きされない日本語は文字バイグラム（1文字の場合はその文字）に、
+    英数字は語単位に分ける。記号でつながった型番は部品と記号を除いた全体の両方を返す。
+    """
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer(_normalize(text)):
+        if match.group("code"):
+            code = match.group("code")
+            parts = re.split(r"[-_.:/]", code)
+            tokens.extend(parts)
+            if len(parts) > 1:
+                tokens.append("".join(parts))
+        else:
+            run = match.group("text")
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def extract_identifiers(query: str) -> List[str]:
+    """クエリに含まれる型番・エラーコードなどの識別子を取り出す"""
+    text = unicodedata.normalize("NFKC", query)
+    return [match.group(0) for match in _IDENTIFIER_PATTERN.finditer(text)]
+
+
+def contains_identifier(document: LangChainDocument, identifiers: Sequence[str]) -> bool:
+    """ドキュメントが識別子をそのまま含むか"""
+    content = _normalize(document.page_content)
+    return any(_normalize(identifier) in content for identifier in identifiers)
+
+
+def reciprocal_rank_fusion(
+    result_lists: Iterable[List[LangChainDocument]], k: int = 60
+) -> List[LangChainDocument]:
+    """複数の検索結果を順位の逆数の和（RRF）で統合"""
+    scores: Dict[str, float] = defaultdict(float)
+    documents: Dict[str, LangChainDocument] = {}
+    for results in result_lists:
+        for rank, document in enumerate(results):
+            key = document.id or document.page_content
+            scores[key] += 1.0 / (k + rank + 1)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class LexicalIndex:
+    """ユーザーごとの語彙検索用転置インデックス（SQLite FTS5・BM25）
+
+    本文はtokenizeで分割したトークンを空白区切りで登録し、FTS5には空白での分割だけを任せる。
+    検索結果をChromaに問い合わせずに返せるよう、チャンクの本文とメタデータも保持する。
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def exists(self) -> bool:
+        """インデックスのファイルが存在するか"""
+        return self.path.exists()
+
+    def upsert(self, ids: Sequence[str], chunks: Sequence[LangChainDocument]):
+        """チャンクを登録（同じIDは置き換え）"""
+        if not ids:
+            return
+        with self._connect() as conn:
+            self._delete_rows(conn, "chunk_id", ids)
+            for chunk_id, chunk in zip(ids, chunks):
+                cursor = conn.execute(
+                    "INSERT INTO chunks (chunk_id, document_id, content, metadata) VALUES (?, ?, ?, ?)",
+                    (
+                        chunk_id,
+                        str(chunk.metadata.get("document_id", "")),
+                        chunk.page_content,
+                        json.dumps(chunk.metadata, ensure_ascii=False),
+                    ),
+                )
+                conn.execute(
+                    "INSERT INTO chunks_fts (rowid, body) VALUES (?, ?)",
+                    (cursor.lastrowid, " ".join(tokenize(chunk.page_content))),
+                )
+
+    def update_metadata(self, ids: Sequence[str], chunks: Sequence[LangChainDocument]):
+        """本文が変わらないチャンクのメタデータだけを更新"""
+        if not ids or not self.exists():
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE chunks SET metadata = ? WHERE chunk_id = ?",
+                [(json.dumps(chunk.metadata, ensure_ascii=False), chunk_id) for chunk_id, chunk in zip(ids, chunks)],
+            )
+
+    def delete(self, ids: Sequence[str]):
+        """チャンクIDを指定して削除"""
+        if ids and self.exists():
+            with self._connect() as conn:
+                self._delete_rows(conn, "chunk_id", ids)
+
+    def delete_documents(self, document_ids: Sequence[str]):
+        """ドキュメントのチャンクをまとめて削除"""
+        if document_ids and self.exists():
+            with self._connect() as conn:
+                self._delete_rows(conn, "document_id", document_ids)
+
+    def count(self) -> int:
+        """登録済みのチャンク数"""
+        if not self.exists():
+            return 0
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def search(self, query: str, k: int) -> List[LangChainDocument]:
+        """BM25で上位k件のチャンクを検索"""
+        tokens = list(dict.fromkeys(tokenize(query)))[:_MAX_QUERY_TOKENS]
+        if not tokens or not self.exists():
+            return []
+        # トークンはダブルクォートを含まないため、そのままフレーズとして並べられる
+        match = " OR ".join(f'"{token}"' for token in tokens)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT c.chunk_id, c.content, c.metadata FROM chunks_fts "
+                "JOIN chunks c ON c.rowid = chunks_fts.rowid "
+                "WHERE chunks_fts MATCH ? ORDER BY bm25(chunks_fts) LIMIT ?",
+                (match, k),
+            ).fetchall()
+        return [
+            LangChainDocument(id=chunk_id, page_content=content, metadata=json.loads(metadata))
+            for chunk_id, content, metadata in rows
+        ]
+
+    def drop(self):
+        """インデックスのファイルを削除"""
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{self.path}{suffix}").unlink(missing_ok=True)
+
+    def _connect(self) -> "_ClosingConnection":
+        # 接続はスレッド間で共有せず、操作ごとに開く（ファイルを開くだけなので軽い）
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "rowid INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE, document_id TEXT NOT NULL, "
+            "content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS chunks_document_id ON chunks (document_id)")
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts "
+            "USING fts5(body, tokenize='unicode61 remove_diacritics 0')"
+        )
+        return _ClosingConnection(conn)
+
+    def _delete_rows(self, conn: sqlite3.Connection, column: str, values: Sequence[str]):
+        values = list(values)
+        for start in range(0, len(values), _QUERY_CHUNK_SIZE):
+            chunk = values[start:start + _QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            rowids = conn.execute(
+                f"SELECT rowid FROM chunks WHERE {column} IN ({placeholders})", chunk
+            ).fetchall()
+            conn.executemany("DELETE FROM chunks_fts WHERE rowid = ?", rowids)
+            conn.executemany("DELETE FROM chunks WHERE rowid = ?", rowids)
+
+
+class _ClosingConnection:
+    """withを抜けるときにコミットして接続を閉じる"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
+
+
+class LexicalIndexStore:
+    """ユーザーごとの語彙検索インデックスを管理"""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+
+    def for_user(self, user_id: str) -> LexicalIndex:
+        """ユーザーのインデックスを取得"""
+        return LexicalIndex(self.directory / f"user_{user_id}.sqlite3")
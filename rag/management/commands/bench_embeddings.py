@@ -0,0 +1,62 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rag.embedding_scheduler import EmbeddingScheduler, RateLimiter
+from rag.fakes import FakeEmbeddings
+
+
+class Command(BaseCommand):
+    help = '擬似エンベディングを使い、ファイル単位の逐次処理とスケジューラのスループットを比較します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=20, help='ファイル数')
+        parser.add_argument('--chunks-per-file', type=int, default=30, help='1ファイルあたりのチャンク数')
+        parser.add_argument('--latency', type=float, default=0.2, help='1リクエストあたりの擬似遅延（秒）')
+        parser.add_argument('--batch-size', type=int, default=settings.EMBEDDING_BATCH_SIZE)
+        parser.add_argument('--concurrency', type=int, default=settings.EMBEDDING_MAX_CONCURRENCY)
+        parser.add_argument('--rpm', type=int, default=settings.EMBEDDING_REQUESTS_PER_MINUTE)
+        parser.add_argument('--tpm', type=int, default=settings.EMBEDDING_TOKENS_PER_MINUTE)
+        parser.add_argument('--rate-limit-every', type=int, default=0, help='N回に1回429を返す（0で無効）')
+
+    def handle(self, *args, **options):
+        files = [
+            [f'ファイル{f}のチャンク{c}。検索拡張生成のベンチマーク用テキストです。' * 10
+             for c in range(options['chunks_per_file'])]
+            for f in range(options['files'])
+        ]
+        total = sum(len(chunks) for chunks in files)
+
+        # 従来方式: ファイルごとに1回ずつ、順番にエンベディング
+        embeddings = FakeEmbeddings(latency=options['latency'])
+        started = time.perf_counter()
+        for chunks in files:
+            embeddings.embed_documents(chunks)
+        sequential = time.perf_counter() - started
+        sequential_requests = embeddings.request_count
+
+        # スケジューラ: ファイルをまたいでバッチ化し、並列に送信
+        embeddings = FakeEmbeddings(
+            latency=options['latency'], rate_limit_every=options['rate_limit_every']
+        )
+        scheduler = EmbeddingScheduler(
+            embeddings,
+            batch_size=options['batch_size'],
+            max_concurrency=options['concurrency'],
+            limiter=RateLimiter(options['rpm'], options['tpm']),
+            backoff_base=options['latency'],
+        )
+        started = time.perf_counter()
+        scheduler.embed_documents([chunk for chunks in files for chunk in chunks])
+        scheduled = time.perf_counter() - started
+
+        self.stdout.write(f'チャンク数: {total}')
+        self.stdout.write(
+            f'ファイル単位の逐次処理: {sequential:.2f}秒 ({total / sequential:.1f} chunks/s, '
+            f'{sequential_requests}リクエスト)'
+        )
+        self.stdout.write(
+            f'スケジューラ: {scheduled:.2f}秒 ({total / scheduled:.1f} chunks/s, '
+            f'{embeddings.request_count}リクエスト)'
+        )
@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from langchain_core.documents import Document as LangChainDocument
+
+from rag.fakes import FakeEmbeddings
+from rag.services import DocumentProcessor
+
+# splitterはunstructuredを使わずにファイル全体を読み、現在のクリーニングと分割だけを行う
+_LOADERS = ('streaming', 'unstructured', 'splitter')
+
+
+def _current_rss_kb() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def _measure(loader: str, path: str, conn):
+    """子プロセスで読み込みとチャンク化を行い、(チャンク数, 秒, 最大メモリ増加量KB)を返す"""
+    from django.conf import settings
+
+    try:
+        processor = DocumentProcessor(embeddings=FakeEmbeddings())
+        baseline = _current_rss_kb()
+        started = time.perf_counter()
+        if loader == 'splitter':
+            with open(path, encoding='utf-8') as f:
+                document = LangChainDocument(page_content=f.read(), metadata={'source': path})
+            chunks = processor.chunk_documents([document], 'bench', 'bench')
+        else:
+            settings.RAG_MARKDOWN_LOADER = loader
+            chunks = processor.load_chunks(path, 'bench', 'bench')
+        elapsed = time.perf_counter() - started
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+        conn.send((len(chunks), elapsed, peak))
+    except Exception as e:
+        conn.send(e)
+    finally:
+        conn.close()
+
+
+class Command(BaseCommand):
+    help = '大きなMarkdownファイルで、Markdownの読み込み方法ごとのスループットと最大メモリを比較します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='計測するMarkdownファイル（省略時は合成したファイル）')
+        parser.add_argument('--size-mb', type=float, default=20, help='合成するファイルの大きさ（MB）')
+        parser.add_argument('--loader', action='append', choices=_LOADERS, help='計測する読み込み方法（複数指定可）')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = options['path'] or self._generate(directory, options['size_mb'], options['seed'])
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            self.stdout.write(f'ファイル: {path}（{size_mb:.1f} MB）')
+
+            # 読み込み方法ごとに別プロセスで計測し、importや前の計測のメモリの影響を除く
+            context = multiprocessing.get_context('fork')
+            for loader in options['loader'] or _LOADERS:
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=_measure, args=(loader, path, sender))
+                process.start()
+                sender.close()
+                result = receiver.recv() if receiver.poll(None) else None
+                process.join()
+
+                if not isinstance(result, tuple):
+                    self.stdout.write(self.style.WARNING(f'{loader:>12}: 計測できませんでした（{result!r}）'))
+                    continue
+                chunks, elapsed, peak = result
+                self.stdout.write(
+                    f'{loader:>12}: {elapsed:.2f}秒（{size_mb / elapsed:.1f} MB/s）、{chunks}チャンク、'
+                    f'最大メモリ増加 {peak / 1024:.1f} MB（ファイルの{peak / 1024 / size_mb:.1f}倍）'
+                )
+
+    def _generate(self, directory: str, size_mb: float, seed: int) -> str:
+        rng = random.Random(seed)
+        words = ['検索', '生成', '設定', '処理', '保存', '性能', '精度', '手順', '確認', '更新', 'API', 'v2.1']
+        path = os.path.join(directory, 'bench.md')
+        target = int(size_mb * 1024 * 1024)
+        written = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            section = 0
+            while written < target:
+                section += 1
+                lines = [f'# 第{section}章', '', f'## 概要{section}', '']
+                for _ in range(rng.randint(3, 8)):
+                    lines.append(''.join(f'{rng.choice(words)}の{rng.choice(words)}について説明します。' for _ in range(8)))
+                    lines.append('')
+                lines += [f'### 手順{section}', '']
+                lines += [f'- {rng.choice(words)}を{rng.choice(words)}する' for _ in range(5)]
+                lines += ['', '```', f'run --section {section}', '```', '']
+                text = '\n'.join(lines) + '\n'
+                f.write(text)
+                written += len(text.encode('utf-8'))
+        return path
@@ -0,0 +1,116 @@
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from langchain_core.documents import Document as LangChainDocument
+
+from rag.fakes import FakeEmbeddings
+from rag.numpy_backend import NumpyBackend
+from rag.quantization import QUANTIZATION_NONE, QUANTIZATIONS, VectorCompression
+from rag.services import DocumentProcessor, get_embeddings
+
+_USER_ID = 'bench'
+
+
+class Command(BaseCommand):
+    help = 'サンプルコーパスで、ベクトルの切り詰め・量子化による1段目のメモリ削減量とrecall@kの変化を計測します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='コーパスにするMarkdownファイルのディレクトリ（省略時は合成テキスト）')
+        parser.add_argument('--chunks', type=int, default=2000, help='合成テキストのチャンク数')
+        parser.add_argument('--queries', type=int, default=200, help='クエリ数')
+        parser.add_argument('--k', type=int, default=5)
+        parser.add_argument('--rerank-candidates', type=int, default=settings.RAG_RERANK_CANDIDATES)
+        parser.add_argument(
+            '--configs',
+            default='none,int8,binary,256,256:int8,128:binary',
+            help='カンマ区切りの設定（「次元数」「量子化」「次元数:量子化」）',
+        )
+        parser.add_argument('--gemini', action='store_true', help='擬似エンベディングの代わりにGeminiを使う')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        embeddings = get_embeddings() if options['gemini'] else FakeEmbeddings()
+        chunks = self._load_corpus(options, rng)
+        if not chunks:
+            raise CommandError('コーパスが空です。')
+
+        ids = [f'chunk_{i}' for i in range(len(chunks))]
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in chunks])
+        queries = [self._sample_query(chunk.page_content, rng) for chunk in rng.choices(chunks, k=options['queries'])]
+        query_vectors = [embeddings.embed_query(query) for query in queries]
+
+        k = options['k']
+        dimension = len(vectors[0])
+        full_bytes = len(vectors) * dimension * 4
+        self.stdout.write(f'チャンク数: {len(chunks)}、次元数: {dimension}、クエリ数: {len(queries)}')
+
+        with tempfile.TemporaryDirectory() as directory:
+            exact = None
+            for name in ['exact'] + options['configs'].split(','):
+                compression = self._parse_config(name, options['rerank_candidates'])
+                backend = NumpyBackend(Path(directory) / name.replace(':', '_'), max_size=1, compression=compression)
+                with backend.open(_USER_ID, create=True) as store:
+                    store.upsert(ids, chunks, vectors)
+                    store.commit()
+
+                with backend.open(_USER_ID) as store:
+                    started = time.perf_counter()
+                    results = [[chunk.id for chunk in store.search(vector, k)] for vector in query_vectors]
+                    elapsed = (time.perf_counter() - started) / len(query_vectors) * 1000
+                    first_pass = compression.nbytes(len(chunks), dimension) if compression.enabled else full_bytes
+
+                if exact is None:
+                    exact = results
+                recall = np.mean([len(set(got) & set(want)) / len(want) for got, want in zip(results, exact)])
+                self.stdout.write(
+                    f'{name:>12}: 1段目 {first_pass / 1024:9.1f} KiB（{1 - first_pass / full_bytes:6.1%}削減）'
+                    f'  recall@{k} {recall:.3f}  検索 {elapsed:.3f} ms'
+                )
+
+    def _parse_config(self, name: str, rerank_candidates: int) -> VectorCompression:
+        if name == 'exact':
+            return VectorCompression()
+        dimensions, quantization = 0, QUANTIZATION_NONE
+        for part in name.split(':'):
+            if part.isdigit():
+                dimensions = int(part)
+            elif part in QUANTIZATIONS:
+                quantization = part
+            else:
+                raise CommandError(f'不明な設定です: {name}')
+        return VectorCompression(dimensions, quantization, rerank_candidates)
+
+    def _load_corpus(self, options, rng: random.Random):
+        if options['path']:
+            processor = DocumentProcessor(embeddings=FakeEmbeddings())
+            chunks = []
+            for i, path in enumerate(sorted(Path(options['path']).rglob('*.md'))):
+                document = LangChainDocument(page_content=path.read_text(encoding='utf-8'), metadata={'source': str(path)})
+                chunks.extend(processor.chunk_documents([document], _USER_ID, str(i)))
+            return chunks
+
+        topics = ['検索', '生成', 'ベクトル', '量子化', '索引', '文書', '回答', '要約', '質問', '分割']
+        words = ['設定', '処理', '保存', '読み込み', '性能', '精度', '速度', '容量', '構成', '手順', '確認', '更新']
+        chunks = []
+        for i in range(options['chunks']):
+            topic = rng.choice(topics)
+            sentences = [
+                f'{topic}の{rng.choice(words)}について、{rng.choice(words)}と{rng.choice(words)}を説明します。'
+                for _ in range(rng.randint(3, 8))
+            ]
+            chunks.append(
+                LangChainDocument(page_content=f'項目{i}。' + ''.join(sentences), metadata={'document_id': str(i)})
+            )
+        return chunks
+
+    def _sample_query(self, text: str, rng: random.Random) -> str:
+        # チャンク本文の一部を質問に見立てる
+        length = min(len(text), 40)
+        start = rng.randint(0, len(text) - length)
+        return text[start:start + length]
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.services import get_embedding_cache
+
+
+class Command(BaseCommand):
+    help = 'エンベディングキャッシュの件数とヒット率を表示します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true', help='キャッシュと統計を消去する')
+
+    def handle(self, *args, **options):
+        cache = get_embedding_cache()
+        if cache is None:
+            raise CommandError('エンベディングキャッシュは無効です（EMBEDDING_CACHE_PATH）。')
+
+        if options['clear']:
+            cache.clear()
+            self.stdout.write(self.style.SUCCESS('エンベディングキャッシュを消去しました。'))
+            return
+
+        stats = cache.stats()
+        self.stdout.write(f"保存件数: {stats['entries']}")
+        self.stdout.write(f"ヒット数（節約したエンベディング数）: {stats['total_hits']}")
+        self.stdout.write(f"ミス数: {stats['total_misses']}")
+        self.stdout.write(f"ヒット率: {stats['total_hit_rate']:.1%}")
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from rag.fakes import FakeModelServer
+
+
+class Command(BaseCommand):
+    help = 'モデルゲートウェイの動作確認用に、Geminiの代わりに応答する擬似モデルサーバーを起動します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス')
+        parser.add_argument('--port', type=int, default=8765, help='待ち受けるポート')
+        parser.add_argument('--latency', type=float, default=0.2, help='1リクエストあたりの遅延（秒）')
+        parser.add_argument('--token-latency', type=float, default=0.02, help='ストリーミング時の1断片ごとの遅延（秒）')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='429を返す確率')
+        parser.add_argument('--outage', action='store_true', help='すべてのリクエストに503を返す')
+        parser.add_argument('--dimension', type=int, default=768, help='エンベディングの次元数')
+
+    def handle(self, *args, **options):
+        server = FakeModelServer(
+            (options['host'], options['port']),
+            latency=options['latency'],
+            token_latency=options['token_latency'],
+            error_rate=options['error_rate'],
+            outage=options['outage'],
+            dimension=options['dimension'],
+        )
+        url = f'http://{options["host"]}:{options["port"]}'
+        self.stdout.write(f'擬似モデルサーバーを起動しました: {url}')
+        self.stdout.write(f'FAKE_MODEL_SERVER_URL={url} を設定すると、RAGがGeminiの代わりにこのサーバーを呼びます。')
+        self.stdout.write(
+            f'リクエスト数: curl {url}/stats　障害の再現: '
+            f'curl -d \'{{"outage": true}}\' {url}/control'
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
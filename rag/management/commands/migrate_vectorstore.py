@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.models import CorpusVersion
+from rag.pool import STORAGE_PER_USER, STORAGE_SHARED, VectorStorePool
+
+
+class Command(BaseCommand):
+    help = 'ユーザーごとのベクトルストアを共有コレクション（RAG_VECTORSTORE_MODE=shared）へ移行します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000, help='1回に読み書きするチャンク数')
+        parser.add_argument(
+            '--delete-source', action='store_true', help='移行後にユーザーごとのディレクトリを削除する'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='移行せずに件数だけを表示する')
+
+    def handle(self, *args, **options):
+        if settings.RAG_VECTORSTORE_MODE != STORAGE_SHARED:
+            raise CommandError('RAG_VECTORSTORE_MODE=shared を設定してから実行してください。')
+
+        # 保存済みのベクトルをそのまま書き込むため、エンベディングモデルは使わない
+        source_pool = VectorStorePool(None, max_size=1, mode=STORAGE_PER_USER)
+        target_pool = VectorStorePool(
+            None,
+            max_size=settings.RAG_VECTORSTORE_SHARDS,
+            mode=STORAGE_SHARED,
+            shards=settings.RAG_VECTORSTORE_SHARDS,
+        )
+
+        directories = sorted(
+            path for path in settings.CHROMA_PERSIST_DIRECTORY.glob('user_*') if path.is_dir()
+        )
+        total = 0
+        for directory in directories:
+            user_id = directory.name[len('user_'):]
+            with source_pool.acquire(user_id) as source:
+                count = source.collection.count()
+                if not options['dry_run']:
+                    self.copy_chunks(source, target_pool, user_id, options['batch'])
+            total += count
+
+            if options['dry_run']:
+                self.stdout.write(f'user {user_id}: {count}件')
+                continue
+
+            CorpusVersion.bump(user_id)
+            if options['delete_source']:
+                source_pool.discard(user_id)
+            else:
+                source_pool.invalidate(user_id)
+            self.stdout.write(f'user {user_id}: {count}件を移行しました。')
+
+        target_pool.clear()
+        self.stdout.write(self.style.SUCCESS(f'{len(directories)}ユーザー・{total}件のチャンクを処理しました。'))
+
+    def copy_chunks(self, source, target_pool: VectorStorePool, user_id: str, batch: int):
+        """ユーザーのチャンクをエンベディングごと共有コレクションへコピー"""
+        with target_pool.acquire(user_id, create=True) as target:
+            max_batch_size = min(batch, target.client.get_max_batch_size())
+            offset = 0
+            while True:
+                rows = source.collection.get(
+                    limit=max_batch_size,
+                    offset=offset,
+                    include=['embeddings', 'documents', 'metadatas'],
+                )
+                if not rows['ids']:
+                    break
+                # 共有コレクションでの絞り込みに必須のユーザーIDを必ず持たせる
+                metadatas = [{**(metadata or {}), 'user_id': user_id} for metadata in rows['metadatas']]
+                target.collection.upsert(
+                    ids=rows['ids'],
+                    embeddings=rows['embeddings'],
+                    documents=rows['documents'],
+                    metadatas=metadatas,
+                )
+                offset += len(rows['ids'])
+
+            copied = len(target.collection.get(where=target_pool.user_filter(user_id), include=[])['ids'])
+            if copied < offset:
+                raise CommandError(f'user {user_id}: 移行後の件数が一致しません（{copied}/{offset}）。')
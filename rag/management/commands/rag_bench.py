@@ -0,0 +1,267 @@
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings
+from langsmith import tracing_context
+
+from rag.fakes import FakeChatModel, FakeEmbeddings, generate_markdown_document, generate_queries
+from rag.lexical import LexicalIndexStore
+from rag.metrics import STAGE_SECONDS
+from rag.router import QueryRouter
+from rag.services import DocumentProcessor, RAGService, build_vectorstore_backend
+
+
+def _int_list(value: str) -> List[int]:
+    try:
+        return [int(part) for part in value.split(',') if part]
+    except ValueError:
+        raise CommandError(f'カンマ区切りの整数で指定してください: {value}')
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    # 最近傍順位法（件数が少なくても実際に観測した値を返す）
+    ordered = sorted(values)
+    rank = max(int(len(ordered) * percent / 100 + 0.5), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _peak_rss_mb() -> float:
+    # Linuxではru_maxrssはKB単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class Command(BaseCommand):
+    help = '擬似エンベディング・擬似LLMと合成コーパスで、取り込み・検索・回答生成の性能をオフラインで計測します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,50,200', help='コーパスのドキュメント数（カンマ区切り、小さい順に計測）')
+        parser.add_argument('--sections', type=int, default=8, help='1ドキュメントあたりの節の数')
+        parser.add_argument('--concurrency', default='1,4,16', help='検索・回答生成の同時実行数（カンマ区切り）')
+        parser.add_argument('--queries', type=int, default=100, help='同時実行数ごとのクエリ数')
+        parser.add_argument('--embedding-latency', type=float, default=0.0, help='擬似エンベディングの1回あたりの遅延（秒）')
+        parser.add_argument('--llm-latency', type=float, default=0.0, help='擬似LLMの1回あたりの遅延（秒）')
+        parser.add_argument(
+            '--backend', choices=['chroma', 'numpy'], default=settings.RAG_VECTORSTORE_BACKEND,
+            help='ベクトルストアのバックエンド',
+        )
+        parser.add_argument(
+            '--router-min-score', type=float, default=settings.RAG_ROUTER_DIRECT_MIN_SCORE,
+            help='クエリルーターがHyDEを省く最高類似度（擬似エンベディングの類似度は実際のモデルより低い）',
+        )
+        parser.add_argument(
+            '--min-similarity', type=float, default=0.0,
+            help='LLMに渡すチャンクの類似度の下限（RAG_MIN_SIMILARITY、擬似エンベディングの類似度に合わせて指定。既定は無効）',
+        )
+        parser.add_argument('--output', help='結果のJSONの出力先（省略時は標準出力）')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        sizes = sorted(_int_list(options['sizes']))
+        levels = _int_list(options['concurrency'])
+        if not sizes or not levels or min(sizes + levels) < 1 or options['queries'] < 1:
+            raise CommandError('--sizes・--concurrency・--queriesには1以上を指定してください。')
+
+        # 実際のデータベースとインデックスには触れず、テスト用データベースと一時ディレクトリを使う
+        database = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                root = Path(directory)
+                with override_settings(
+                    RAG_VECTORSTORE_BACKEND=options['backend'],
+                    CHROMA_PERSIST_DIRECTORY=root / 'chroma_db',
+                    NUMPY_INDEX_DIRECTORY=str(root / 'numpy_index'),
+                    LEXICAL_INDEX_DIRECTORY=str(root / 'lexical_index'),
+                    RAG_MIN_SIMILARITY=options['min_similarity'],
+                ):
+                    results = [self._run_size(root, size, levels, options) for size in sizes]
+        finally:
+            connection.creation.destroy_test_db(database, verbosity=0)
+
+        report = {
+            'commit': _git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'options': {
+                'backend': options['backend'],
+                'sections': options['sections'],
+                'queries': options['queries'],
+                'embedding_latency': options['embedding_latency'],
+                'llm_latency': options['llm_latency'],
+                'router_min_score': options['router_min_score'],
+                'min_similarity': options['min_similarity'],
+                'seed': options['seed'],
+            },
+            'settings': {
+                'RAG_MARKDOWN_LOADER': settings.RAG_MARKDOWN_LOADER,
+                'RAG_VECTOR_DIMENSIONS': settings.RAG_VECTOR_DIMENSIONS,
+                'RAG_VECTOR_QUANTIZATION': settings.RAG_VECTOR_QUANTIZATION,
+                'RAG_CONTEXT_MAX_TOKENS': settings.RAG_CONTEXT_MAX_TOKENS,
+                'RAG_SCORE_GAP': settings.RAG_SCORE_GAP,
+                'RAG_LEXICAL_FAST_PATH': settings.RAG_LEXICAL_FAST_PATH,
+                'RAG_QUERY_ROUTER': settings.RAG_QUERY_ROUTER,
+                'RAG_ROUTER_DIRECT_MIN_CHARS': settings.RAG_ROUTER_DIRECT_MIN_CHARS,
+                'EMBEDDING_BATCH_SIZE': settings.EMBEDDING_BATCH_SIZE,
+                'EMBEDDING_MAX_CONCURRENCY': settings.EMBEDDING_MAX_CONCURRENCY,
+            },
+            'results': results,
+        }
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(text + '\n', encoding='utf-8')
+            self.stderr.write(f'結果を{options["output"]}に書き出しました。')
+        else:
+            self.stdout.write(text)
+
+    def _run_size(self, root: Path, size: int, levels: List[int], options) -> dict:
+        """size件のドキュメントのコーパスを取り込み、同時実行数ごとに検索と回答生成を計測"""
+        rng = random.Random(options['seed'])
+        stages_before = STAGE_SECONDS.totals()
+        corpus = root / f'corpus_{size}'
+        corpus.mkdir()
+        user = get_user_model().objects.create_user(
+            username=f'bench{size}', email=f'bench{size}@example.com', password=None
+        )
+        user_id = str(user.id)
+        items = []
+        for i in range(size):
+            path = corpus / f'doc_{i}.md'
+            path.write_text(generate_markdown_document(i, options['sections'], rng), encoding='utf-8')
+            items.append((str(path), user_id, f'doc_{i}'))
+
+        embeddings = FakeEmbeddings(latency=options['embedding_latency'])
+        backend = build_vectorstore_backend(embeddings)
+        lexical_store = LexicalIndexStore(settings.LEXICAL_INDEX_DIRECTORY)
+        processor = DocumentProcessor(
+            embeddings=embeddings, backend=backend, embedding_cache=None, lexical_store=lexical_store
+        )
+
+        started = time.perf_counter()
+        ingested = processor.ingest_documents(items)
+        elapsed = time.perf_counter() - started
+        failures = [repr(result) for result in ingested.values() if not isinstance(result, int)]
+        if failures:
+            raise CommandError(f'取り込みに失敗しました: {failures[0]}')
+        chunks = sum(ingested.values())
+        self.stderr.write(f'{size}ドキュメント: {chunks}チャンクを{elapsed:.2f}秒で取り込みました。')
+
+        queries = generate_queries(size, options['sections'], options['queries'], rng)
+        retrieval, always_hyde, generation = {}, {}, {}
+        routes: Dict[str, int] = {}
+        for level in levels:
+            # HyDEのキャッシュが前の計測の結果を返さないよう、同時実行数ごとにサービスを作り直す
+            llm = FakeChatModel(latency=options['llm_latency'])
+            router = QueryRouter(
+                settings.RAG_QUERY_ROUTER, settings.RAG_ROUTER_DIRECT_MIN_CHARS, options['router_min_score']
+            )
+            service = RAGService(
+                embeddings=embeddings, llm=llm, backend=backend, lexical_store=lexical_store, router=router
+            )
+            decisions = []
+            retrieval[str(level)] = self._measure(
+                lambda q: decisions.append(service.route_and_retrieve(q, user_id)[1]), queries, level
+            )
+            for decision in decisions:
+                if decision is not None:
+                    routes[decision.mode] = routes.get(decision.mode, 0) + 1
+            # 比較用に、識別子の語彙検索以外は常にHyDEを使う場合も計測する
+            service = RAGService(
+                embeddings=embeddings, llm=llm, backend=backend, lexical_store=lexical_store,
+                router=QueryRouter(False, 0, 0.0),
+            )
+            always_hyde[str(level)] = self._measure(lambda q: service.retrieve(q, user_id), queries, level)
+            service = RAGService(
+                embeddings=embeddings, llm=llm, backend=backend, lexical_store=lexical_store, router=router
+            )
+            # 出典が無い回答は、関連するチャンクが無くLLMを呼ばずに返したもの
+            without_llm = []
+            generation[str(level)] = self._measure(
+                lambda q: without_llm.append(not service.answer(q, user_id).sources), queries, level
+            )
+            generation[str(level)]['answered_without_llm'] = sum(without_llm)
+            self.stderr.write(
+                f'  同時実行数{level}: 検索 p95 {retrieval[str(level)]["p95_ms"]:.1f} ms'
+                f'（常にHyDE {always_hyde[str(level)]["p95_ms"]:.1f} ms）、'
+                f'回答生成 p95 {generation[str(level)]["p95_ms"]:.1f} ms'
+            )
+
+        backend.clear()
+        stages = {}
+        for (stage,), (count, total) in sorted(STAGE_SECONDS.totals().items()):
+            previous_count, previous_total = stages_before.get((stage,), (0, 0.0))
+            if count > previous_count:
+                stages[stage] = {
+                    'count': count - previous_count,
+                    'mean_ms': round((total - previous_total) / (count - previous_count) * 1000, 3),
+                }
+        return {
+            'documents': size,
+            'chunks': chunks,
+            'ingest': {
+                'seconds': round(elapsed, 4),
+                'chunks_per_second': round(chunks / elapsed, 1) if elapsed else None,
+            },
+            'retrieve': retrieval,
+            'retrieve_always_hyde': always_hyde,
+            'router': {
+                # 全ての同時実行数を通した検索方法ごとの件数
+                'routes': routes,
+                'mean_ms_saved': {
+                    level: round(always_hyde[level]['mean_ms'] - retrieval[level]['mean_ms'], 3)
+                    for level in retrieval
+                },
+            },
+            'generate_response': generation,
+            # 取り込みと全ての同時実行数を通した段階ごとの平均所要時間
+            'stages': stages,
+            # プロセス全体の最大値のため、小さいコーパスから順に計測して増え方を見る
+            'peak_rss_mb': round(_peak_rss_mb(), 1),
+        }
+
+    def _measure(self, func: Callable[[str], object], queries: List[str], concurrency: int) -> Dict[str, float]:
+        """queriesをconcurrency並列で実行し、1件ごとのレイテンシの分布とスループットを返す"""
+        def timed(query: str) -> float:
+            started = time.perf_counter()
+            try:
+                # LangSmithへの送信を計測に含めない（コンテキスト変数のためスレッドごとに無効にする）
+                with tracing_context(enabled=False):
+                    func(query)
+                return (time.perf_counter() - started) * 1000
+            finally:
+                # ワーカースレッドが開いたデータベース接続を閉じる
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, queries))
+        elapsed = time.perf_counter() - started
+        return {
+            'p50_ms': round(_percentile(latencies, 50), 3),
+            'p95_ms': round(_percentile(latencies, 95), 3),
+            'p99_ms': round(_percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'queries_per_second': round(len(latencies) / elapsed, 1),
+        }
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from rag.services import warm_up
+
+
+class Command(BaseCommand):
+    help = 'RAGの重いモジュールとクライアントを読み込み、段階ごとの所要時間を表示します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', default=[], help='ベクトルストアを開いておくユーザーID（複数指定可）')
+
+    def handle(self, *args, **options):
+        timings = warm_up(options['user'])
+        for name, seconds in timings.items():
+            self.stdout.write(f'{name}: {seconds:.2f}秒')
+        self.stdout.write(self.style.SUCCESS(f'ウォームアップが完了しました（合計{sum(timings.values()):.2f}秒）。'))
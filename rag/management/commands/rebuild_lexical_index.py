@@ -0,0 +1,35 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.services import build_vectorstore_backend, get_lexical_index_store
+
+
+class Command(BaseCommand):
+    help = 'ベクトルストアに保存済みのチャンクから語彙検索インデックスを作り直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', help='対象のユーザーID（複数指定可、省略時は全ユーザー）')
+        parser.add_argument('--batch', type=int, default=1000, help='1回に読み込むチャンク数')
+
+    def handle(self, *args, **options):
+        lexical_store = get_lexical_index_store()
+        if lexical_store is None:
+            raise CommandError('語彙検索インデックスは無効です（LEXICAL_INDEX_DIRECTORY）。')
+
+        # 保存済みの本文を読むだけなので、エンベディングモデルは使わない
+        backend = build_vectorstore_backend(None)
+        user_ids = options['user'] or [str(pk) for pk in get_user_model().objects.values_list('pk', flat=True)]
+        for user_id in user_ids:
+            index = lexical_store.for_user(user_id)
+            index.drop()
+            count = 0
+            with backend.open(user_id) as vectorstore:
+                if vectorstore is None:
+                    continue
+                for ids, chunks in vectorstore.iter_chunks(options['batch']):
+                    index.upsert(ids, chunks)
+                    count += len(ids)
+            self.stdout.write(f'user {user_id}: {count}件')
+
+        backend.clear()
+        self.stdout.write(self.style.SUCCESS('語彙検索インデックスを作り直しました。'))
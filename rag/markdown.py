@@ -0,0 +1,166 @@
+import re
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document as LangChainDocument
+
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)(?:\s+#+)?\s*$")
+_FENCE_PATTERN = re.compile(r"^(```|~~~)")
+_SPACES_PATTERN = re.compile(r" +")
+# チャンクの区切りに使う文字（前にあるものほど優先）
+_SEPARATORS = ("\n", "。", "、", " ")
+# 見出しの階層を連結する区切り
+HEADING_SEPARATOR = " > "
+
+
+def _common_prefix(left: List[str], right: List[str]) -> List[str]:
+    prefix = []
+    for a, b in zip(left, right):
+        if a != b:
+            break
+        prefix.append(a)
+    return prefix
+
+
+class MarkdownChunker:
+    """Markdownを1行ずつ読みながら、1回の走査でクリーニングとチャンク化を行う
+
+    空行を除いて行頭・行末と連続する空白を詰める処理（DocumentProcessor.clean_textと同じ）を
+    行ごとに行い、見出し（ATX形式）でチャンクを区切る。min_chunk_size文字に満たない節は
+    次の節とまとめる。各チャンクには見出しの階層（まとめた節に共通する部分）をheading_pathとして付ける。
+    chunk_sizeを超える場合は改行・句点・読点・空白の順で区切りを探して分割し、
+    次のチャンクの先頭に前のチャンクの末尾chunk_overlap文字以内を重ねる。
+    """
+
+    def __init__(self, chunk_size: int, chunk_overlap: int, min_chunk_size: Optional[int] = None):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlapはchunk_sizeより小さくしてください")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.min_chunk_size = chunk_size // 4 if min_chunk_size is None else min_chunk_size
+
+    def split_file(self, file_path: str) -> Iterator[Tuple[str, str]]:
+        """ファイルを(チャンク本文, 見出しの階層)の列に分割"""
+        with open(file_path, encoding="utf-8", errors="replace") as f:
+            yield from self.split_lines(f)
+
+    def split_lines(self, lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+        """行の列を(チャンク本文, 見出しの階層)の列に分割"""
+        headings: List[Tuple[int, str]] = []
+        # bufferの内容が属する見出しの階層（短い節をまとめた場合は共通する部分）
+        merged_path: List[str] = []
+        buffer = ""
+        # bufferのうち最後の見出しの節が始まる位置
+        section_start = 0
+        # bufferのうち見出し行だけでできている先頭部分の長さ（本文が無ければチャンクにしない）
+        heading_only = 0
+        in_fence = False
+
+        def emit(final: bool) -> Iterator[Tuple[str, str]]:
+            nonlocal buffer, merged_path, section_start
+            chunks, buffer, rest_start = self._split(buffer)
+            if final and buffer:
+                chunks.append((buffer, rest_start))
+                buffer = ""
+            current = HEADING_SEPARATOR.join(text for _, text in headings)
+            for chunk, start in chunks:
+                # 最後の節の中だけでできたチャンクには、その節の見出しの階層を付ける
+                yield chunk, current if start >= section_start else HEADING_SEPARATOR.join(merged_path)
+            if rest_start >= section_start:
+                merged_path = [text for _, text in headings]
+                section_start = 0
+            else:
+                section_start -= rest_start
+
+        for raw in lines:
+            line = _SPACES_PATTERN.sub(" ", raw.strip())
+            if not line:
+                continue
+
+            if _FENCE_PATTERN.match(line):
+                in_fence = not in_fence
+            elif not in_fence:
+                match = _HEADING_PATTERN.match(line)
+                if match:
+                    if len(buffer) >= self.min_chunk_size:
+                        yield from emit(final=True)
+
+                    level, title = len(match.group(1)), match.group(2)
+                    while headings and headings[-1][0] >= level:
+                        headings.pop()
+                    headings.append((level, title))
+                    path = [text for _, text in headings]
+
+                    if len(buffer) > heading_only:
+                        # 短い節は次の節とまとめ、見出しの階層は共通する部分だけを残す
+                        merged_path = _common_prefix(merged_path, path)
+                        section_start = len(buffer) + 1
+                        buffer = f"{buffer}\n{title}"
+                        heading_only = 0
+                    else:
+                        merged_path = path
+                        section_start = 0
+                        buffer = title
+                        heading_only = len(buffer)
+                    continue
+
+            buffer = f"{buffer}\n{line}" if buffer else line
+            if len(buffer) > self.chunk_size:
+                yield from emit(final=False)
+                heading_only = 0
+
+        if len(buffer) > heading_only:
+            yield from emit(final=True)
+
+    def _split(self, text: str) -> Tuple[List[Tuple[str, int]], str, int]:
+        """chunk_sizeを超える部分をチャンクに切り出す
+
+        (チャンクとその開始位置のリスト, 残り, 残りの開始位置)を返す。開始位置は重ねた部分を含めたtext内の位置。
+        1行が非常に長い場合でも文字列全体を作り直さないよう、切り出し位置だけを進める。
+        """
+        chunks = []
+        start = 0
+        # 前のチャンクの末尾から重ねる部分
+        prefix = ""
+        while len(prefix) + len(text) - start > self.chunk_size:
+            window = prefix + text[start:start + self.chunk_size]
+            end = self._find_split(window, len(prefix))
+            chunk = window[:end].rstrip("\n")
+            chunks.append((chunk, start - len(prefix)))
+            start += end - len(prefix)
+            prefix = self._overlap(chunk)
+            if not prefix:
+                while start < len(text) and text[start] == "\n":
+                    start += 1
+        return chunks, prefix + text[start:], start - len(prefix)
+
+    def _find_split(self, window: str, carried: int) -> int:
+        limit = min(len(window), self.chunk_size)
+        # 小さすぎるチャンクを作らないよう、チャンクの後半にある区切りだけを使う
+        lower = max(carried + 1, self.chunk_size // 2)
+        for separator in _SEPARATORS:
+            position = window.rfind(separator, lower, limit)
+            if position != -1:
+                # 改行は次のチャンクの先頭に回し、句読点はこのチャンクに含める
+                return position if separator == "\n" else position + len(separator)
+        return limit
+
+    def _overlap(self, chunk: str) -> str:
+        if not self.chunk_overlap:
+            return ""
+        tail = chunk[-self.chunk_overlap:]
+        if len(tail) == len(chunk):
+            return ""
+        # 文や行の途中から重ねないよう、最初の区切りの後ろから始める
+        for separator in _SEPARATORS:
+            position = tail.find(separator)
+            if position != -1 and position + len(separator) < len(tail):
+                return tail[position + len(separator):].lstrip("\n")
+        return tail
+
+    def chunk_file(self, file_path: str, metadata: Optional[dict] = None) -> List[LangChainDocument]:
+        """ファイルをチャンク化してドキュメントのリストにする"""
+        base = {"source": file_path, **(metadata or {})}
+        return [
+            LangChainDocument(page_content=text, metadata={**base, "heading_path": heading_path})
+            for text, heading_path in self.split_file(file_path)
+        ]
@@ -1,3 +1,89 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
+
+
+class CorpusVersion(models.Model):
+    """ユーザーごとのベクトルストア更新カウンタ"""
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='corpus_version'
+    )
+    version = models.PositiveBigIntegerField(default=0, verbose_name='バージョン')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+
+    class Meta:
+        verbose_name = 'コーパスバージョン'
+        verbose_name_plural = 'コーパスバージョン'
+
+    def __str__(self):
+        return f'{self.user_id}: {self.version}'
+
+    @classmethod
+    def current(cls, user_id: str) -> int:
+        """ユーザーの現在のバージョンを取得"""
+        version = cls.objects.filter(user_id=user_id).values_list('version', flat=True).first()
+        return version or 0
+
+    @classmethod
+    async def acurrent(cls, user_id: str) -> int:
+        """ユーザーの現在のバージョンを取得（非同期）"""
+        version = await cls.objects.filter(user_id=user_id).values_list('version', flat=True).afirst()
+        return version or 0
+
+    @classmethod
+    def bump(cls, user_id: str) -> int:
+        """ユーザーのバージョンを進めて新しい値を返す"""
+        cls.objects.get_or_create(user_id=user_id)
+        # update()ではauto_nowが効かないため更新日時も明示する（共有プールの鮮度判定に使う）
+        cls.objects.filter(user_id=user_id).update(version=F('version') + 1, updated_at=timezone.now())
+        return cls.current(user_id)
+
+
+class ChatSession(models.Model):
+    """チャットの会話（直近のやり取りより前は要約して保持する）"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chat_sessions')
+    title = models.CharField(max_length=100, blank=True, verbose_name='タイトル')
+    # 要約済みのメッセージ（summarized=True）の内容を順に畳み込んだ要約
+    summary = models.TextField(blank=True, verbose_name='これまでの会話の要約')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+
+    class Meta:
+        verbose_name = 'チャットの会話'
+        verbose_name_plural = 'チャットの会話'
+        ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['user', '-updated_at'], name='rag_session_user_updated_idx'),
+        ]
+
+    def __str__(self):
+        return self.title or str(self.id)
+
+
+class ChatMessage(models.Model):
+    """会話の1メッセージ"""
+
+    class Role(models.TextChoices):
+        USER = 'user', 'ユーザー'
+        ASSISTANT = 'assistant', 'AI'
+
+    session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
+    role = models.CharField(max_length=20, choices=Role.choices, verbose_name='発言者')
+    content = models.TextField(verbose_name='内容')
+    # 履歴を踏まえて書き換えた検索用の質問（ユーザーのメッセージのみ）
+    retrieval_query = models.TextField(blank=True, verbose_name='検索に使った質問')
+    # 要約に畳み込み済みで、プロンプトには要約としてだけ含める
+    summarized = models.BooleanField(default=False, verbose_name='要約済み')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+
+    class Meta:
+        verbose_name = 'チャットのメッセージ'
+        verbose_name_plural = 'チャットのメッセージ'
+        ordering = ['created_at', 'id']
 
-# Create your models here.
+    def __str__(self):
+        return f'{self.get_role_display()}: {self.content[:30]}'
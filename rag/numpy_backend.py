@@ -0,0 +1,456 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document as LangChainDocument
+
+from .backends import UserVectorStore, VectorStoreBackend
+from .quantization import VectorCompression, normalize_rows
+
+_META_FILE = "meta.json"
+_LOCK_FILE = "lock"
+# メタデータを読んだ直後に書き込みで前の世代のファイルが消された場合に読み直す回数
+_LOAD_ATTEMPTS = 3
+# チャンクのログの行数が有効な行の何倍を超えたら書き直すか
+_COMPACT_RATIO = 2
+
+
+class _IndexData:
+    """1ユーザー分のベクトル行列とメタデータ
+
+    ベクトルは正規化済みのfloat32行列で、内積がそのままコサイン類似度になる。
+    compressionが有効な場合は、切り詰め・量子化したコードをメモリに読み込んで1段目の検索に使い、
+    全精度の行列はメモリマップのまま候補の並べ替えにだけ参照する。
+
+    ディスク上では、チャンクのIDと本文・メタデータを1行1件の追記専用のログ（chunks-*.jsonl）に、
+    ベクトルを行列のファイル（vectors-*.f32）に置き、meta.jsonには各行のログ内の位置とファイル名だけを持つ。
+    追加だけの書き込みは両方のファイルの末尾に追記し、更新・削除があった場合は行列を新しい世代に書き出す。
+    """
+
+    def __init__(
+        self,
+        ids: List[str],
+        documents: List[str],
+        metadatas: List[dict],
+        vectors: np.ndarray,
+        compression: VectorCompression,
+        generation: int = 0,
+        codes: Optional[np.ndarray] = None,
+        scales: Optional[np.ndarray] = None,
+        offsets: Optional[List[Optional[int]]] = None,
+        files: Optional[dict] = None,
+    ):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.vectors = vectors
+        self.compression = compression
+        self.generation = generation
+        # 1段目の検索用のコード（変更後は検索時に作り直す）
+        self.codes = codes
+        self.scales = scales
+        self.rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+        # 各行のチャンクのログ内の位置（Noneは未書き込み・変更あり）
+        self.offsets = offsets if offsets is not None else [None] * len(ids)
+        # 読み込んだ世代のファイル名・ログの大きさと行数・行列の行数
+        self.files = files or {}
+        # 行列のファイルと内容が一致している先頭の行数（これより後ろだけが追加なら追記できる）
+        self.stable_rows = self.files.get("count", 0)
+        # このデータが反映しているコーパスバージョン
+        self.version: Optional[int] = None
+
+    @classmethod
+    def empty(cls, compression: VectorCompression) -> "_IndexData":
+        return cls([], [], [], np.empty((0, 0), dtype=np.float32), compression)
+
+    @classmethod
+    def load(cls, directory: Path, compression: VectorCompression, in_memory: bool = False) -> "_IndexData":
+        """ディスクから読み込む（in_memory=Falseの場合、ベクトルはメモリマップで参照）"""
+        for attempt in range(_LOAD_ATTEMPTS):
+            try:
+                return cls._load(directory, compression, in_memory)
+            except FileNotFoundError:
+                # 読んだメタデータが指すファイルが、2世代後の書き込みで削除された
+                if attempt == _LOAD_ATTEMPTS - 1:
+                    raise
+
+    @classmethod
+    def _load(cls, directory: Path, compression: VectorCompression, in_memory: bool) -> "_IndexData":
+        meta_path = directory / _META_FILE
+        if not meta_path.exists():
+            return cls.empty(compression)
+        with meta_path.open(encoding="utf-8") as f:
+            meta = json.load(f)
+
+        if "documents" in meta:
+            # チャンクのログを導入する前の形式（次の書き込みでログに移す）
+            ids, documents, metadatas = meta["ids"], meta["documents"], meta["metadatas"]
+            offsets = None
+        else:
+            ids, documents, metadatas = [], [], []
+            offsets = meta["offsets"]
+            with (directory / meta["chunks"]).open("rb") as f:
+                log = f.read(meta["chunks_size"])
+            for offset in offsets:
+                chunk = json.loads(log[offset:log.index(b"\n", offset)])
+                ids.append(chunk["id"])
+                documents.append(chunk["text"])
+                metadatas.append(chunk["metadata"])
+        files = {
+            name: meta[name] for name in ("vectors", "chunks", "chunks_size", "chunks_lines", "codes", "scales")
+            if name in meta
+        }
+        if offsets is not None:
+            files["count"] = len(ids)
+
+        count, dimension = len(ids), meta["dimension"]
+        vectors_path = directory / meta["vectors"]
+        if count == 0:
+            vectors = np.empty((0, dimension), dtype=np.float32)
+        elif in_memory:
+            vectors = np.fromfile(vectors_path, dtype=np.float32, count=count * dimension).reshape(count, dimension)
+        else:
+            vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, dimension))
+
+        codes = scales = None
+        # 設定が変わっていた場合は保存済みのコードを使わず、検索時に作り直す
+        if count and not in_memory and compression.enabled and meta.get("compression") == compression.describe():
+            codes = np.load(directory / meta["codes"])
+            scales = np.load(directory / meta["scales"]) if meta.get("scales") else None
+        return cls(
+            ids, documents, metadatas, vectors, compression, meta["generation"], codes, scales, offsets, files
+        )
+
+    def save(self, directory: Path) -> "_IndexData":
+        """変更をファイルに書き出してメタデータを差し替え、メモリマップで開き直したデータを返す
+
+        メタデータはアトミックに置き換え、直前の世代のファイルは次の書き込みまで残すため、
+        他プロセスが読み込み中に古いメタデータが指すファイルを失うことはない。
+        """
+        generation = self.generation + 1
+        dimension = int(self.vectors.shape[1])
+        meta = {"generation": generation, "dimension": dimension}
+        meta.update(self._save_chunks(directory, generation))
+        meta["vectors"] = self._save_vectors(directory, generation)
+        if self.compression.enabled and self.ids:
+            codes, scales = self.encoded()
+            meta["compression"] = self.compression.describe()
+            meta["codes"] = f"codes-{generation}.npy"
+            np.save(directory / meta["codes"], codes)
+            if scales is not None:
+                meta["scales"] = f"scales-{generation}.npy"
+                np.save(directory / meta["scales"], scales)
+        meta["offsets"] = self.offsets
+
+        tmp_path = directory / f"{_META_FILE}.tmp"
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        # 読み込み中の他プロセスが半端な状態を見ないよう、メタデータはアトミックに置き換える
+        os.replace(tmp_path, directory / _META_FILE)
+
+        # 今の世代と直前の世代が参照していないファイルを削除（開いているメモリマップは削除後も読める）
+        keep = {meta.get(name) for name in ("vectors", "chunks", "codes", "scales")}
+        keep |= {self.files.get(name) for name in ("vectors", "chunks", "codes", "scales")}
+        for pattern in ("vectors-*.f32", "chunks-*.jsonl", "codes-*.npy", "scales-*.npy"):
+            for path in directory.glob(pattern):
+                if path.name not in keep:
+                    path.unlink(missing_ok=True)
+        return _IndexData.load(directory, self.compression)
+
+    def _save_chunks(self, directory: Path, generation: int) -> dict:
+        """変更のあったチャンクをログに追記する（無効な行が増えたら新しいログに書き直す）"""
+        name = self.files.get("chunks")
+        size, lines = self.files.get("chunks_size", 0), self.files.get("chunks_lines", 0)
+        pending = [row for row, offset in enumerate(self.offsets) if offset is None]
+        if name is None or lines + len(pending) > _COMPACT_RATIO * len(self.ids) + 100:
+            name, size, lines = f"chunks-{generation}.jsonl", 0, 0
+            pending = list(range(len(self.ids)))
+
+        with (directory / name).open("r+b" if size else "wb") as f:
+            # 前回の書き込みが途中で失敗した場合の末尾のゴミは上書きする
+            f.seek(size)
+            for row in pending:
+                line = json.dumps(
+                    {"id": self.ids[row], "text": self.documents[row], "metadata": self.metadatas[row]},
+                    ensure_ascii=False,
+                ).encode("utf-8") + b"\n"
+                self.offsets[row] = size
+                f.write(line)
+                size += len(line)
+            f.truncate()
+        return {"chunks": name, "chunks_size": size, "chunks_lines": lines + len(pending)}
+
+    def _save_vectors(self, directory: Path, generation: int) -> str:
+        """追加だけなら行列のファイルに追記し、それ以外は新しい世代のファイルに書き出す"""
+        matrix = np.ascontiguousarray(self.vectors, dtype=np.float32)
+        name, count = self.files.get("vectors"), self.files.get("count", 0)
+        if name is not None and count and self.stable_rows == count and (directory / name).exists():
+            with (directory / name).open("r+b") as f:
+                # 他プロセスがメモリマップしている先頭の行には触れず、その後ろに書く
+                f.seek(count * matrix.shape[1] * 4)
+                matrix[count:].tofile(f)
+                f.truncate()
+            return name
+        name = f"vectors-{generation}.f32"
+        matrix.tofile(directory / name)
+        return name
+
+    def encoded(self) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """1段目の検索用のコードとスケール（未作成なら全精度の行列から作る）"""
+        if self.codes is None:
+            self.codes, self.scales = self.compression.encode(self.vectors)
+        return self.codes, self.scales
+
+    def upsert(self, ids: Sequence[str], chunks: Sequence[LangChainDocument], vectors: Sequence[Sequence[float]]):
+        matrix = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        if not len(self.ids):
+            self.vectors = np.empty((0, matrix.shape[1]), dtype=np.float32)
+        elif matrix.shape[1] != self.vectors.shape[1]:
+            raise ValueError(f"エンベディングの次元が一致しません: {matrix.shape[1]} != {self.vectors.shape[1]}")
+
+        appended = []
+        for chunk_id, chunk, vector in zip(ids, chunks, matrix):
+            row = self.rows.get(chunk_id)
+            if row is None:
+                self.rows[chunk_id] = len(self.ids) + len(appended)
+                appended.append(vector)
+                self.ids.append(chunk_id)
+                self.documents.append(chunk.page_content)
+                self.metadatas.append(dict(chunk.metadata))
+                self.offsets.append(None)
+            else:
+                self.vectors[row] = vector
+                self.documents[row] = chunk.page_content
+                self.metadatas[row] = dict(chunk.metadata)
+                self.offsets[row] = None
+                self.stable_rows = min(self.stable_rows, row)
+        if appended:
+            self.vectors = np.vstack([self.vectors, np.asarray(appended, dtype=np.float32)])
+        self.codes = self.scales = None
+
+    def delete_rows(self, rows: Sequence[int]):
+        if not rows:
+            return
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[list(rows)] = False
+        self.vectors = self.vectors[keep]
+        self.ids = [value for value, kept in zip(self.ids, keep) if kept]
+        self.documents = [value for value, kept in zip(self.documents, keep) if kept]
+        self.metadatas = [value for value, kept in zip(self.metadatas, keep) if kept]
+        self.offsets = [value for value, kept in zip(self.offsets, keep) if kept]
+        self.rows = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self.stable_rows = min(self.stable_rows, min(rows))
+        self.codes = self.scales = None
+
+    def document_rows(self, document_ids: Sequence[str]) -> List[int]:
+        targets = set(document_ids)
+        return [row for row, metadata in enumerate(self.metadatas) if metadata.get("document_id") in targets]
+
+    def search(self, embedding: Sequence[float], k: int) -> List[Tuple[LangChainDocument, float]]:
+        count = len(self.ids)
+        if count == 0 or k <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        if not self.compression.enabled:
+            scores = self.vectors @ query
+            return [(self.document(int(row)), float(scores[row])) for row in _top_k(scores, k)]
+
+        # 1段目は圧縮したコードで候補を絞り、全精度のベクトルで計算し直して並べ替える
+        codes, scales = self.encoded()
+        approximate = self.compression.scores(codes, scales, query)
+        # 全精度の行列はメモリマップなので、ディスク上の順に読むよう候補を行番号で並べておく
+        candidates = np.sort(_top_k(approximate, max(k, self.compression.rerank_candidates)))
+        exact = self.vectors[candidates] @ query
+        return [(self.document(int(candidates[i])), float(exact[i])) for i in _top_k(exact, k)]
+
+    def document(self, row: int) -> LangChainDocument:
+        return LangChainDocument(id=self.ids[row], page_content=self.documents[row], metadata=dict(self.metadatas[row]))
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコアの高い順に上位k件の行番号"""
+    k = min(k, len(scores))
+    # 全件を並べ替えず、上位k件だけを取り出してから並べる
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class NumpyUserStore(UserVectorStore):
+    """NumPyバックエンドの1ユーザー分のストア
+
+    読み込みは開いた時点のデータ（メモリマップ）を参照する。
+    最初の書き込みでファイルロックを取ってディスク上の最新の内容を読み込み、
+    以降の変更はメモリ上で行ってcommitでまとめて書き出す。
+    """
+
+    def __init__(self, backend: "NumpyBackend", user_id: str, data: _IndexData):
+        self.backend = backend
+        self.user_id = user_id
+        self.data = data
+        self._lock_file = None
+        self._dirty = False
+
+    def is_empty(self) -> bool:
+        return not self.data.ids
+
+    def get_chunk_ids(self, document_ids):
+        existing: Dict[str, set] = {}
+        for row in self.data.document_rows(document_ids):
+            existing.setdefault(self.data.metadatas[row]["document_id"], set()).add(self.data.ids[row])
+        return existing
+
+    def upsert(self, ids, chunks, vectors):
+        if ids:
+            self._begin_write().upsert(ids, chunks, vectors)
+            self._dirty = True
+
+    def update_metadata(self, ids, chunks):
+        data = self._begin_write() if ids else self.data
+        for chunk_id, chunk in zip(ids, chunks):
+            row = data.rows.get(chunk_id)
+            if row is not None:
+                data.metadatas[row] = dict(chunk.metadata)
+                data.offsets[row] = None
+                self._dirty = True
+
+    def delete(self, ids):
+        if ids:
+            data = self._begin_write()
+            rows = [data.rows[chunk_id] for chunk_id in ids if chunk_id in data.rows]
+            data.delete_rows(rows)
+            self._dirty = self._dirty or bool(rows)
+
+    def delete_documents(self, document_ids) -> bool:
+        data = self._begin_write()
+        rows = data.document_rows(document_ids)
+        data.delete_rows(rows)
+        self._dirty = self._dirty or bool(rows)
+        return bool(rows)
+
+    def search_with_scores(self, embedding, k):
+        return self.data.search(embedding, k)
+
+    def get_document_chunks(self, document_id):
+        rows = sorted(
+            self.data.document_rows([document_id]),
+            key=lambda row: self.data.metadatas[row].get("chunk_index", 0),
+        )
+        return [self.data.document(row) for row in rows], [self.data.vectors[row].tolist() for row in rows]
+
+    def iter_chunks(self, batch_size):
+        for start in range(0, len(self.data.ids), batch_size):
+            rows = range(start, min(start + batch_size, len(self.data.ids)))
+            yield [self.data.ids[row] for row in rows], [self.data.document(row) for row in rows]
+
+    def commit(self):
+        if self._dirty:
+            version = self.data.version
+            self.data = self.data.save(self.backend.user_directory(self.user_id))
+            self.data.version = version
+            self.backend.remember(self.user_id, self.data)
+            self._dirty = False
+        self._release_lock()
+
+    def advance_version(self, version: int):
+        if self.data.version is not None and version == self.data.version + 1:
+            self.data.version = version
+
+    def close(self):
+        """確定していない変更を捨ててロックを解放"""
+        self._dirty = False
+        self._release_lock()
+
+    def _begin_write(self) -> _IndexData:
+        if self._lock_file is None:
+            directory = self.backend.user_directory(self.user_id)
+            directory.mkdir(parents=True, exist_ok=True)
+            self._lock_file = open(directory / _LOCK_FILE, "a")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            # 他プロセスの書き込みを取り込むため、ロック後にディスクから読み直す
+            version = self.data.version
+            self.data = _IndexData.load(directory, self.backend.compression, in_memory=True)
+            self.data.version = version
+        return self.data
+
+    def _release_lock(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class NumpyBackend(VectorStoreBackend):
+    """ユーザーごとのベクトルをメモリマップしたfloat32行列で保持するプロセス内バックエンド
+
+    検索はベクトル化した内積とargpartitionによる厳密なtop-k。
+    compressionを指定すると、切り詰め・量子化したベクトルで候補を絞ってから全精度で並べ替える。
+    読み込んだデータはmax_size人分までLRUで保持する。
+    """
+
+    def __init__(self, directory: Path, max_size: int, compression: Optional[VectorCompression] = None):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.compression = compression or VectorCompression()
+        self._indexes: "OrderedDict[str, _IndexData]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def user_directory(self, user_id: str) -> Path:
+        """ユーザーのデータを保存するディレクトリ"""
+        return self.directory / f"user_{user_id}"
+
+    @contextmanager
+    def open(self, user_id: str, create: bool = False, version: Optional[int] = None):
+        data = self._load(user_id, create, version)
+        if data is None:
+            yield None
+            return
+        store = NumpyUserStore(self, user_id, data)
+        try:
+            yield store
+        finally:
+            store.close()
+
+    def exists(self, user_id: str) -> bool:
+        return (self.user_directory(user_id) / _META_FILE).exists()
+
+    def discard(self, user_id: str):
+        with self._lock:
+            self._indexes.pop(user_id, None)
+        shutil.rmtree(self.user_directory(user_id), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def remember(self, user_id: str, data: _IndexData):
+        """書き込み後のデータを保持"""
+        with self._lock:
+            self._indexes[user_id] = data
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_size:
+                self._indexes.popitem(last=False)
+
+    def _load(self, user_id: str, create: bool, version: Optional[int]) -> Optional[_IndexData]:
+        with self._lock:
+            data = self._indexes.get(user_id)
+            if data is not None and (version is None or data.version == version):
+                self._indexes.move_to_end(user_id)
+                return data
+
+        if not self.exists(user_id) and not create:
+            return None
+        data = _IndexData.load(self.user_directory(user_id), self.compression)
+        data.version = version
+        self.remember(user_id, data)
+        return data
@@ -0,0 +1,307 @@
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+import chromadb
+from chromadb.api.shared_system_client import SharedSystemClient
+from django.conf import settings
+from django.utils import timezone
+from langchain_chroma import Chroma
+
+from .models import CorpusVersion
+
+# ベクトルストアの保存形式
+STORAGE_PER_USER = "per_user"
+STORAGE_SHARED = "shared"
+
+# chromadbは同じパスを開くクライアントに同じSystemを返すため、プールをまたいで参照数を数え、
+# 最後の利用者が解放したときだけ停止する
+_system_refs: Dict[int, int] = {}
+_system_lock = threading.Lock()
+
+# 同じパスのクライアントを複数のスレッドが同時に作ると、chromadbが起動前のSystemを返すことがあるため、
+# エントリを開く処理はキーごとのロック（固定数に分けたもの）で直列にする
+_OPEN_LOCK_STRIPES = 64
+
+
+def _hold_system(system):
+    with _system_lock:
+        _system_refs[id(system)] = _system_refs.get(id(system), 0) + 1
+
+
+def _release_system(system):
+    with _system_lock:
+        refs = _system_refs.pop(id(system), 1) - 1
+        if refs > 0:
+            _system_refs[id(system)] = refs
+            return
+    system.stop()
+
+
+def get_user_persist_directory(user_id: str) -> Path:
+    """ユーザー専用のベクトルストアディレクトリを取得"""
+    return settings.CHROMA_PERSIST_DIRECTORY / f"user_{user_id}"
+
+
+def get_user_collection_name(user_id: str) -> str:
+    """ユーザー専用のコレクション名を取得"""
+    return f"documents_{user_id}"
+
+
+def get_shard_persist_directory(shard: int) -> Path:
+    """共有モードのシャードのディレクトリを取得
+
+    chromadbはパスごとにSystemを共有するため、シャードごとにディレクトリを分けて
+    個別に開き直し・解放できるようにする。
+    """
+    return settings.CHROMA_PERSIST_DIRECTORY / "shared" / f"shard_{shard}"
+
+
+def get_shard_collection_name(shard: int) -> str:
+    """共有モードのシャードのコレクション名を取得"""
+    return f"documents_shard_{shard}"
+
+
+def get_user_shard(user_id: str, shards: int) -> int:
+    """ユーザーが属するシャード番号を取得（プロセスをまたいで同じ値になるようcrc32を使う）"""
+    return zlib.crc32(str(user_id).encode("utf-8")) % shards
+
+
+class _PoolEntry:
+    """プールに保持するクライアントとベクトルストア
+
+    ユーザー別モードでは1ユーザー、共有モードでは1シャードに対応する。
+    """
+
+    def __init__(self, key: str, persist_directory: Path, client, vectorstore: Chroma, collection):
+        self.key = key
+        self.persist_directory = persist_directory
+        self.client = client
+        self.vectorstore = vectorstore
+        self.collection = collection
+        # このハンドルが反映しているユーザーごとのコーパスバージョン
+        self.versions: Dict[str, Optional[int]] = {}
+        self.opened_at: datetime = timezone.now()
+        self.system = client._system
+        _hold_system(self.system)
+        self.refs = 0
+        self.evicted = False
+        # 解放時にディレクトリごと削除するか
+        self.remove_directory = False
+
+
+class VectorStorePool:
+    """Chromaクライアントとベクトルストアを保持するLRUプール
+
+    modeが"per_user"の場合はユーザーごとのディレクトリとコレクションを、
+    "shared"の場合はshards個のコレクションを全ユーザーで共有する。
+    共有モードでは検索・削除の条件に必ずuser_filterでユーザーIDを含めること。
+    """
+
+    def __init__(self, embeddings, max_size: int, mode: str = STORAGE_PER_USER, shards: int = 1):
+        if mode not in (STORAGE_PER_USER, STORAGE_SHARED):
+            raise ValueError(f"不明なストレージモードです: {mode}")
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.mode = mode
+        self.shards = max(shards, 1)
+        self._entries: "OrderedDict[str, _PoolEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._open_locks = [threading.Lock() for _ in range(_OPEN_LOCK_STRIPES)]
+
+    @property
+    def shared(self) -> bool:
+        """共有コレクションモードか"""
+        return self.mode == STORAGE_SHARED
+
+    @contextmanager
+    def acquire(
+        self, user_id: str, create: bool = False, version: Optional[int] = None
+    ) -> Iterator[Optional[_PoolEntry]]:
+        """ユーザーのエントリを借用（ストアが存在せずcreate=Falseの場合はNone）
+
+        versionを指定すると、保持中のエントリが別バージョンで開かれていた場合に開き直す。
+        他プロセスが書き込んだ内容を読み込むために使う。
+        """
+        entry = self._checkout(user_id, create, version)
+        try:
+            yield entry
+        finally:
+            if entry is not None:
+                self._checkin(entry)
+
+    def user_filter(self, user_id: str, where: Optional[dict] = None) -> Optional[dict]:
+        """共有モードではユーザーIDの条件を加えたメタデータ条件を返す"""
+        if not self.shared:
+            return where
+        condition = {"user_id": str(user_id)}
+        return condition if where is None else {"$and": [condition, where]}
+
+    def exists(self, user_id: str) -> bool:
+        """ユーザーのベクトルストアが存在するか"""
+        if not self.shared:
+            return self._key(user_id) in self._entries or get_user_persist_directory(user_id).exists()
+
+        with self.acquire(user_id) as entry:
+            return entry is not None and not self.is_empty(entry, user_id)
+
+    def is_empty(self, entry: _PoolEntry, user_id: str) -> bool:
+        """ユーザーのチャンクが残っていないか（IDの一覧は取得せずに判定）"""
+        if not self.shared:
+            return entry.collection.count() == 0
+        return not entry.collection.get(where=self.user_filter(user_id), limit=1, include=[])["ids"]
+
+    def invalidate(self, user_id: str):
+        """ユーザーのエントリを破棄（使用中の場合は返却時に解放）"""
+        with self._lock:
+            entry = self._entries.pop(self._key(user_id), None)
+            if entry is not None:
+                self._retire(entry)
+
+    def discard(self, user_id: str):
+        """ユーザーのエントリを破棄し、ベクトルストアのディレクトリを削除
+
+        使用中の場合は、最後の返却でクライアントを停止してから削除する。
+        共有モードではディレクトリを他のユーザーと共有しているため何もしない。
+        """
+        if self.shared:
+            return
+        with self._lock:
+            entry = self._entries.pop(self._key(user_id), None)
+            if entry is None:
+                shutil.rmtree(get_user_persist_directory(user_id), ignore_errors=True)
+                return
+            entry.remove_directory = True
+            self._retire(entry)
+
+    def clear(self):
+        """全エントリを破棄"""
+        with self._lock:
+            while self._entries:
+                _, entry = self._entries.popitem(last=False)
+                self._retire(entry)
+
+    def _key(self, user_id: str) -> str:
+        if self.shared:
+            return f"shard_{get_user_shard(user_id, self.shards)}"
+        return f"user_{user_id}"
+
+    def _location(self, user_id: str):
+        if self.shared:
+            shard = get_user_shard(user_id, self.shards)
+            return get_shard_persist_directory(shard), get_shard_collection_name(shard)
+        return get_user_persist_directory(user_id), get_user_collection_name(user_id)
+
+    def _is_stale(self, entry: _PoolEntry, user_id: str, version: Optional[int]) -> bool:
+        if version is None:
+            return False
+        if user_id in entry.versions:
+            return entry.versions[user_id] != version
+        if not self.shared:
+            return True
+        # 共有エントリを初めて使うユーザーは、開いた後に他プロセスの書き込みがあったかで判定する
+        return CorpusVersion.objects.filter(user_id=user_id, updated_at__gt=entry.opened_at).exists()
+
+    def _checkout(self, user_id: str, create: bool, version: Optional[int]) -> Optional[_PoolEntry]:
+        # クライアントの作成やバージョンの確認（DBへの問い合わせ）はプール全体のロックの外で行い、
+        # 他のユーザーの保持中のエントリの借用を待たせない
+        key = self._key(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # 判定中に解放されないよう借用しておく
+                entry.refs += 1
+
+        if entry is not None:
+            try:
+                stale = self._is_stale(entry, user_id, version)
+            except BaseException:
+                self._checkin(entry)
+                raise
+            if not stale:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._entries.move_to_end(key)
+                    self._record_version(entry, user_id, version)
+                    return entry
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                    self._retire(entry)
+                self._checkin_locked(entry)
+
+        with self._open_locks[zlib.crc32(key.encode("utf-8")) % _OPEN_LOCK_STRIPES]:
+            # 待っている間に他のスレッドが開いていれば、それを使う
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.refs += 1
+                    self._record_version(entry, user_id, version)
+                    return entry
+
+            persist_directory, collection_name = self._location(user_id)
+            if not persist_directory.exists():
+                if not create:
+                    return None
+                persist_directory.mkdir(parents=True, exist_ok=True)
+            entry = self._open(key, persist_directory, collection_name)
+
+            with self._lock:
+                self._entries[key] = entry
+                self._evict_overflow()
+                entry.refs += 1
+                self._record_version(entry, user_id, version)
+                return entry
+
+    def _open(self, key: str, persist_directory: Path, collection_name: str) -> _PoolEntry:
+        client = chromadb.PersistentClient(path=str(persist_directory))
+        vectorstore = Chroma(
+            client=client,
+            embedding_function=self.embeddings,
+            collection_name=collection_name,
+        )
+        # エンベディング済みベクトルの一括書き込み用に生のコレクションも保持する
+        collection = client.get_collection(collection_name)
+        return _PoolEntry(key, persist_directory, client, vectorstore, collection)
+
+    @staticmethod
+    def _record_version(entry: _PoolEntry, user_id: str, version: Optional[int]):
+        if version is not None or user_id not in entry.versions:
+            entry.versions[user_id] = version
+
+    def _checkin(self, entry: _PoolEntry):
+        with self._lock:
+            self._checkin_locked(entry)
+
+    def _checkin_locked(self, entry: _PoolEntry):
+        entry.refs -= 1
+        if entry.evicted and entry.refs == 0:
+            self._release(entry)
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_size:
+            _, entry = self._entries.popitem(last=False)
+            self._retire(entry)
+
+    def _retire(self, entry: _PoolEntry):
+        # chromadbはパスごとにSystemをクラス変数でキャッシュするため、
+        # 次に開くクライアントが新しいSystemを作るようキャッシュから外しておく
+        identifier = entry.client._identifier
+        if SharedSystemClient._identifier_to_system.get(identifier) is entry.system:
+            del SharedSystemClient._identifier_to_system[identifier]
+
+        entry.evicted = True
+        if entry.refs == 0:
+            self._release(entry)
+
+    def _release(self, entry: _PoolEntry):
+        _release_system(entry.system)
+        # 削除待ちの間に同じストアが開き直されていたら、そちらのデータを残す
+        if entry.remove_directory and entry.key not in self._entries:
+            shutil.rmtree(entry.persist_directory, ignore_errors=True)
@@ -0,0 +1,89 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# 1段目の検索に使うベクトルの量子化方式
+QUANTIZATION_NONE = "none"
+QUANTIZATION_INT8 = "int8"
+QUANTIZATION_BINARY = "binary"
+QUANTIZATIONS = (QUANTIZATION_NONE, QUANTIZATION_INT8, QUANTIZATION_BINARY)
+
+# スコア計算で一度にfloat32へ展開する行数（一時配列の大きさを抑える）
+_SCORE_BLOCK_ROWS = 4096
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """行ごとにL2正規化"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorCompression:
+    """1段目の検索用に次元を切り詰め・量子化したベクトルを作り、近似スコアを計算する
+
+    dimensionsは先頭から残す次元数（0で切り詰めない）。切り詰めたベクトルは正規化し直す。
+    int8は行ごとのスケールで、binaryは符号ビットで保持する。
+    近似スコアの上位rerank_candidates件を、全精度のベクトルで計算し直して並べ替える前提。
+    """
+
+    def __init__(self, dimensions: int = 0, quantization: str = QUANTIZATION_NONE, rerank_candidates: int = 50):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"不明な量子化方式です: {quantization}")
+        self.dimensions = max(dimensions, 0)
+        self.quantization = quantization
+        self.rerank_candidates = rerank_candidates
+
+    @property
+    def enabled(self) -> bool:
+        """全精度のベクトルとは別に1段目用のベクトルを使うか"""
+        return self.dimensions > 0 or self.quantization != QUANTIZATION_NONE
+
+    def describe(self) -> dict:
+        """保存済みのコードがどの設定で作られたかを記録するための値"""
+        return {"dimensions": self.dimensions, "quantization": self.quantization}
+
+    def truncate(self, vectors: np.ndarray) -> np.ndarray:
+        """先頭のdimensions次元に切り詰めて正規化し直す"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not self.dimensions or self.dimensions >= vectors.shape[1]:
+            return vectors
+        return normalize_rows(vectors[:, :self.dimensions])
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """正規化済みのベクトルを(コード, 行ごとのスケール)に変換"""
+        truncated = self.truncate(vectors)
+        if self.quantization == QUANTIZATION_INT8:
+            scales = np.abs(truncated).max(axis=1) / 127.0 if len(truncated) else np.empty(0)
+            scales[scales == 0] = 1.0
+            codes = np.round(truncated / scales[:, None]).astype(np.int8)
+            return codes, scales.astype(np.float32)
+        if self.quantization == QUANTIZATION_BINARY:
+            return np.packbits(truncated > 0, axis=1), None
+        return np.ascontiguousarray(truncated, dtype=np.float32), None
+
+    def scores(self, codes: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+        """正規化済みのクエリに対する全行の近似スコア"""
+        query = self.truncate(query[None, :])[0]
+        if self.quantization == QUANTIZATION_NONE:
+            return codes @ query
+
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), _SCORE_BLOCK_ROWS):
+            end = start + _SCORE_BLOCK_ROWS
+            if self.quantization == QUANTIZATION_INT8:
+                scores[start:end] = (codes[start:end].astype(np.float32) @ query) * scales[start:end]
+            else:
+                # クエリは量子化せず、各次元の符号（±1）との内積を取る
+                signs = np.unpackbits(codes[start:end], axis=1, count=len(query)).astype(np.float32)
+                scores[start:end] = signs @ (2 * query) - query.sum()
+        return scores
+
+    def nbytes(self, count: int, dimension: int) -> int:
+        """count行・dimension次元のベクトルを1段目用に保持するのに必要なバイト数"""
+        dimension = min(self.dimensions, dimension) if self.dimensions else dimension
+        if self.quantization == QUANTIZATION_INT8:
+            return count * (dimension + 4)
+        if self.quantization == QUANTIZATION_BINARY:
+            return count * ((dimension + 7) // 8)
+        return count * dimension * 4
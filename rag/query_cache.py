@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+from .embedding_cache import normalize_text
+
+
+def normalize_query(query: str) -> str:
+    """言い回しの揺れを吸収するためにクエリを正規化"""
+    return normalize_text(query).casefold().rstrip("?？。.!！ ")
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """件数上限付きのプロセス内TTL・LRUキャッシュ"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    async def aget(self, key: str):
+        return self.get(key)
+
+    async def aset(self, key: str, value):
+        self.set(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend:
+    """Djangoのキャッシュフレームワークを使うプロセス間共有のバックエンド"""
+
+    def __init__(self, alias: str, ttl: float):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key: str):
+        return self.cache.get(key)
+
+    def set(self, key: str, value):
+        self.cache.set(key, value, timeout=self.ttl)
+
+    def delete(self, key: str):
+        self.cache.delete(key)
+
+    async def aget(self, key: str):
+        return await self.cache.aget(key)
+
+    async def aset(self, key: str, value):
+        await self.cache.aset(key, value, timeout=self.ttl)
+
+    def clear(self):
+        # 共有キャッシュ全体を消すと他の用途に影響するため、TTLでの失効に任せる
+        pass
+
+
+class HydeCache:
+    """HyDEの2段キャッシュ
+
+    1段目は正規化したクエリ→仮想ドキュメント、2段目は仮想ドキュメント→エンベディング。
+    言い換えで仮想ドキュメントが同じになった場合も2段目でエンベディング呼び出しを省ける。
+    """
+
+    def __init__(self, backend, llm_name: str, embedding_name: str):
+        self.backend = backend
+        self.llm_name = llm_name
+        self.embedding_name = embedding_name
+
+    def get_hypothetical(self, query: str) -> Optional[str]:
+        return self.backend.get(self._hypothetical_key(query))
+
+    def set_hypothetical(self, query: str, document: str):
+        self.backend.set(self._hypothetical_key(query), document)
+
+    def get_embedding(self, text: str) -> Optional[List[float]]:
+        value = self.backend.get(self._embedding_key(text))
+        return None if value is None else array("f", value).tolist()
+
+    def set_embedding(self, text: str, embedding: List[float]):
+        # floatのリストより小さいfloat32のバイト列で保持する
+        self.backend.set(self._embedding_key(text), array("f", embedding).tobytes())
+
+    async def aget_hypothetical(self, query: str) -> Optional[str]:
+        return await self.backend.aget(self._hypothetical_key(query))
+
+    async def aset_hypothetical(self, query: str, document: str):
+        await self.backend.aset(self._hypothetical_key(query), document)
+
+    async def aget_embedding(self, text: str) -> Optional[List[float]]:
+        value = await self.backend.aget(self._embedding_key(text))
+        return None if value is None else array("f", value).tolist()
+
+    async def aset_embedding(self, text: str, embedding: List[float]):
+        await self.backend.aset(self._embedding_key(text), array("f", embedding).tobytes())
+
+    def clear(self):
+        self.backend.clear()
+
+    def _hypothetical_key(self, query: str) -> str:
+        return f"rag:hyde:doc:{_digest(self.llm_name, normalize_query(query))}"
+
+    def _embedding_key(self, text: str) -> str:
+        return f"rag:hyde:emb:{_digest(self.embedding_name, normalize_text(text))}"
@@ -0,0 +1,63 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from .metrics import REGISTRY
+
+# クエリの検索方法
+LEXICAL = "lexical"
+DIRECT = "direct"
+HYDE = "hyde"
+
+ROUTE_DECISIONS = REGISTRY.counter(
+    "rag_query_route_total", "クエリルーターが選んだ検索方法と理由ごとの件数", ("mode", "reason")
+)
+
+
+@dataclass
+class RouteDecision:
+    """クエリルーターの判断"""
+    # "lexical"（語彙検索のみ）・"direct"（クエリを直接エンベディング）・"hyde"
+    mode: str
+    # 判断の理由（"identifier"・"long_query"・"confident"・"low_score"・"disabled"）
+    reason: str
+    # 直接エンベディングでの1段目の検索の最高類似度
+    score: Optional[float] = None
+
+    def as_dict(self) -> dict:
+        return {"mode": self.mode, "reason": self.reason, "score": self.score}
+
+
+class QueryRouter:
+    """クエリごとに検索方法を選ぶ
+
+    型番などの識別子が語彙検索でそのまま見つかれば語彙検索だけで答える。
+    十分に長い質問はHyDEの仮想ドキュメントを作っても検索の精度が上がりにくいため直接エンベディングする。
+    短い質問はまず直接エンベディングで検索し、最上位の類似度がdirect_min_score以上ならその結果を使い、
+    足りなければHyDEで検索し直す。
+    """
+
+    def __init__(self, enabled: bool, direct_min_chars: int, direct_min_score: float):
+        self.enabled = enabled
+        self.direct_min_chars = direct_min_chars
+        self.direct_min_score = direct_min_score
+
+    def route(self, query: str, exact_match: bool) -> Optional[RouteDecision]:
+        """検索前に決められる場合は判断を返す（1段目の検索の類似度が必要ならNone）"""
+        if exact_match:
+            return RouteDecision(LEXICAL, "identifier")
+        if not self.enabled:
+            return RouteDecision(HYDE, "disabled")
+        if len("".join(query.split())) >= self.direct_min_chars:
+            return RouteDecision(DIRECT, "long_query")
+        return None
+
+    def route_by_score(self, score: Optional[float]) -> RouteDecision:
+        """直接エンベディングでの検索の最高類似度から判断"""
+        if score is not None and score >= self.direct_min_score:
+            return RouteDecision(DIRECT, "confident", score)
+        return RouteDecision(HYDE, "low_score", score)
+
+
+def record_route(decision: RouteDecision):
+    """ルーターの判断をメトリクスに記録"""
+    ROUTE_DECISIONS.inc(mode=decision.mode, reason=decision.reason)
@@ -1,29 +1,318 @@
+import hashlib
+import importlib
+import logging
+import os
 import re
-import shutil
-from typing import List
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
 
-import chromadb
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from langchain.chains.hyde.base import HypotheticalDocumentEmbedder
-from langchain.schema import Document as LangChainDocument
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from django.db import close_old_connections
+from langchain_core.documents import Document as LangChainDocument
 
+from .answer_cache import AnswerCache
+from .backends import ChromaBackend, UserVectorStore, VectorStoreBackend
+from .context import ContextBuilder
+from .conversation import ChatHistory, condense_prompt, summary_prompt
+from .embedding_cache import EmbeddingCache
+from .embedding_scheduler import EmbeddingScheduler, RateLimiter
+from .gateway import ModelGateway, ModelUnavailableError
+from .lexical import (
+    LexicalIndexStore,
+    contains_identifier,
+    extract_identifiers,
+    reciprocal_rank_fusion,
+)
+from .markdown import MarkdownChunker
+from .metrics import count_items, timed
+from .models import CorpusVersion
+from .query_cache import DjangoCacheBackend, HydeCache, TTLCache
+from .router import DIRECT, HYDE, LEXICAL, QueryRouter, RouteDecision, record_route
+
+# chromadb・LangChainのチェーン・Geminiクライアントはimportに数秒かかるため、
+# URLの読み込みやmigrateなどで読み込まないよう、使う関数の中でimportする（rag_warmupで事前に読み込める）
+if TYPE_CHECKING:
+    from .gateway_models import GatewayChatModel, GatewayEmbeddings
+    from .pool import VectorStorePool
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "models/text-embedding-004"
+CHAT_MODEL = "gemini-2.0-flash-exp"
+# チャンクの文字数と、隣接チャンクとの重なりの文字数
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# モデルが障害中・混雑中でゲートウェイが呼び出しを断った場合の回答
+MODEL_UNAVAILABLE_MESSAGE = "現在AIモデルが混み合っているため回答を生成できませんでした。しばらくしてから再度お試しください。"
+
+
+@lru_cache(maxsize=None)
+def get_model_gateway(name: str, max_concurrency: int) -> ModelGateway:
+    """プロセス内で共有するモデルごとのゲートウェイを取得"""
+    return ModelGateway(
+        name,
+        max_concurrency=max_concurrency,
+        max_retries=settings.MODEL_GATEWAY_MAX_RETRIES,
+        backoff_base=settings.MODEL_GATEWAY_BACKOFF_BASE,
+        backoff_max=settings.MODEL_GATEWAY_BACKOFF_MAX,
+        failure_threshold=settings.MODEL_GATEWAY_FAILURE_THRESHOLD,
+        reset_timeout=settings.MODEL_GATEWAY_RESET_TIMEOUT,
+        acquire_timeout=settings.MODEL_GATEWAY_ACQUIRE_TIMEOUT,
+    )
 
-class DocumentProcessor:
-    """ドキュメント処理クラス"""
 
-    def __init__(self):
-        self.embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/text-embedding-004", google_api_key=settings.GEMINI_API_KEY
+@lru_cache(maxsize=None)
+def get_embeddings() -> "GatewayEmbeddings":
+    """プロセス内で共有するエンベディングクライアントを取得（呼び出しはModelGatewayを通す）"""
+    from .gateway_models import GatewayEmbeddings
+
+    if settings.FAKE_MODEL_SERVER_URL:
+        from .fakes import FakeServerEmbeddings
+
+        embeddings = FakeServerEmbeddings(settings.FAKE_MODEL_SERVER_URL)
+    else:
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+        embeddings = GoogleGenerativeAIEmbeddings(
+            model=EMBEDDING_MODEL, google_api_key=settings.GEMINI_API_KEY
         )
+    return GatewayEmbeddings(
+        embeddings, get_model_gateway(EMBEDDING_MODEL, settings.MODEL_GATEWAY_EMBEDDING_CONCURRENCY)
+    )
+
+
+@lru_cache(maxsize=None)
+def get_llm() -> "GatewayChatModel":
+    """プロセス内で共有するLLMクライアントを取得（呼び出しはModelGatewayを通す）"""
+    from .gateway_models import GatewayChatModel
+
+    if settings.FAKE_MODEL_SERVER_URL:
+        from .fakes import FakeServerChatModel
+
+        model = FakeServerChatModel(base_url=settings.FAKE_MODEL_SERVER_URL)
+    else:
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        model = ChatGoogleGenerativeAI(
+            model=CHAT_MODEL,
+            google_api_key=settings.GEMINI_API_KEY,
+            temperature=0.1,
+        )
+    return GatewayChatModel(
+        model=model, gateway=get_model_gateway(CHAT_MODEL, settings.MODEL_GATEWAY_CHAT_CONCURRENCY)
+    )
+
+
+def build_embedding_scheduler(embeddings) -> EmbeddingScheduler:
+    """設定に従ったエンベディングスケジューラを作成"""
+    return EmbeddingScheduler(
+        embeddings,
+        batch_size=settings.EMBEDDING_BATCH_SIZE,
+        max_concurrency=settings.EMBEDDING_MAX_CONCURRENCY,
+        limiter=RateLimiter(
+            requests_per_minute=settings.EMBEDDING_REQUESTS_PER_MINUTE,
+            tokens_per_minute=settings.EMBEDDING_TOKENS_PER_MINUTE,
+        ),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_embedding_scheduler() -> EmbeddingScheduler:
+    """プロセス内で共有するエンベディングスケジューラを取得"""
+    # 429はスケジューラがレートを落として再試行するため、ゲートウェイでは再試行しない
+    return build_embedding_scheduler(get_embeddings().without_rate_limit_retries())
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """プロセス内で共有するエンベディングキャッシュを取得（無効な場合はNone）"""
+    if not settings.EMBEDDING_CACHE_PATH:
+        return None
+    return EmbeddingCache(
+        settings.EMBEDDING_CACHE_PATH,
+        model_name=EMBEDDING_MODEL,
+        max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_hyde_cache() -> HydeCache:
+    """プロセス内で共有するHyDEキャッシュを取得"""
+    if settings.HYDE_CACHE_BACKEND:
+        backend = DjangoCacheBackend(settings.HYDE_CACHE_BACKEND, ttl=settings.HYDE_CACHE_TTL)
+    else:
+        backend = TTLCache(settings.HYDE_CACHE_MAX_ENTRIES, ttl=settings.HYDE_CACHE_TTL)
+    return HydeCache(backend, llm_name=CHAT_MODEL, embedding_name=EMBEDDING_MODEL)
+
+
+@lru_cache(maxsize=None)
+def get_answer_cache() -> Optional[AnswerCache]:
+    """プロセス内で共有する回答キャッシュを取得（無効な場合はNone）"""
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    return AnswerCache(
+        max_users=settings.ANSWER_CACHE_MAX_USERS,
+        max_entries_per_user=settings.ANSWER_CACHE_MAX_ENTRIES_PER_USER,
+        ttl=settings.ANSWER_CACHE_TTL,
+        similarity_threshold=settings.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+    )
+
+
+def build_vectorstore_pool(embeddings) -> "VectorStorePool":
+    """設定に従ったベクトルストアプールを作成"""
+    from .pool import VectorStorePool
+
+    return VectorStorePool(
+        embeddings,
+        max_size=settings.RAG_VECTORSTORE_POOL_SIZE,
+        mode=settings.RAG_VECTORSTORE_MODE,
+        shards=settings.RAG_VECTORSTORE_SHARDS,
+    )
+
+
+def build_vectorstore_backend(embeddings) -> VectorStoreBackend:
+    """設定に従ったベクトルストアのバックエンドを作成"""
+    from .numpy_backend import NumpyBackend
+    from .quantization import VectorCompression
+
+    compression = VectorCompression(
+        dimensions=settings.RAG_VECTOR_DIMENSIONS,
+        quantization=settings.RAG_VECTOR_QUANTIZATION,
+        rerank_candidates=settings.RAG_RERANK_CANDIDATES,
+    )
+    if settings.RAG_VECTORSTORE_BACKEND == "numpy":
+        return NumpyBackend(
+            settings.NUMPY_INDEX_DIRECTORY, max_size=settings.RAG_VECTORSTORE_POOL_SIZE, compression=compression
+        )
+    if settings.RAG_VECTORSTORE_BACKEND == "chroma":
+        if compression.enabled:
+            # ChromaのHNSWインデックスは全精度のfloat32しか扱えないため
+            logger.warning("ベクトルの切り詰め・量子化はnumpyバックエンドでのみ有効です")
+        return ChromaBackend(build_vectorstore_pool(embeddings))
+    raise ValueError(f"不明なベクトルストアのバックエンドです: {settings.RAG_VECTORSTORE_BACKEND}")
+
+
+@lru_cache(maxsize=None)
+def get_vectorstore_backend() -> VectorStoreBackend:
+    """プロセス内で共有するベクトルストアのバックエンドを取得"""
+    return build_vectorstore_backend(get_embeddings())
+
+
+@lru_cache(maxsize=None)
+def get_lexical_index_store() -> Optional[LexicalIndexStore]:
+    """語彙検索インデックスの保存先を取得（無効な場合はNone）"""
+    if not settings.LEXICAL_INDEX_DIRECTORY:
+        return None
+    return LexicalIndexStore(settings.LEXICAL_INDEX_DIRECTORY)
+
+
+@lru_cache(maxsize=None)
+def get_blocking_executor() -> ThreadPoolExecutor:
+    """非同期ビューからブロッキング処理（Chromaなど）を逃がすスレッドプールを取得"""
+    return ThreadPoolExecutor(
+        max_workers=settings.RAG_BLOCKING_THREADS, thread_name_prefix="rag-blocking"
+    )
+
+
+def _call_closing_connections(func):
+    # プールのスレッドは使い回されるため、ORMを使う処理（CorpusVersionの参照など）の前後で
+    # リクエストの終了時と同じように古くなったDB接続を閉じる
+    close_old_connections()
+    try:
+        return func()
+    finally:
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """ブロッキング処理を上限付きスレッドプールで実行して待つ"""
+    return await sync_to_async(
+        _call_closing_connections, thread_sensitive=False, executor=get_blocking_executor()
+    )(partial(func, *args, **kwargs))
+
+
+@lru_cache(maxsize=None)
+def get_document_processor() -> "DocumentProcessor":
+    """プロセス内で共有するDocumentProcessorを取得"""
+    return DocumentProcessor()
+
+
+@lru_cache(maxsize=None)
+def get_rag_service() -> "RAGService":
+    """プロセス内で共有するRAGServiceを取得"""
+    return RAGService()
+
+
+def warm_up(user_ids: Sequence[str] = ()) -> Dict[str, float]:
+    """重いモジュールの読み込みと共有クライアントの作成を前もって行い、段階ごとの所要秒数を返す
+
+    user_idsを指定すると、そのユーザーのベクトルストアも開いておく。
+    """
+    steps = [
+        ("embeddings", get_embeddings),
+        ("llm", get_llm),
+        ("vectorstore_backend", get_vectorstore_backend),
+        ("rag_service", get_rag_service),
+        ("document_processor", get_document_processor),
+    ]
+    if settings.RAG_MARKDOWN_LOADER == "unstructured":
+        # UnstructuredMarkdownLoaderは読み込み時にunstructuredの分割処理をimportする
+        steps.append(("markdown_loader", partial(importlib.import_module, "unstructured.partition.md")))
+
+    def open_stores():
+        backend = get_vectorstore_backend()
+        for user_id in user_ids:
+            with backend.open(str(user_id)):
+                pass
+
+    if user_ids:
+        steps.append(("vectorstores", open_stores))
+
+    timings = {}
+    for name, step in steps:
+        started = time.perf_counter()
+        step()
+        timings[name] = time.perf_counter() - started
+    return timings
+
+
+class DocumentParser:
+    """ドキュメントの読み込み・クリーニング・チャンク化（エンベディングや保存先を持たない）
+
+    APIクライアントやベクトルストアを作らないため、別プロセスでの並列な解析にも使える。
+    """
+
+    def load_chunks(self, file_path: str, user_id: str, document_id: str) -> List[LangChainDocument]:
+        """マークダウンファイルを読み込んでチャンク化（読み込み方法はRAG_MARKDOWN_LOADERで選ぶ）"""
+        if settings.RAG_MARKDOWN_LOADER == "streaming":
+            # 読み込み・クリーニング・分割を1回の走査で行うため、まとめてsplitとして計測する
+            with timed("split"):
+                chunks = MarkdownChunker(CHUNK_SIZE, CHUNK_OVERLAP).chunk_file(
+                    file_path, {"user_id": user_id, "document_id": document_id}
+                )
+            for index, chunk in enumerate(chunks):
+                chunk.metadata["chunk_index"] = index
+            count_items("split", len(chunks))
+            return chunks
+        if settings.RAG_MARKDOWN_LOADER == "unstructured":
+            chunks = self.chunk_documents(self.load_document(file_path), user_id, document_id)
+            count_items("split", len(chunks))
+            return chunks
+        raise ValueError(f"不明なMarkdownの読み込み方法です: {settings.RAG_MARKDOWN_LOADER}")
 
     def load_document(self, file_path: str) -> List[LangChainDocument]:
         """マークダウンファイルを読み込み"""
-        loader = UnstructuredMarkdownLoader(file_path)
-        documents = loader.load()
+        # unstructuredは読み込みが重いため、使う場合だけimportする
+        from langchain_community.document_loaders import UnstructuredMarkdownLoader
+
+        with timed("load"):
+            loader = UnstructuredMarkdownLoader(file_path)
+            documents = loader.load()
         return documents
 
     def clean_text(self, text: str) -> str:
@@ -40,9 +329,11 @@ class DocumentProcessor:
         self, documents: List[LangChainDocument], user_id: str, document_id: str
     ) -> List[LangChainDocument]:
         """日本語に特化したセマンティックチャンク化"""
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+
         text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
             length_function=len,
             separators=["\n\n", "\n", "。", "、", " ", ""],
         )
@@ -50,132 +341,840 @@ class DocumentProcessor:
         chunks = []
         for doc in documents:
             # テキストをクリーニング
-            cleaned_text = self.clean_text(doc.page_content)
+            with timed("clean"):
+                cleaned_text = self.clean_text(doc.page_content)
 
             # チャンク化
-            chunk_docs = text_splitter.create_documents(
-                [cleaned_text],
-                metadatas=[
-                    {
-                        **doc.metadata,
-                        "user_id": user_id,
-                        "document_id": document_id,
-                        "source": doc.metadata.get("source", ""),
-                    }
-                ],
-            )
+            with timed("split"):
+                chunk_docs = text_splitter.create_documents(
+                    [cleaned_text],
+                    metadatas=[
+                        {
+                            **doc.metadata,
+                            "user_id": user_id,
+                            "document_id": document_id,
+                            "source": doc.metadata.get("source", ""),
+                        }
+                    ],
+                )
             chunks.extend(chunk_docs)
 
+        # ドキュメント内の位置を記録（差分更新時に順序だけ変わったチャンクの更新に使う）
+        for index, chunk in enumerate(chunks):
+            chunk.metadata["chunk_index"] = index
+
         return chunks
 
-    def store_documents(self, chunks: List[LangChainDocument], user_id: str):
+
+class DocumentProcessor(DocumentParser):
+    """ドキュメント処理クラス"""
+
+    def __init__(
+        self,
+        embeddings=None,
+        backend: Optional[VectorStoreBackend] = None,
+        embedding_scheduler: Optional[EmbeddingScheduler] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        lexical_store: Optional[LexicalIndexStore] = None,
+    ):
+        self.embeddings = embeddings or get_embeddings()
+        if backend is None:
+            backend = get_vectorstore_backend() if embeddings is None else build_vectorstore_backend(self.embeddings)
+        self.backend = backend
+        self.lexical_store = lexical_store or get_lexical_index_store()
+        if embedding_scheduler is None:
+            embedding_scheduler = (
+                get_embedding_scheduler() if embeddings is None else build_embedding_scheduler(embeddings)
+            )
+        self.embedding_scheduler = embedding_scheduler
+        # エンベディングを差し替えた場合、モデルが異なるため共有キャッシュは使わない
+        if embedding_cache is None and embeddings is None:
+            embedding_cache = get_embedding_cache()
+        self.embedding_cache = embedding_cache
+
+    def chunk_ids(self, chunks: List[LangChainDocument], document_id: str) -> List[str]:
+        """チャンク内容のハッシュからIDを作成（同じ内容の重複は出現順で区別）"""
+        seen: Dict[str, int] = {}
+        ids = []
+        for chunk in chunks:
+            digest = hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()[:32]
+            occurrence = seen.get(digest, 0)
+            seen[digest] = occurrence + 1
+            ids.append(f"{document_id}_{digest}" if occurrence == 0 else f"{document_id}_{digest}_{occurrence}")
+        return ids
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """キャッシュを参照し、未キャッシュのテキストだけをエンベディング"""
+        if self.embedding_cache is None:
+            return self._embed_documents(texts)
+
+        vectors = self.embedding_cache.get_many(texts)
+        # 同じテキストが複数回出てきても1回だけエンベディングする
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            new_vectors = self._embed_documents(missing)
+            self.embedding_cache.put_many(missing, new_vectors)
+            embedded = dict(zip(missing, new_vectors))
+            vectors = [
+                vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors)
+            ]
+        return vectors
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        with timed("embed"):
+            vectors = self.embedding_scheduler.embed_documents(texts)
+        count_items("embed", len(texts))
+        return vectors
+
+    def store_documents(
+        self, chunks: List[LangChainDocument], user_id: str, ids: Optional[List[str]] = None
+    ):
         """ベクトルストアにドキュメントを保存"""
-        persist_directory = settings.CHROMA_PERSIST_DIRECTORY / f"user_{user_id}"
-        persist_directory.mkdir(parents=True, exist_ok=True)
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in chunks]
+        vectors = self.embed_texts([chunk.page_content for chunk in chunks])
 
-        vectorstore = Chroma(
-            persist_directory=str(persist_directory),
-            embedding_function=self.embeddings,
-            collection_name=f"documents_{user_id}",
-        )
+        with timed("store"), self.backend.open(user_id, create=True, version=CorpusVersion.current(user_id)) as store:
+            store.upsert(ids, chunks, vectors)
+            if self.lexical_store is not None:
+                self.lexical_store.for_user(user_id).upsert(ids, chunks)
+            self._bump_version(store, user_id)
+        count_items("store", len(chunks))
+
+    def replace_document_chunks(self, chunks: List[LangChainDocument], user_id: str, document_id: str):
+        """ドキュメントの既存チャンクとの差分だけを反映して保存（再実行しても結果は同じ）"""
+        result = self.sync_document_chunks([(user_id, document_id, chunks)])[document_id]
+        if isinstance(result, Exception):
+            raise result
+
+    def ingest_document(self, file_path: str, user_id: str, document_id: str) -> int:
+        """ドキュメントを読み込み・チャンク化してベクトルストアに保存し、チャンク数を返す"""
+        result = self.ingest_documents([(file_path, user_id, document_id)])[document_id]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def ingest_documents(self, items: List[Tuple[str, str, str]]) -> Dict[str, object]:
+        """複数ドキュメントを読み込み・チャンク化してまとめてベクトルストアに保存
+
+        itemsは(file_path, user_id, document_id)のリスト。
+        ドキュメントIDごとにチャンク数、または失敗時の例外を返す。
+        """
+        results: Dict[str, object] = {}
+        prepared = []
+        for file_path, user_id, document_id in items:
+            try:
+                chunks = self.load_chunks(file_path, user_id, document_id)
+                prepared.append((user_id, document_id, chunks))
+            except Exception as e:
+                results[document_id] = e
+
+        results.update(self.sync_document_chunks(prepared))
+        return results
+
+    def sync_document_chunks(self, items: List[Tuple[str, str, List[LangChainDocument]]]) -> Dict[str, object]:
+        """ドキュメントのチャンクを保存済みのチャンクと比較し、差分だけを反映
+
+        itemsは(user_id, document_id, chunks)のリスト。内容が変わらないチャンクは
+        エンベディングも書き込みもせず、消えたチャンクの削除と新しいチャンクの追加だけを行う。
+        ドキュメントIDごとにチャンク数、または失敗時の例外を返す。
+        """
+        results: Dict[str, object] = {}
+        by_user: Dict[str, Dict[str, tuple]] = {}
+        for user_id, document_id, chunks in items:
+            by_user.setdefault(user_id, {})[document_id] = (chunks, self.chunk_ids(chunks, document_id))
+
+        # 既に保存されているチャンクIDを取得し、エンベディングが必要なチャンクを集める
+        pending = []
+        for user_id, documents in list(by_user.items()):
+            try:
+                existing = self._existing_chunk_ids(user_id, list(documents))
+            except Exception as e:
+                for document_id in by_user.pop(user_id):
+                    results[document_id] = e
+                continue
+            for document_id, (chunks, ids) in documents.items():
+                documents[document_id] = (chunks, ids, existing.get(document_id, set()))
+                pending.extend(
+                    chunk for chunk, chunk_id in zip(chunks, ids) if chunk_id not in documents[document_id][2]
+                )
+
+        # ファイルをまたいで新しいチャンクだけをまとめてエンベディングする
+        try:
+            vectors = self.embed_texts([chunk.page_content for chunk in pending])
+        except Exception as e:
+            for documents in by_user.values():
+                for document_id in documents:
+                    results[document_id] = e
+            return results
+        embedded = {id(chunk): vector for chunk, vector in zip(pending, vectors)}
+
+        for user_id, documents in by_user.items():
+            try:
+                self._apply_chunk_diff(user_id, documents, embedded)
+            except Exception as e:
+                for document_id in documents:
+                    results[document_id] = e
+            else:
+                for document_id, (chunks, _, _) in documents.items():
+                    results[document_id] = len(chunks)
+        return results
+
+    def copy_document_chunks(
+        self, user_id: str, source_document_id: str, document_id: str, source: Optional[str] = None
+    ) -> int:
+        """同じ内容のドキュメントの保存済みチャンクとエンベディングを複製し、チャンク数を返す
+
+        読み込み・エンベディングは行わない。document_idに既存のチャンクがあれば置き換える。
+        """
+        lexical = self.lexical_store.for_user(user_id) if self.lexical_store is not None else None
+        with timed("store"), self.backend.open(user_id, create=True, version=CorpusVersion.current(user_id)) as store:
+            chunks, vectors = store.get_document_chunks(source_document_id)
+            if not chunks:
+                raise ValueError(f"複製元のドキュメントのチャンクがありません: {source_document_id}")
+
+            copies = []
+            for chunk in chunks:
+                metadata = {**chunk.metadata, "document_id": document_id}
+                if source is not None:
+                    metadata["source"] = source
+                copies.append(LangChainDocument(page_content=chunk.page_content, metadata=metadata))
+            ids = self.chunk_ids(copies, document_id)
+
+            store.delete_documents([document_id])
+            store.upsert(ids, copies, vectors)
+            if lexical is not None:
+                lexical.delete_documents([document_id])
+                lexical.upsert(ids, copies)
+            self._bump_version(store, user_id)
+        count_items("store", len(copies))
+        return len(copies)
+
+    def _existing_chunk_ids(self, user_id: str, document_ids: List[str]) -> Dict[str, set]:
+        """ドキュメントごとの保存済みチャンクIDを取得"""
+        with self.backend.open(user_id, version=CorpusVersion.current(user_id)) as store:
+            if store is None:
+                return {}
+            return store.get_chunk_ids(document_ids)
+
+    def _apply_chunk_diff(self, user_id: str, documents: Dict[str, tuple], embedded: Dict[int, List[float]]):
+        """差分（削除・追加・位置の更新）をベクトルストアに反映"""
+        lexical = self.lexical_store.for_user(user_id) if self.lexical_store is not None else None
+        with timed("store"), self.backend.open(user_id, create=True, version=CorpusVersion.current(user_id)) as store:
+            changed = False
+            for document_id, (chunks, ids, existing) in documents.items():
+                removed = existing - set(ids)
+                if removed:
+                    store.delete(list(removed))
+                    if lexical is not None:
+                        lexical.delete(list(removed))
 
-        vectorstore.add_documents(chunks)
-        return vectorstore
+                added = [(chunk_id, chunk) for chunk_id, chunk in zip(ids, chunks) if chunk_id not in existing]
+                if added:
+                    store.upsert(
+                        [chunk_id for chunk_id, _ in added],
+                        [chunk for _, chunk in added],
+                        [embedded[id(chunk)] for _, chunk in added],
+                    )
+                    if lexical is not None:
+                        lexical.upsert([chunk_id for chunk_id, _ in added], [chunk for _, chunk in added])
+
+                # 内容が同じで位置だけ変わったチャンクはメタデータのみ更新
+                kept = [(chunk_id, chunk) for chunk_id, chunk in zip(ids, chunks) if chunk_id in existing]
+                if kept:
+                    store.update_metadata([chunk_id for chunk_id, _ in kept], [chunk for _, chunk in kept])
+                    if lexical is not None:
+                        lexical.update_metadata([chunk_id for chunk_id, _ in kept], [chunk for _, chunk in kept])
+
+                logger.info(
+                    "チャンクを差分更新しました: document=%s 追加=%d 削除=%d 維持=%d",
+                    document_id, len(added), len(removed), len(kept),
+                )
+                changed = changed or bool(added or removed)
+                count_items("store", len(added))
+
+            # 内容に変化が無ければ回答キャッシュなどを無効にしないようバージョンを据え置く
+            if changed:
+                self._bump_version(store, user_id)
+            else:
+                store.commit()
+
+    def _bump_version(self, store: UserVectorStore, user_id: str):
+        """書き込みを確定してからコーパスバージョンを進める"""
+        store.commit()
+        store.advance_version(CorpusVersion.bump(user_id))
 
     def delete_document_from_vectorstore(self, user_id: str, document_id: str):
         """ベクトルストアから特定のドキュメントを削除"""
-        persist_directory = settings.CHROMA_PERSIST_DIRECTORY / f"user_{user_id}"
+        self.delete_documents_from_vectorstore(user_id, [document_id])
+
+    def delete_documents_from_vectorstore(self, user_id: str, document_ids: List[str]) -> bool:
+        """ベクトルストアから複数のドキュメントをまとめて削除し、削除したかを返す
+
+        空になった場合はユーザーのストアごと削除する。
+        """
+        if not document_ids:
+            return False
+
+        with self.backend.open(user_id, version=CorpusVersion.current(user_id)) as store:
+            if store is None:
+                return False
+
+            deleted = store.delete_documents(list(document_ids))
+            if self.lexical_store is not None:
+                self.lexical_store.for_user(user_id).delete_documents(list(document_ids))
+
+            if not deleted:
+                return False
+            if not store.is_empty():
+                self._bump_version(store, user_id)
+                return True
+            store.commit()
+
+        # 空になった場合、ハンドルを破棄してストアごと削除
+        self.backend.discard(user_id)
+        if self.lexical_store is not None:
+            self.lexical_store.for_user(user_id).drop()
+        CorpusVersion.bump(user_id)
+        return True
+
+
+@dataclass
+class ChatResult:
+    """チャットの回答と付随情報"""
+    response: str
+    # 回答キャッシュに一致した場合の種類（"exact"・"semantic"）
+    cache_hit: Optional[str] = None
+    sources: List[dict] = field(default_factory=list)
+    # クエリルーターが選んだ検索方法（"lexical"・"direct"・"hyde"、検索しなかった場合はNone）
+    route: Optional[str] = None
+    # 会話の履歴を踏まえて書き換えた検索用の質問（書き換えなかった場合はNone）
+    retrieval_query: Optional[str] = None
+    # 回答の生成に失敗した場合（会話の履歴には残さない）
+    failed: bool = False
+    # モデルが障害中・混雑中で回答できなかった場合の、再試行までの目安の秒数
+    retry_after: Optional[float] = None
 
-        client = chromadb.PersistentClient(path=str(persist_directory))
-        collection_name = f"documents_{user_id}"
-        collection = client.get_collection(collection_name)
 
-        # 指定されたドキュメントIDのデータを取得
-        results = collection.get(where={"document_id": document_id})
+@dataclass
+class PreparedAnswer:
+    """LLM呼び出し前までの準備結果（resultがあればLLMを呼ばずにそれを返す）"""
+    result: Optional[ChatResult] = None
+    prompt: str = ""
+    sources: List[dict] = field(default_factory=list)
+    version: int = 0
+    query_embedding: Optional[List[float]] = None
+    route: Optional[str] = None
+    retrieval_query: Optional[str] = None
+    # 会話の履歴に依存する回答は回答キャッシュに入れない
+    cacheable: bool = True
 
-        if results["ids"]:
-            # 指定されたドキュメントを削除
-            collection.delete(ids=results["ids"])
 
-            # 削除後にコレクションが空かどうかを確認
-            remaining_data = collection.get()
-            if not remaining_data["ids"]:
-                # コレクションが空の場合、コレクションを削除
-                client.delete_collection(collection_name)
+def summarize_sources(documents: List[LangChainDocument]) -> List[dict]:
+    """検索結果の出典をドキュメント単位でまとめる"""
+    sources = {}
+    for doc in documents:
+        document_id = doc.metadata.get("document_id", "")
+        if document_id not in sources:
+            sources[document_id] = {
+                "document_id": document_id,
+                "source": os.path.basename(doc.metadata.get("source", "")),
+            }
+    return list(sources.values())
 
-                # コレクションのUUIDディレクトリを削除
-                for item in persist_directory.iterdir():
-                    if item.is_dir() and len(item.name) == 36:  # UUIDの長さは36文字
-                        shutil.rmtree(item)
+
+def select_relevant(
+    scored: List[Tuple[LangChainDocument, float]], min_score: float, max_gap: float
+) -> List[LangChainDocument]:
+    """類似度がmin_score以上で、最上位との差がmax_gap以内のチャンク（0の条件は使わない）"""
+    if not scored:
+        return []
+    floor = min_score if min_score > 0 else float("-inf")
+    if max_gap > 0:
+        floor = max(floor, scored[0][1] - max_gap)
+    return [doc for doc, score in scored if score >= floor]
 
 
 class RAGService:
     """RAGサービスクラス"""
 
-    def __init__(self):
-        self.embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/text-embedding-004", google_api_key=settings.GEMINI_API_KEY
+    def __init__(
+        self,
+        embeddings=None,
+        llm=None,
+        backend: Optional[VectorStoreBackend] = None,
+        hyde_cache: Optional[HydeCache] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        lexical_store: Optional[LexicalIndexStore] = None,
+        context_builder: Optional[ContextBuilder] = None,
+        router: Optional[QueryRouter] = None,
+    ):
+        self.embeddings = embeddings or get_embeddings()
+        self.llm = llm or get_llm()
+        self.context_builder = context_builder or ContextBuilder(
+            settings.RAG_CONTEXT_MAX_TOKENS, max_overlap=CHUNK_OVERLAP
         )
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp",
-            google_api_key=settings.GEMINI_API_KEY,
-            temperature=0.1,
+        if backend is None:
+            backend = get_vectorstore_backend() if embeddings is None else build_vectorstore_backend(self.embeddings)
+        self.backend = backend
+        self.lexical_store = lexical_store or get_lexical_index_store()
+        # モデルを差し替えた場合は共有キャッシュを使わない
+        if hyde_cache is None:
+            if embeddings is None and llm is None:
+                hyde_cache = get_hyde_cache()
+            else:
+                hyde_cache = HydeCache(
+                    TTLCache(settings.HYDE_CACHE_MAX_ENTRIES, ttl=settings.HYDE_CACHE_TTL),
+                    llm_name=repr(self.llm),
+                    embedding_name=repr(self.embeddings),
+                )
+        self.hyde_cache = hyde_cache
+        if answer_cache is None and embeddings is None and llm is None:
+            answer_cache = get_answer_cache()
+        self.answer_cache = answer_cache
+        self.router = router or QueryRouter(
+            settings.RAG_QUERY_ROUTER, settings.RAG_ROUTER_DIRECT_MIN_CHARS, settings.RAG_ROUTER_DIRECT_MIN_SCORE
         )
 
-    def get_retriever(self, user_id: str):
-        """ユーザー専用のリトリーバーを取得"""
-        persist_directory = settings.CHROMA_PERSIST_DIRECTORY / f"user_{user_id}"
-
-        if not persist_directory.exists():
-            # ベクトルストアが存在しない場合はNoneを返す
-            return None
+        from langchain.chains.hyde.base import HypotheticalDocumentEmbedder
 
-        # HypotheticalDocumentEmbedderを作成
-        hyde_embeddings = HypotheticalDocumentEmbedder.from_llm(
+        # HypotheticalDocumentEmbedderはクエリごとに作らず使い回す
+        self.hyde_embeddings = HypotheticalDocumentEmbedder.from_llm(
             llm=self.llm, base_embeddings=self.embeddings, prompt_key="web_search"
         )
 
-        # HyDEエンベディングを使用してベクトルストアを作成
-        vectorstore = Chroma(
-            persist_directory=str(persist_directory),
-            embedding_function=hyde_embeddings,
-            collection_name=f"documents_{user_id}",
-        )
+    def embed_query(self, query: str) -> List[float]:
+        """HyDEでクエリをベクトル化（仮想ドキュメントとエンベディングをキャッシュ）"""
+        hypothetical = self.hyde_cache.get_hypothetical(query)
+        if hypothetical is None:
+            with timed("hyde"):
+                hypothetical = self.hyde_embeddings.llm_chain.invoke({"QUESTION": query})
+            self.hyde_cache.set_hypothetical(query, hypothetical)
+
+        embedding = self.hyde_cache.get_embedding(hypothetical)
+        if embedding is None:
+            with timed("query_embed"):
+                embedding = self.hyde_embeddings.embed_documents([hypothetical])[0]
+            self.hyde_cache.set_embedding(hypothetical, embedding)
+        return embedding
+
+    async def aembed_query(self, query: str) -> List[float]:
+        """HyDEでクエリをベクトル化（非同期）"""
+        hypothetical = await self.hyde_cache.aget_hypothetical(query)
+        if hypothetical is None:
+            with timed("hyde"):
+                hypothetical = await self.hyde_embeddings.llm_chain.ainvoke({"QUESTION": query})
+            await self.hyde_cache.aset_hypothetical(query, hypothetical)
 
-        # 標準のリトリーバーを返す
-        return vectorstore.as_retriever(search_kwargs={"k": 5})
+        embedding = await self.hyde_cache.aget_embedding(hypothetical)
+        if embedding is None:
+            with timed("query_embed"):
+                vectors = await run_blocking(self.hyde_embeddings.embed_documents, [hypothetical])
+            embedding = vectors[0]
+            await self.hyde_cache.aset_embedding(hypothetical, embedding)
+        return embedding
+
+    def retrieve(
+        self, query: str, user_id: str, version: Optional[int] = None
+    ) -> Optional[List[LangChainDocument]]:
+        """ユーザーのベクトルストアから関連ドキュメントを検索（ストアが無い場合はNone）
+
+        語彙検索が有効な場合はベクトル検索の結果とRRFで統合する。
+        ベクトル検索の類似度がRAG_MIN_SIMILARITY未満、または最上位からRAG_SCORE_GAPより
+        下がったチャンクは除き、残った件数（最大RAG_RETRIEVAL_K件）だけを返す。
+        検索方法はクエリルーターが選ぶ（route_and_retrieveを参照）。
+        """
+        documents, _ = self.route_and_retrieve(query, user_id, version=version)
+        return documents
+
+    def route_and_retrieve(
+        self,
+        query: str,
+        user_id: str,
+        version: Optional[int] = None,
+        query_embedding: Optional[List[float]] = None,
+    ) -> Tuple[Optional[List[LangChainDocument]], Optional[RouteDecision]]:
+        """クエリルーターが選んだ方法で検索し、結果と判断を返す
+
+        型番などの識別子を含むクエリが語彙検索でそのまま見つかった場合は、
+        HyDE・エンベディングを呼ばずに語彙検索の結果を返す。
+        それ以外は直接エンベディングで検索し、長い質問か類似度が十分な場合はその結果を、
+        そうでなければHyDEで検索し直した結果を使う。
+        query_embeddingにクエリを直接エンベディングしたベクトルがあれば使い回す。
+        """
+        if version is None:
+            version = CorpusVersion.current(user_id)
+        if not self.backend.exists(user_id):
+            # ベクトルストアが存在しない場合はNoneを返す
+            return None, None
+
+        lexical_docs = self._search_lexical(query, user_id)
+        exact_docs = self._exact_matches(query, lexical_docs)
+        decision = self.router.route(query, bool(exact_docs))
+        if decision is not None and decision.mode == LEXICAL:
+            return self._routed(exact_docs, decision)
+
+        scored = None
+        if decision is None or decision.mode == DIRECT:
+            if query_embedding is None:
+                with timed("query_embed"):
+                    query_embedding = self.embeddings.embed_query(query)
+            scored = self._search_by_vector(user_id, version, query_embedding)
+            if decision is None and scored is not None:
+                decision = self.router.route_by_score(scored[0][1] if scored else None)
+
+        if decision is not None and decision.mode == HYDE:
+            # HyDEエンベディングでクエリをベクトル化して検索
+            scored = self._search_by_vector(user_id, version, self.embed_query(query))
+        return self._routed(self._fuse(scored, lexical_docs), decision)
+
+    async def aretrieve(
+        self, query: str, user_id: str, version: Optional[int] = None
+    ) -> Optional[List[LangChainDocument]]:
+        """retrieveの非同期版（Chroma・SQLiteの呼び出しはスレッドプールで実行）"""
+        documents, _ = await self.aroute_and_retrieve(query, user_id, version=version)
+        return documents
+
+    async def aroute_and_retrieve(
+        self,
+        query: str,
+        user_id: str,
+        version: Optional[int] = None,
+        query_embedding: Optional[List[float]] = None,
+    ) -> Tuple[Optional[List[LangChainDocument]], Optional[RouteDecision]]:
+        """route_and_retrieveの非同期版"""
+        if version is None:
+            version = await CorpusVersion.acurrent(user_id)
+        if not await run_blocking(self.backend.exists, user_id):
+            return None, None
+
+        lexical_docs = await run_blocking(self._search_lexical, query, user_id)
+        exact_docs = self._exact_matches(query, lexical_docs)
+        decision = self.router.route(query, bool(exact_docs))
+        if decision is not None and decision.mode == LEXICAL:
+            return self._routed(exact_docs, decision)
+
+        scored = None
+        if decision is None or decision.mode == DIRECT:
+            if query_embedding is None:
+                with timed("query_embed"):
+                    query_embedding = await run_blocking(self.embeddings.embed_query, query)
+            scored = await run_blocking(self._search_by_vector, user_id, version, query_embedding)
+            if decision is None and scored is not None:
+                decision = self.router.route_by_score(scored[0][1] if scored else None)
+
+        if decision is not None and decision.mode == HYDE:
+            query_embedding = await self.aembed_query(query)
+            scored = await run_blocking(self._search_by_vector, user_id, version, query_embedding)
+        return self._routed(self._fuse(scored, lexical_docs), decision)
+
+    def _routed(
+        self, documents: Optional[List[LangChainDocument]], decision: Optional[RouteDecision]
+    ) -> Tuple[Optional[List[LangChainDocument]], Optional[RouteDecision]]:
+        # ストアが検索中に削除された場合は判断を記録しない
+        if documents is None:
+            return None, None
+        record_route(decision)
+        logger.debug("クエリの検索方法: %s（%s、類似度 %s）", decision.mode, decision.reason, decision.score)
+        return documents, decision
+
+    def _search_lexical(self, query: str, user_id: str) -> List[LangChainDocument]:
+        if self.lexical_store is None:
+            return []
+        with timed("lexical_search"):
+            return self.lexical_store.for_user(user_id).search(query, k=settings.RAG_HYBRID_CANDIDATES)
+
+    def _exact_matches(self, query: str, lexical_docs: List[LangChainDocument]) -> List[LangChainDocument]:
+        """識別子をそのまま含む語彙検索の結果（語彙検索だけで答えられる場合）"""
+        if not settings.RAG_LEXICAL_FAST_PATH or not lexical_docs:
+            return []
+        identifiers = extract_identifiers(query)
+        if not identifiers:
+            return []
+        matches = [doc for doc in lexical_docs if contains_identifier(doc, identifiers)]
+        return matches[:settings.RAG_RETRIEVAL_K]
+
+    def _fuse(
+        self, scored: Optional[List[Tuple[LangChainDocument, float]]], lexical_docs: List[LangChainDocument]
+    ) -> Optional[List[LangChainDocument]]:
+        if scored is None:
+            return None
+        # 関連の薄いチャンクはベクトル検索の結果からだけ除く（語彙検索で一致したチャンクは
+        # 類似度が低くても残す）。どちらも空なら空のリスト
+        vector_docs = select_relevant(scored, settings.RAG_MIN_SIMILARITY, settings.RAG_SCORE_GAP)
+        if not vector_docs:
+            logger.debug("類似度が閾値以上のチャンクがありません（最高 %s）", scored[0][1] if scored else None)
+        if not lexical_docs or not vector_docs:
+            return (vector_docs or lexical_docs)[:settings.RAG_RETRIEVAL_K]
+        fused = reciprocal_rank_fusion([vector_docs, lexical_docs], k=settings.RAG_RRF_K)
+        return fused[:settings.RAG_RETRIEVAL_K]
+
+    def _search_by_vector(
+        self, user_id: str, version: int, query_embedding: List[float]
+    ) -> Optional[List[Tuple[LangChainDocument, float]]]:
+        # 語彙検索と統合する場合は統合前の候補を多めに取る
+        k = settings.RAG_HYBRID_CANDIDATES if self.lexical_store is not None else settings.RAG_RETRIEVAL_K
+        with timed("vector_search"), self.backend.open(user_id, version=version) as store:
+            if store is None:
+                return None
+            return store.search_with_scores(query_embedding, k=k)
 
     def generate_response(self, query: str, user_id: str) -> str:
         """RAGを使用して回答を生成"""
-        retriever = self.get_retriever(user_id)
+        return self.answer(query, user_id).response
 
-        if not retriever:
-            return "アップロードされたドキュメントがありません。まずドキュメントをアップロードしてください。"
+    def prepare(self, query: str, user_id: str, history: Optional[ChatHistory] = None) -> PreparedAnswer:
+        """回答キャッシュの参照・検索・プロンプト構築を行う
 
-        try:
-            relevant_docs = retriever.invoke(query)
+        会話の履歴があれば、追加の質問を単独で意味が通じる質問に書き換えて検索し、
+        プロンプトにも履歴を含める（回答キャッシュは使わない）。
+        """
+        version = CorpusVersion.current(user_id)
+        if history is not None and not history.is_empty:
+            retrieval_query = self.condense_query(query, history)
+            relevant_docs, decision = self.route_and_retrieve(retrieval_query, user_id, version)
+            return self._prepare_prompt(
+                query, relevant_docs, version, None, decision, history=history, retrieval_query=retrieval_query
+            )
 
-            if not relevant_docs:
-                return "関連する情報が見つかりませんでした。"
+        query_embedding = None
+        if self.answer_cache is not None and self.answer_cache.semantic:
+            query_embedding = self.embeddings.embed_query(query)
+        cached = self._lookup_answer(user_id, query, version, query_embedding)
+        if cached is not None:
+            return cached
 
-            # コンテキストを構築
-            context = "\n\n".join([doc.page_content for doc in relevant_docs])
+        relevant_docs, decision = self.route_and_retrieve(query, user_id, version, query_embedding)
+        return self._prepare_prompt(query, relevant_docs, version, query_embedding, decision)
 
-            # プロンプトを構築
-            prompt = f"""
+    async def aprepare(self, query: str, user_id: str, history: Optional[ChatHistory] = None) -> PreparedAnswer:
+        """prepareの非同期版"""
+        version = await CorpusVersion.acurrent(user_id)
+        if history is not None and not history.is_empty:
+            retrieval_query = await self.acondense_query(query, history)
+            relevant_docs, decision = await self.aroute_and_retrieve(retrieval_query, user_id, version)
+            return self._prepare_prompt(
+                query, relevant_docs, version, None, decision, history=history, retrieval_query=retrieval_query
+            )
+
+        query_embedding = None
+        if self.answer_cache is not None and self.answer_cache.semantic:
+            query_embedding = await run_blocking(self.embeddings.embed_query, query)
+        cached = self._lookup_answer(user_id, query, version, query_embedding)
+        if cached is not None:
+            return cached
+
+        relevant_docs, decision = await self.aroute_and_retrieve(query, user_id, version, query_embedding)
+        return self._prepare_prompt(query, relevant_docs, version, query_embedding, decision)
+
+    def condense_query(self, query: str, history: ChatHistory) -> str:
+        """追加の質問を、履歴を読まなくても意味が通じる検索用の質問に書き換える"""
+        with timed("condense"):
+            response = self.llm.invoke(condense_prompt(query, history))
+        return response.content.strip() or query
+
+    async def acondense_query(self, query: str, history: ChatHistory) -> str:
+        """condense_queryの非同期版"""
+        with timed("condense"):
+            response = await self.llm.ainvoke(condense_prompt(query, history))
+        return response.content.strip() or query
+
+    def summarize_history(self, summary: str, messages: Sequence[Tuple[str, str]]) -> str:
+        """これまでの要約に古いメッセージを畳み込んだ要約を作る"""
+        with timed("summarize"):
+            return self.llm.invoke(summary_prompt(summary, messages)).content
+
+    async def asummarize_history(self, summary: str, messages: Sequence[Tuple[str, str]]) -> str:
+        """summarize_historyの非同期版"""
+        with timed("summarize"):
+            response = await self.llm.ainvoke(summary_prompt(summary, messages))
+        return response.content
+
+    def _lookup_answer(
+        self, user_id: str, query: str, version: int, query_embedding: Optional[List[float]]
+    ) -> Optional[PreparedAnswer]:
+        if self.answer_cache is None:
+            return None
+        cached, cache_hit = self.answer_cache.get(user_id, query, version, query_embedding)
+        if cached is None:
+            return None
+        return PreparedAnswer(result=ChatResult(cached, cache_hit=cache_hit))
+
+    def _prepare_prompt(
+        self,
+        query: str,
+        relevant_docs: Optional[List[LangChainDocument]],
+        version: int,
+        query_embedding: Optional[List[float]],
+        decision: Optional[RouteDecision] = None,
+        history: Optional[ChatHistory] = None,
+        retrieval_query: Optional[str] = None,
+    ) -> PreparedAnswer:
+        route = decision.mode if decision is not None else None
+        if relevant_docs is None:
+            return PreparedAnswer(result=ChatResult(
+                "アップロードされたドキュメントがありません。まずドキュメントをアップロードしてください。"
+            ))
+
+        if not relevant_docs:
+            return PreparedAnswer(result=ChatResult(
+                "関連する情報が見つかりませんでした。", route=route, retrieval_query=retrieval_query
+            ))
+
+        # コンテキストを構築（隣接チャンクの重なりを除き、トークン数の上限内に収める）
+        with timed("prompt_build"):
+            context = self.context_builder.build(relevant_docs)
+
+            # 会話の履歴は要約と直近のやり取りをトークン数の上限内に収める
+            conversation = ""
+            if history is not None and not history.is_empty:
+                conversation = "これまでの会話:\n" + history.render(
+                    settings.RAG_CHAT_HISTORY_MAX_TOKENS, settings.RAG_CHAT_SUMMARY_MAX_TOKENS
+                ) + "\n\n"
+
+        # プロンプトを構築
+        prompt = f"""
 以下のコンテキストに基づいて、ユーザーの質問に回答してください。
 コンテキストに含まれていない情報については、「アップロードされたドキュメントでは回答できません」と答えてください。
 
 コンテキスト:
-{context}
+{context.text}
 
-質問: {query}
+{conversation}質問: {query}
 
 回答:"""
 
+        return PreparedAnswer(
+            prompt=prompt,
+            sources=summarize_sources(context.documents),
+            version=version,
+            query_embedding=query_embedding,
+            route=route,
+            retrieval_query=retrieval_query,
+            cacheable=history is None or history.is_empty,
+        )
+
+    def answer(self, query: str, user_id: str, history: Optional[ChatHistory] = None) -> ChatResult:
+        """RAGを使用して回答を生成（回答キャッシュを参照）"""
+        try:
+            prepared = self.prepare(query, user_id, history)
+            if prepared.result is not None:
+                return prepared.result
+
             # LLMで回答を生成
-            response = self.llm.invoke(prompt)
-            return response.content
+            with timed("llm"):
+                response = self.llm.invoke(prepared.prompt)
+
+            self._remember_answer(user_id, query, response.content, prepared)
+            return ChatResult(
+                response.content, sources=prepared.sources, route=prepared.route,
+                retrieval_query=prepared.retrieval_query,
+            )
+
+        except ModelUnavailableError as e:
+            return ChatResult(MODEL_UNAVAILABLE_MESSAGE, failed=True, retry_after=e.retry_after)
+        except Exception as e:
+            return ChatResult(f"回答の生成中にエラーが発生しました: {str(e)}", failed=True)
 
+    async def aanswer(self, query: str, user_id: str, history: Optional[ChatHistory] = None) -> ChatResult:
+        """answerの非同期版"""
+        try:
+            prepared = await self.aprepare(query, user_id, history)
+            if prepared.result is not None:
+                return prepared.result
+
+            with timed("llm"):
+                response = await self.llm.ainvoke(prepared.prompt)
+
+            self._remember_answer(user_id, query, response.content, prepared)
+            return ChatResult(
+                response.content, sources=prepared.sources, route=prepared.route,
+                retrieval_query=prepared.retrieval_query,
+            )
+
+        except ModelUnavailableError as e:
+            return ChatResult(MODEL_UNAVAILABLE_MESSAGE, failed=True, retry_after=e.retry_after)
+        except Exception as e:
+            return ChatResult(f"回答の生成中にエラーが発生しました: {str(e)}", failed=True)
+
+    def stream_answer(
+        self, query: str, user_id: str, history: Optional[ChatHistory] = None
+    ) -> Iterator[Tuple[str, dict]]:
+        """回答を(イベント名, データ)の列としてストリーミング
+
+        検索結果のメタデータ("metadata")を先に返し、続いてLLMのトークン("token")を
+        生成され次第返す。最後に回答全体("done")、失敗時は"error"を返す。
+        """
+        try:
+            prepared = self.prepare(query, user_id, history)
+            if prepared.result is not None:
+                yield from self._result_events(prepared.result)
+                return
+
+            yield "metadata", {
+                "sources": prepared.sources, "cache_hit": None, "route": prepared.route,
+                "retrieval_query": prepared.retrieval_query,
+            }
+
+            parts = []
+            # クライアントへの送信待ちも含め、最後のトークンまでの時間を計測する
+            with timed("llm"):
+                for chunk in self.llm.stream(prepared.prompt):
+                    if chunk.content:
+                        parts.append(chunk.content)
+                        yield "token", {"text": chunk.content}
+
+            response = "".join(parts)
+            self._remember_answer(user_id, query, response, prepared)
+            yield "done", {"response": response}
+
+        except ModelUnavailableError as e:
+            yield "error", {"error": MODEL_UNAVAILABLE_MESSAGE, "retry_after": e.retry_after}
         except Exception as e:
-            return f"回答の生成中にエラーが発生しました: {str(e)}"
+            yield "error", {"error": f"回答の生成中にエラーが発生しました: {str(e)}"}
+
+    async def astream_answer(
+        self, query: str, user_id: str, history: Optional[ChatHistory] = None
+    ) -> AsyncIterator[Tuple[str, dict]]:
+        """stream_answerの非同期版"""
+        try:
+            prepared = await self.aprepare(query, user_id, history)
+            if prepared.result is not None:
+                for event in self._result_events(prepared.result):
+                    yield event
+                return
+
+            yield "metadata", {
+                "sources": prepared.sources, "cache_hit": None, "route": prepared.route,
+                "retrieval_query": prepared.retrieval_query,
+            }
+
+            parts = []
+            with timed("llm"):
+                async for chunk in self.llm.astream(prepared.prompt):
+                    if chunk.content:
+                        parts.append(chunk.content)
+                        yield "token", {"text": chunk.content}
+
+            response = "".join(parts)
+            self._remember_answer(user_id, query, response, prepared)
+            yield "done", {"response": response}
+
+        except ModelUnavailableError as e:
+            yield "error", {"error": MODEL_UNAVAILABLE_MESSAGE, "retry_after": e.retry_after}
+        except Exception as e:
+            yield "error", {"error": f"回答の生成中にエラーが発生しました: {str(e)}"}
+
+    def _result_events(self, result: ChatResult) -> Iterator[Tuple[str, dict]]:
+        yield "metadata", {
+            "sources": result.sources, "cache_hit": result.cache_hit, "route": result.route,
+            "retrieval_query": result.retrieval_query,
+        }
+        yield "token", {"text": result.response}
+        yield "done", {"response": result.response}
+
+    def _remember_answer(self, user_id: str, query: str, response: str, prepared: PreparedAnswer):
+        if self.answer_cache is not None and prepared.cacheable:
+            self.answer_cache.set(user_id, query, response, prepared.version, prepared.query_embedding)
@@ -1,3 +1,527 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from .answer_cache import AnswerCache
+from .embedding_cache import EmbeddingCache
+from .fakes import FakeChatModel, FakeEmbeddings, FakeRateLimitError, generate_markdown_document
+from .gateway import ModelGateway, ModelUnavailableError
+from .lexical import LexicalIndexStore
+from .models import ChatSession, CorpusVersion
+from .pool import VectorStorePool
+from .services import DocumentProcessor, RAGService, build_vectorstore_backend, run_blocking
+
+
+class RAGTestCase(TestCase):
+    """擬似エンベディング・擬似LLMと一時ディレクトリのベクトルストアを使うテストの基底クラス"""
+
+    backend_name = "chroma"
+
+    def setUp(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.directory = directory
+        overrides = override_settings(
+            RAG_VECTORSTORE_BACKEND=self.backend_name,
+            CHROMA_PERSIST_DIRECTORY=directory / "chroma_db",
+            NUMPY_INDEX_DIRECTORY=str(directory / "numpy_index"),
+            LEXICAL_INDEX_DIRECTORY=str(directory / "lexical_index"),
+            # 擬似エンベディングの類似度は実際のモデルより低いため、類似度での足切りは無効にする
+            RAG_MIN_SIMILARITY=0.0,
+            RAG_SCORE_GAP=0.0,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.user = get_user_model().objects.create_user(username="alice", email="alice@example.com", password=None)
+        self.user_id = str(self.user.id)
+        self.embeddings = FakeEmbeddings()
+        self.llm = FakeChatModel()
+        self.backend = build_vectorstore_backend(self.embeddings)
+        self.addCleanup(self.backend.clear)
+        self.lexical_store = LexicalIndexStore(directory / "lexical_index")
+        self.processor = DocumentProcessor(
+            embeddings=self.embeddings, backend=self.backend, embedding_cache=None, lexical_store=self.lexical_store
+        )
+        self.rng = random.Random(0)
+
+    def make_service(self, **kwargs) -> RAGService:
+        return RAGService(
+            embeddings=self.embeddings, llm=self.llm, backend=self.backend, lexical_store=self.lexical_store, **kwargs
+        )
+
+    def write_document(self, index: int, text: str = None) -> str:
+        path = self.directory / f"doc_{index}.md"
+        path.write_text(text or generate_markdown_document(index, 4, self.rng), encoding="utf-8")
+        return str(path)
+
+    def ingest(self, *indexes: int) -> dict:
+        items = [(self.write_document(index), self.user_id, f"doc_{index}") for index in indexes]
+        return self.processor.ingest_documents(items)
+
+    def document_chunks(self, document_id: str):
+        with self.backend.open(self.user_id) as store:
+            return store.get_document_chunks(document_id)[0]
+
+
+class IngestRetrieveGenerateTests(RAGTestCase):
+    def test_ingest_retrieve_and_generate_response(self):
+        results = self.ingest(0, 1, 2)
+        self.assertTrue(all(isinstance(count, int) and count > 0 for count in results.values()), results)
+
+        service = self.make_service()
+        documents = service.retrieve("検索の手順が上限を超えたらどうすればいいですか？", self.user_id)
+        self.assertTrue(documents)
+        self.assertTrue(all(document.metadata["user_id"] == self.user_id for document in documents))
+
+        response = service.generate_response("検索の手順が上限を超えたらどうすればいいですか？", self.user_id)
+        self.assertTrue(response.startswith("擬似的な回答です。"))
+        self.assertGreater(self.llm.call_count, 0)
+
+    def test_identifier_query_uses_lexical_search_only(self):
+        self.ingest(0)
+        service = self.make_service()
+        requests = self.embeddings.request_count
+
+        documents, decision = service.route_and_retrieve("エラーコード E0-001 の原因は？", self.user_id)
+
+        self.assertEqual(decision.mode, "lexical")
+        self.assertTrue(any("E0-001" in document.page_content for document in documents))
+        self.assertEqual(self.embeddings.request_count, requests)
+
+    def test_lexical_match_is_kept_when_no_vector_hit_passes_the_threshold(self):
+        self.ingest(0)
+        path = self.write_document(1, "# 保守窓口\n\nゼフィランサス社の保守窓口は第三営業部が担当します。\n")
+        self.processor.ingest_documents([(path, self.user_id, "doc_1")])
+        service = self.make_service()
+
+        with override_settings(RAG_MIN_SIMILARITY=1.01):
+            documents = service.retrieve("ゼフィランサス社の窓口はどこですか", self.user_id)
+            unrelated = service.retrieve("今日の天気", self.user_id)
+
+        self.assertTrue(any("ゼフィランサス社" in document.page_content for document in documents))
+        self.assertEqual(unrelated, [])
+
+    def test_user_without_documents_gets_no_llm_call(self):
+        response = self.make_service().generate_response("設定の手順は？", self.user_id)
+
+        self.assertIn("ドキュメントがありません", response)
+        self.assertEqual(self.llm.call_count, 0)
+
+
+class NumpyIngestRetrieveGenerateTests(IngestRetrieveGenerateTests):
+    backend_name = "numpy"
+
+
+class NumpyBackendStorageTests(RAGTestCase):
+    backend_name = "numpy"
+
+    def read_meta(self) -> dict:
+        return json.loads((self.backend.user_directory(self.user_id) / "meta.json").read_text(encoding="utf-8"))
+
+    def test_appends_keep_the_vector_file_and_previous_generation(self):
+        self.ingest(0)
+        first = self.read_meta()
+
+        self.ingest(1)
+        second = self.read_meta()
+
+        # 追加だけなら行列のファイルに追記し、メタデータには本文を持たない
+        self.assertEqual(second["vectors"], first["vectors"])
+        self.assertNotIn("documents", second)
+        self.processor.delete_documents_from_vectorstore(self.user_id, ["doc_0"])
+        third = self.read_meta()
+        self.assertNotEqual(third["vectors"], first["vectors"])
+        # 直前の世代のファイルは次の書き込みまで残る
+        self.assertTrue((self.backend.user_directory(self.user_id) / second["vectors"]).exists())
+
+    def test_reload_from_disk_matches_written_chunks(self):
+        self.ingest(0, 1)
+        before = [chunk.page_content for chunk in self.document_chunks("doc_1")]
+
+        self.backend.clear()
+
+        self.assertEqual([chunk.page_content for chunk in self.document_chunks("doc_1")], before)
+
+
+class ReplaceDocumentTests(RAGTestCase):
+    def test_only_changed_chunks_are_embedded(self):
+        text = generate_markdown_document(0, 6, self.rng)
+        path = self.write_document(0, text)
+        total = self.processor.ingest_document(path, self.user_id, "doc_0")
+        embedded = self.embeddings.text_count
+
+        # 最後の節だけを書き換える
+        self.write_document(0, text + "\n## 追記\n\n追記した節の本文です。\n")
+        self.processor.ingest_document(path, self.user_id, "doc_0")
+
+        changed = self.embeddings.text_count - embedded
+        self.assertGreater(changed, 0)
+        self.assertLess(changed, total)
+        self.assertIn("追記した節の本文です。", "".join(chunk.page_content for chunk in self.document_chunks("doc_0")))
+
+    def test_reingesting_the_same_file_embeds_nothing(self):
+        path = self.write_document(0)
+        self.processor.ingest_document(path, self.user_id, "doc_0")
+        embedded = self.embeddings.text_count
+        version = CorpusVersion.current(self.user_id)
+
+        self.processor.ingest_document(path, self.user_id, "doc_0")
+
+        self.assertEqual(self.embeddings.text_count, embedded)
+        self.assertEqual(CorpusVersion.current(self.user_id), version)
+
+
+class DeleteDocumentsTests(RAGTestCase):
+    def test_bulk_delete_empties_the_store(self):
+        self.ingest(0, 1)
+
+        self.assertTrue(self.processor.delete_documents_from_vectorstore(self.user_id, ["doc_0", "doc_1"]))
+
+        self.assertFalse(self.backend.exists(self.user_id))
+        self.assertIsNone(self.make_service().retrieve("検索の手順は？", self.user_id))
+        self.assertEqual(self.lexical_store.for_user(self.user_id).count(), 0)
+
+    def test_partial_delete_keeps_other_documents(self):
+        self.ingest(0, 1)
+        version = CorpusVersion.current(self.user_id)
+
+        self.assertTrue(self.processor.delete_documents_from_vectorstore(self.user_id, ["doc_0"]))
+
+        self.assertEqual(self.document_chunks("doc_0"), [])
+        self.assertTrue(self.document_chunks("doc_1"))
+        self.assertGreater(CorpusVersion.current(self.user_id), version)
+
+
+class AnswerCacheTests(RAGTestCase):
+    def test_cache_ignores_answers_from_another_version(self):
+        cache = AnswerCache(max_users=10, max_entries_per_user=10, ttl=60)
+        cache.set(self.user_id, "設定の手順は？", "回答", version=1)
+
+        self.assertEqual(cache.get(self.user_id, " 設定の手順は? ", version=1), ("回答", "exact"))
+        self.assertEqual(cache.get(self.user_id, "設定の手順は？", version=2), (None, None))
+
+    def test_ingest_invalidates_cached_answers(self):
+        self.ingest(0)
+        service = self.make_service(answer_cache=AnswerCache(max_users=10, max_entries_per_user=10, ttl=60))
+        query = "検索の手順が上限を超えたらどうすればいいですか？"
+
+        self.assertIsNone(service.answer(query, self.user_id).cache_hit)
+        self.assertEqual(service.answer(query, self.user_id).cache_hit, "exact")
+        calls = self.llm.call_count
+
+        self.ingest(1)
+        self.assertIsNone(service.answer(query, self.user_id).cache_hit)
+        self.assertGreater(self.llm.call_count, calls)
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def make_cache(self, max_entries: int) -> EmbeddingCache:
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        cache = EmbeddingCache(directory / "cache.sqlite3", "fake", max_entries=max_entries)
+        self.addCleanup(cache._conn.close)
+        return cache
+
+    def test_eviction_keeps_recent_entries_and_counts_in_batches(self):
+        cache = self.make_cache(max_entries=100)
+        statements = []
+        cache._conn.set_trace_callback(statements.append)
+
+        for index in range(150):
+            cache.put_many([f"テキスト{index}"], [[float(index)]])
+
+        self.assertLessEqual(cache.stats()["entries"], 100)
+        self.assertEqual(cache.get_many(["テキスト149"]), [[149.0]])
+        self.assertEqual(cache.get_many(["テキスト0"]), [None])
+        # 件数は上限を超えたと見積もったときだけ数え直す
+        counts = [statement for statement in statements if "COUNT(*)" in statement]
+        self.assertLessEqual(len(counts), 6)
+
+
+class VectorStorePoolTests(RAGTestCase):
+    def test_entry_is_reopened_when_version_changes(self):
+        pool = VectorStorePool(self.embeddings, max_size=4)
+        self.addCleanup(pool.clear)
+
+        with pool.acquire(self.user_id, create=True, version=1) as first:
+            pass
+        with pool.acquire(self.user_id, version=1) as same:
+            self.assertIs(same, first)
+        with pool.acquire(self.user_id, version=2) as reopened:
+            self.assertIsNot(reopened, first)
+
+    def test_shared_entry_is_reopened_after_another_process_writes(self):
+        pool = VectorStorePool(self.embeddings, max_size=4, mode="shared", shards=1)
+        self.addCleanup(pool.clear)
+        other = get_user_model().objects.create_user(username="bob", email="bob@example.com", password=None)
+
+        with pool.acquire(self.user_id, create=True, version=0) as first:
+            pass
+        # 共有エントリを開いた後に他のユーザーのコーパスが更新された
+        version = CorpusVersion.bump(str(other.id))
+        with pool.acquire(str(other.id), version=version) as reopened:
+            self.assertIsNot(reopened, first)
+
+
+    def test_opening_a_store_does_not_block_other_users(self):
+        pool = VectorStorePool(self.embeddings, max_size=4)
+        self.addCleanup(pool.clear)
+        with pool.acquire(self.user_id, create=True, version=1):
+            pass
+
+        opening, release = threading.Event(), threading.Event()
+        open_entry = pool._open
+
+        def slow_open(*args):
+            opening.set()
+            release.wait(5)
+            return open_entry(*args)
+
+        with mock.patch.object(pool, "_open", side_effect=slow_open):
+            def open_other():
+                with pool.acquire("other", create=True):
+                    pass
+
+            thread = threading.Thread(target=open_other)
+            thread.start()
+            self.assertTrue(opening.wait(5))
+            # 他のユーザーのストアを開いている間も、保持中のエントリはすぐに借用できる
+            started = time.monotonic()
+            with pool.acquire(self.user_id, version=1) as entry:
+                self.assertIsNotNone(entry)
+            self.assertLess(time.monotonic() - started, 1)
+            release.set()
+            thread.join(5)
+
+    def test_concurrent_opens_of_the_same_store_share_one_entry(self):
+        pool = VectorStorePool(self.embeddings, max_size=4)
+        self.addCleanup(pool.clear)
+        open_entry = pool._open
+        entries = []
+
+        def slow_open(*args):
+            time.sleep(0.05)
+            return open_entry(*args)
+
+        def checkout():
+            entries.append(pool._checkout(self.user_id, create=True, version=1))
+
+        with mock.patch.object(pool, "_open", side_effect=slow_open) as opened:
+            threads = [threading.Thread(target=checkout) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(opened.call_count, 1)
+        self.assertIs(entries[0], entries[1])
+        self.assertEqual(entries[0].refs, 2)
+        for entry in entries:
+            pool._checkin(entry)
+
+
+class ChatStreamApiTests(RAGTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingest(0)
+        patcher = mock.patch("rag.views.get_rag_service", return_value=self.make_service())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.async_client.force_login(self.user)
+
+    async def stream(self, body) -> list:
+        response = await self.async_client.post(
+            reverse("rag:chat_stream_api"), body, content_type="application/json"
+        )
+        content = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        events = []
+        for raw in content.strip().split("\n\n"):
+            event, data = raw.split("\n")
+            events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+        return events
+
+    async def test_turn_is_saved_before_done_and_session_is_created_lazily(self):
+        events = await self.stream({"query": "検索の手順は？"})
+
+        metadata, done = dict(events)["metadata"], dict(events)["done"]
+        # 新しい会話は回答を保存するまで作らない
+        self.assertIsNone(metadata["session_id"])
+        session = await ChatSession.objects.aget(pk=done["session_id"])
+        self.assertEqual(await session.messages.acount(), 2)
+
+        events = await self.stream({"query": "その続きは？", "session_id": done["session_id"]})
+        self.assertEqual(dict(events)["metadata"]["session_id"], done["session_id"])
+        self.assertEqual(await session.messages.acount(), 4)
+        self.assertEqual(await ChatSession.objects.acount(), 1)
+
+    async def test_invalid_requests_get_json_errors(self):
+        invalid = [(["検索の手順は？"], 400), ({"query": 1}, 400), ({"query": "手順は？", "session_id": "x"}, 404)]
+        for body, status in invalid:
+            response = await self.async_client.post(
+                reverse("rag:chat_stream_api"), body, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, status, body)
+            self.assertIn("error", json.loads(response.content))
+
+        with mock.patch("rag.views.aload_history", side_effect=RuntimeError("boom")):
+            response = await self.async_client.post(
+                reverse("rag:chat_stream_api"), {"query": "手順は？"}, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("boom", json.loads(response.content)["error"])
+
+    async def test_failed_answer_creates_no_session(self):
+        with mock.patch.object(FakeChatModel, "_astream", side_effect=RuntimeError("boom")):
+            events = await self.stream({"query": "検索の手順は？"})
+
+        self.assertEqual(events[-1][0], "error")
+        self.assertFalse(await ChatSession.objects.aexists())
+
+
+class RunBlockingTests(SimpleTestCase):
+    def test_db_connections_are_closed_around_the_call_in_the_worker_thread(self):
+        threads = []
+        with mock.patch("rag.services.close_old_connections", side_effect=lambda: threads.append(threading.get_ident())):
+            result = asyncio.run(run_blocking(lambda value: (threading.get_ident(), value), 1))
+
+        worker, value = result
+        self.assertEqual(value, 1)
+        self.assertNotEqual(worker, threading.get_ident())
+        self.assertEqual(threads, [worker, worker])
+
+
+class ModelGatewayTests(SimpleTestCase):
+    def make_gateway(self, **kwargs) -> ModelGateway:
+        options = {"max_concurrency": 4, "backoff_base": 0.001, "failure_threshold": 3, "reset_timeout": 0.05}
+        options.update(kwargs)
+        return ModelGateway("test", **options)
+
+    def test_retries_transient_errors(self):
+        gateway = self.make_gateway()
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError("reset")
+            return "ok"
+
+        self.assertEqual(gateway.call(flaky), "ok")
+        self.assertEqual(len(calls), 3)
+        self.assertFalse(gateway.breaker.is_open)
+
+    def test_does_not_retry_invalid_requests(self):
+        gateway = self.make_gateway()
+        calls = []
+
+        def invalid():
+            calls.append(1)
+            raise ValueError("invalid")
+
+        with self.assertRaises(ValueError):
+            gateway.call(invalid)
+        self.assertEqual(len(calls), 1)
+
+    def test_breaker_fails_fast_and_recovers(self):
+        gateway = self.make_gateway(max_retries=0)
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise ConnectionError("down")
+
+        for _ in range(3):
+            with self.assertRaises(ModelUnavailableError):
+                gateway.call(down)
+        self.assertTrue(gateway.breaker.is_open)
+
+        with self.assertRaises(ModelUnavailableError):
+            gateway.call(down)
+        self.assertEqual(len(calls), 3)
+
+        time.sleep(0.06)
+        self.assertEqual(gateway.call(lambda: "ok"), "ok")
+        self.assertFalse(gateway.breaker.is_open)
+
+    def test_rate_limits_do_not_open_the_breaker(self):
+        gateway = self.make_gateway(max_retries=0)
+
+        def limited():
+            raise FakeRateLimitError("429 Resource has been exhausted (fake)")
+
+        for _ in range(5):
+            with self.assertRaises(ModelUnavailableError) as raised:
+                gateway.call(limited)
+            self.assertTrue(raised.exception.rate_limited)
+        self.assertFalse(gateway.breaker.is_open)
+
+    def test_concurrent_identical_calls_are_coalesced(self):
+        gateway = self.make_gateway()
+        calls = []
+        started = threading.Event()
+
+        def slow():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return "shared"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(gateway.call(slow, key="same")))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(gateway.call(slow, key="same"))) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        for thread in [leader, *followers]:
+            thread.join()
+
+        self.assertEqual(results, ["shared"] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_concurrent_identical_async_calls_are_coalesced(self):
+        gateway = self.make_gateway()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "shared"
+
+        async def run():
+            return await asyncio.gather(*[gateway.acall(slow, key="same") for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), ["shared"] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_concurrency_is_limited(self):
+        gateway = self.make_gateway(max_concurrency=2)
+        active, peak = [0], [0]
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+
+        threads = [threading.Thread(target=gateway.call, args=(work,)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(peak[0], 2)
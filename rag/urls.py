@@ -5,5 +5,8 @@ app_name = 'rag'
 
 urlpatterns = [
     path('chat/', views.chat_view, name='chat'),
+    path('chat/<uuid:session_id>/', views.chat_view, name='chat_session'),
     path('api/chat/', views.chat_api, name='chat_api'),
+    path('api/chat/stream/', views.chat_stream_api, name='chat_stream_api'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
@@ -1,41 +1,185 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
+import hmac
 import json
+import logging
+import math
 
-from .services import RAGService
+from .conversation import afold_history, aget_session, aload_history, arecord_turn
+from .metrics import CONTENT_TYPE, REGISTRY
+from .models import ChatSession
+from .services import ChatResult, get_rag_service
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_query(request):
+    """リクエストボディから質問と会話のIDを取り出す（不正な場合はエラーレスポンスを返す）"""
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return None, None, JsonResponse({'error': '無効なJSONデータです。'}, status=400)
+    if not isinstance(data, dict) or not isinstance(data.get('query', ''), str):
+        return None, None, JsonResponse({'error': '無効なJSONデータです。'}, status=400)
+
+    query = data.get('query', '').strip()
+    if not query:
+        return None, None, JsonResponse({'error': '質問を入力してください。'}, status=400)
+    return query, data.get('session_id') or None, None
+
+
+async def _get_session(user, session_id):
+    """会話を取得（session_idが無ければ未保存の新しい会話を返す）"""
+    try:
+        return await aget_session(user, session_id), None
+    except (ChatSession.DoesNotExist, ValidationError):
+        return None, JsonResponse({'error': '会話が見つかりません。'}, status=404)
+
+
+def _session_id(session):
+    """会話のID（まだ保存していない会話ならNone）"""
+    return None if session._state.adding else str(session.id)
+
+
+async def _remember_turn(session, query, result):
+    """回答を会話に保存（失敗した回答は保存しない）。保存したかどうかを返す"""
+    if result.failed:
+        return False
+    await arecord_turn(session, query, result)
+    return True
+
+
+async def _fold_history(session, rag_service):
+    """履歴が上限を超えたら古いやり取りを要約に畳み込む"""
+    try:
+        await afold_history(session, rag_service)
+    except Exception:
+        # 要約に失敗しても回答は返す（畳み込めなかったメッセージは次の質問の後に再試行される）
+        logger.exception('会話の履歴の要約に失敗しました: %s', session.pk)
+
+
+def _format_sse(event, data):
+    """Server-Sent Events形式の1イベント"""
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
 
 
 @login_required
-def chat_view(request):
-    """チャット画面"""
-    return render(request, 'rag/chat.html')
+def chat_view(request, session_id=None):
+    """チャット画面（session_idを指定すると、その会話の続きから表示する）"""
+    session = None
+    messages = []
+    if session_id is not None:
+        session = get_object_or_404(ChatSession, pk=session_id, user=request.user)
+        messages = list(session.messages.values('role', 'content'))
+    return render(request, 'rag/chat.html', {
+        'session': session,
+        'chat_messages': messages,
+        'sessions': ChatSession.objects.filter(user=request.user).only('id', 'title')[:20],
+    })
 
 
 @login_required
 @csrf_exempt
 @require_http_methods(["POST"])
-def chat_api(request):
-    """チャットAPI"""
+async def chat_api(request):
+    """チャットAPI（ASGIではLLMの応答待ちでワーカースレッドを占有しない）"""
     try:
-        data = json.loads(request.body)
-        query = data.get('query', '').strip()
+        query, session_id, error_response = _parse_query(request)
+        if error_response:
+            return error_response
+
+        user = await request.auser()
+        session, error_response = await _get_session(user, session_id)
+        if error_response:
+            return error_response
 
-        if not query:
-            return JsonResponse({'error': '質問を入力してください。'}, status=400)
+        # RAGサービスで会話の履歴を踏まえて回答を生成
+        rag_service = get_rag_service()
+        result = await rag_service.aanswer(query, str(user.id), await aload_history(session))
+        if await _remember_turn(session, query, result):
+            await _fold_history(session, rag_service)
 
-        # RAGサービスで回答を生成
-        rag_service = RAGService()
-        response = rag_service.generate_response(query, str(request.user.id))
+        if result.retry_after is not None:
+            # モデルが障害中・混雑中のため、クライアントに待ってから再試行してもらう
+            response = JsonResponse({
+                'error': result.response, 'retry_after': result.retry_after, 'session_id': _session_id(session),
+            }, status=503)
+            response['Retry-After'] = str(math.ceil(result.retry_after))
+            return response
 
         return JsonResponse({
-            'response': response,
-            'query': query
+            'response': result.response,
+            'query': query,
+            'cached': result.cache_hit is not None,
+            'cache_hit': result.cache_hit,
+            'route': result.route,
+            'session_id': _session_id(session),
+            'retrieval_query': result.retrieval_query,
         })
 
-    except json.JSONDecodeError:
-        return JsonResponse({'error': '無効なJSONデータです。'}, status=400)
     except Exception as e:
         return JsonResponse({'error': f'エラーが発生しました: {str(e)}'}, status=500)
+
+
+@login_required
+@csrf_exempt
+@require_http_methods(["POST"])
+async def chat_stream_api(request):
+    """チャットAPI（Server-Sent Eventsでトークンを逐次返す）"""
+    # ストリームを始める前のエラーは、chat_apiと同じくJSONで返す
+    try:
+        query, session_id, error_response = _parse_query(request)
+        if error_response:
+            return error_response
+
+        user = await request.auser()
+        session, error_response = await _get_session(user, session_id)
+        if error_response:
+            return error_response
+        rag_service = get_rag_service()
+        history = await aload_history(session)
+    except Exception as e:
+        return JsonResponse({'error': f'エラーが発生しました: {str(e)}'}, status=500)
+
+    async def event_stream():
+        retrieval_query, remembered = None, False
+        async for event, data in rag_service.astream_answer(query, str(user.id), history):
+            if event == 'metadata':
+                retrieval_query = data.get('retrieval_query')
+                data = {**data, 'session_id': _session_id(session)}
+            elif event == 'done':
+                # 次の質問が今回のやり取りを履歴として読めるよう、doneを送る前に保存する
+                # （途中で切断された場合は保存しない）
+                remembered = await _remember_turn(
+                    session, query, ChatResult(data['response'], retrieval_query=retrieval_query)
+                )
+                data = {**data, 'session_id': _session_id(session)}
+            yield _format_sse(event, data)
+        # 要約は時間がかかるため、回答を送り終えてから行う
+        if remembered:
+            await _fold_history(session, rag_service)
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # nginxなどのプロキシでバッファリングさせない
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """段階ごとの所要時間などのメトリクス（Prometheus形式、このプロセス分のみ）"""
+    if not settings.RAG_METRICS_ENABLED:
+        raise Http404
+    if settings.RAG_METRICS_TOKEN:
+        expected = f'Bearer {settings.RAG_METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponse(status=401)
+    elif not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
@@ -110,6 +110,12 @@ document.addEventListener('DOMContentLoaded', function() {
             formData.append('file', file);
         });
 
+        // 同名ファイルを更新するかどうか
+        const replaceMode = document.getElementById('id_mode_replace');
+        if (replaceMode && replaceMode.checked) {
+            formData.append('mode', replaceMode.value);
+        }
+
         // XMLHttpRequestでアップロード
         const xhr = new XMLHttpRequest();
 